@@ -1,13 +1,21 @@
 import streamlit as st
 import pandas as pd
-from playwright.sync_api import sync_playwright
+from playwright.async_api import async_playwright
 import os
 from datetime import datetime
 import time
 import asyncio
 import sys
+import threading
+import atexit
+import contextlib
 import json
 import re
+import random
+import numbers
+import unicodedata
+import sqlite3
+from urllib.parse import urlsplit
 
 # Bug fix for Windows
 if sys.platform == 'win32':
@@ -17,18 +25,32 @@ if sys.platform == 'win32':
     asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
 
 import gspread
+from gspread.utils import rowcol_to_a1
 from google.oauth2.service_account import Credentials
 
 st.set_page_config(page_title="Monitor Alojamientos", layout="wide")
 
 # --- CONEXIÓN GOOGLE SHEETS ---
+# Un cliente autorizado por proceso (get_gsheets_connection): google-auth renueva el token
+# solo cuando caduca. La hoja se busca por nombre (búsqueda en Drive) una única vez y
+# luego se abre por ID; hoja y pestañas quedan guardadas, así que cada lectura o escritura
+# es una sola llamada a la API. Si una llamada falla (token revocado, pestaña borrada,
+# red), se descarta todo lo guardado, se reconecta y se reintenta una vez.
+SPREADSHEET_NAME = "Base de Datos Reviews"
+
 class GSheetsConnection:
     def __init__(self, secrets):
         self.scope = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
         self.secrets = secrets
         self.client = None
+        self.spreadsheet_id = None
+        self.reconnects = 0
+        self._spreadsheet = None
+        self._worksheets = {}
+        self._lock = threading.Lock()
         
     def connect(self):
+        if self.client: return True
         try:
             # Intentar cargar desde st.secrets (Streamlit Cloud o secrets.toml)
             if "gcp_service_account" in self.secrets:
@@ -47,16 +69,47 @@ class GSheetsConnection:
             print(f"Error conectando a GSheets: {e}")
             return False
 
-    def get_data(self, sheet_name="Reviews"):
+    def reset(self):
+        """Olvida cliente, hoja y pestañas (el ID de la hoja se conserva)."""
+        with self._lock:
+            self.client = None
+            self._spreadsheet = None
+            self._worksheets = {}
+
+    def worksheet(self, sheet_name, create=False):
+        """Pestaña guardada; si no existe se crea (create) o se usa la primera."""
+        with self._lock:
+            if sheet_name not in self._worksheets:
+                if self._spreadsheet is None:
+                    self._spreadsheet = (self.client.open_by_key(self.spreadsheet_id) if self.spreadsheet_id
+                                         else self.client.open(SPREADSHEET_NAME))
+                    self.spreadsheet_id = self._spreadsheet.id
+                try:
+                    ws = self._spreadsheet.worksheet(sheet_name)
+                except gspread.exceptions.WorksheetNotFound:
+                    # Sin guardar la primera pestaña en su lugar: una escritura posterior la crearía
+                    if not create: return self._spreadsheet.sheet1
+                    ws = self._spreadsheet.add_worksheet(title=sheet_name, rows="1000", cols="20")
+                self._worksheets[sheet_name] = ws
+            return self._worksheets[sheet_name]
+
+    def run(self, sheet_name, op, create=False):
+        """op(worksheet), reconectando y reintentando una vez si falla la API o la red."""
+        try:
+            return op(self.worksheet(sheet_name, create))
+        except (ValueError, gspread.exceptions.SpreadsheetNotFound):
+            raise  # Datos o configuración: reintentar no lo arregla
+        except Exception as e:
+            print(f"GSheets: reconectando tras {type(e).__name__}: {e}")
+            self.reset()
+            self.reconnects += 1
+            if not self.connect(): raise
+            return op(self.worksheet(sheet_name, create))
+
+    def get_data(self, sheet_name="Reviews", create=False):
         if not self.client: return pd.DataFrame()
         try:
-            # Buscar la hoja. Si no existe la crea (o usa la primera)
-            try:
-                sheet = self.client.open("Base de Datos Reviews").worksheet(sheet_name)
-            except:
-                sheet = self.client.open("Base de Datos Reviews").sheet1
-            
-            data = sheet.get_all_records()
+            data = self.run(sheet_name, lambda ws: ws.get_all_records(), create=create)
             df = pd.DataFrame(data)
             return df
         except Exception as e:
@@ -69,112 +122,625 @@ class GSheetsConnection:
                 st.sidebar.code(f"Response Body: {e.response.text}")
             return pd.DataFrame()
 
-    def save_data(self, df, sheet_name="Reviews"):
+    def save_data(self, df, sheet_name="Reviews", partial=False, complete=None):
+        """
+        Vuelca df en la hoja (upsert por Hash).
+        partial: df son solo las filas tocadas; no se lee la hoja entera ni se borra nada.
+        complete: en parcial, hashes -> filas completas (locales) para los que la hoja aún no tiene.
+        """
         if not self.client: return False
-        try:
-            try:
-                sh = self.client.open("Base de Datos Reviews")
-                try: worksheet = sh.worksheet(sheet_name)
-                except: worksheet = sh.add_worksheet(title=sheet_name, rows="1000", cols="20")
-            except Exception as e:
-                st.error(f"No se encontró la hoja 'Base de Datos Reviews'. Asegúrate de haberla creado y compartido con el email del bot.")
-                print(f"Error opening sheet: {e}")
-                return False
 
+        def _clean(df):
             # Reemplazar NaN con "" para que JSON no falle
-            df_clean = df.fillna("")
-            worksheet.clear()
-            worksheet.update([df_clean.columns.values.tolist()] + df_clean.values.tolist())
+            # Las derivadas (DERIVED_COLS) no se suben: se recalculan al importar
+            df_clean = df.drop(columns=DERIVED_COLS, errors="ignore")
+            if "Date" in df_clean.columns and pd.api.types.is_datetime64_any_dtype(df_clean["Date"]):
+                df_clean["Date"] = df_clean["Date"].dt.strftime('%Y-%m-%d %H:%M:%S')
+            df_clean = df_clean.astype(object).fillna("")
+            if "Hash" not in df_clean.columns: df_clean["Hash"] = ""
+            if not df_clean.empty: df_clean["Hash"] = review_hashes(df_clean)  # La clave del upsert
+            return df_clean
+
+        try:
+            df_clean = _clean(df)
+            full_rows = (lambda keys: _clean(complete(keys))) if complete else None
+            self.last_save = self.run(sheet_name, lambda ws: upsert_worksheet(ws, df_clean, partial=partial, complete=full_rows), create=True)
+            print(f"☁️ GSheets: {self.last_save}")
             return True
+        except gspread.exceptions.SpreadsheetNotFound as e:
+            st.error(f"No se encontró la hoja '{SPREADSHEET_NAME}'. Asegúrate de haberla creado y compartido con el email del bot.")
+            print(f"Error opening sheet: {e}")
+            return False
         except Exception as e:
             st.error(f"Error guardando en GSheets: {e}")
             print(f"❌ Error GSheets (save_data): {e}")
             return False
 
-# Inicializar conexión global
-try:
-    GS_CONN = GSheetsConnection(st.secrets) if "gcp_service_account" in st.secrets else None
-except:
-    GS_CONN = None
+# --- ESCRITURA INCREMENTAL EN SHEETS (upsert por Hash) ---
+# En vez de clear() + subir todo: se lee la hoja una vez, se comparan las filas por Hash
+# y solo se envían las celdas que cambian (batch_update), las filas nuevas (append_rows)
+# y, al final, se borran las filas que ya no existen. Si algo falla a mitad, la hoja
+# queda con datos de más, nunca vacía. En modo parcial (ediciones sueltas) solo se lee
+# la cabecera y la columna Hash, y se escriben las columnas de las filas recibidas; las
+# que la hoja aún no tiene se añaden con su fila completa (complete), nunca a medias.
+def _sheet_cell(value):
+    """Valor comparable entre el DataFrame y la hoja leída con UNFORMATTED_VALUE."""
+    if value is None or (not isinstance(value, str) and pd.isna(value)): return ""
+    if isinstance(value, bool) or str(value) in ("True", "False", "TRUE", "FALSE"): return str(value).upper()
+    if isinstance(value, numbers.Number): return repr(round(float(value), 6))
+    return str(value)
+
+def _row_runs(cols):
+    """[1,2,3,7] -> [(1,3),(7,7)]: tramos contiguos para mandar un rango por tramo."""
+    runs = []
+    for c in sorted(cols):
+        if runs and c == runs[-1][1] + 1: runs[-1][1] = c
+        else: runs.append([c, c])
+    return [tuple(r) for r in runs]
+
+def upsert_worksheet(worksheet, df, key="Hash", partial=False, complete=None):
+    """
+    Sincroniza la hoja con df (clave key). Devuelve el recuento de cambios enviados.
+    complete (parcial): claves -> DataFrame con las filas enteras de las que no están en la
+    hoja. Las que no devuelva no se añaden (una fila con solo Hash + un campo no sirve).
+    """
+    stats = {"celdas": 0, "nuevas": 0, "borradas": 0}
+    if partial:
+        header = worksheet.row_values(1)
+        keys = worksheet.col_values(header.index(key) + 1, value_render_option="UNFORMATTED_VALUE")[1:] if key in header else []
+        values = [header] + [[""] * header.index(key) + [k] for k in keys] if header else []
+    else:
+        values = worksheet.get_all_values(value_render_option="UNFORMATTED_VALUE")
+    # Filas enteras de las claves que la hoja no tiene (solo en parcial y con complete)
+    full_rows = {}
+    if partial and complete is not None and key in df.columns:
+        key_i = values[0].index(key) if values and key in values[0] else None
+        known = {_sheet_cell(row[key_i]) for row in values[1:] if key_i is not None and key_i < len(row)}
+        unknown = [h for h in dict.fromkeys(df[key].map(_sheet_cell)) if h and h not in known]
+        full = complete(unknown) if unknown else pd.DataFrame()
+        full_rows = {_sheet_cell(rec[key]): rec for rec in full.to_dict("records")}
+
+    if not values or not any(values[0]):
+        # Hoja vacía: cabecera + todo (primera subida)
+        if complete is not None:
+            df = pd.DataFrame(list(full_rows.values()))
+            if df.empty: return stats
+        worksheet.update([df.columns.tolist()] + df.values.tolist(), "A1")
+        stats["nuevas"] = len(df)
+        return stats
+
+    header = list(values[0])
+    if key not in header or key not in df.columns:
+        raise ValueError(f"Falta la columna '{key}' en la hoja o en los datos")
+
+    # Columnas nuevas: se añaden al final de la cabecera
+    extra_cols = dict.fromkeys(c for rec in full_rows.values() for c in rec)
+    missing = [c for c in dict.fromkeys([*df.columns, *extra_cols]) if c not in header]
+    if missing:
+        if len(header) + len(missing) > worksheet.col_count:
+            worksheet.add_cols(len(header) + len(missing) - worksheet.col_count)
+        worksheet.update([missing], rowcol_to_a1(1, len(header) + 1))
+        header += missing
+    col_pos = {c: header.index(c) for c in df.columns}
+    key_i = header.index(key)
+
+    # Filas de la hoja por Hash (la primera aparición manda; duplicados y huérfanas se borran)
+    sheet_rows, stale = {}, []
+    for r, row in enumerate(values[1:], start=2):
+        h = _sheet_cell(row[key_i]) if key_i < len(row) else ""
+        if h and h not in sheet_rows: sheet_rows[h] = (r, row)
+        else: stale.append(r)
+
+    updates, new_rows, seen = [], [], set()
+    for rec in df.itertuples(index=False, name=None):
+        rec = dict(zip(df.columns, rec))
+        h = _sheet_cell(rec[key])
+        if not h or h in seen: continue
+        seen.add(h)
+        if h not in sheet_rows:
+            if complete is not None:
+                if h not in full_rows:
+                    stats["omitidas"] = stats.get("omitidas", 0) + 1  # Ya no está en local
+                    continue
+                rec = {**rec, **full_rows[h]}
+            new_rows.append([rec.get(c, "") for c in header])
+            continue
+        r, row = sheet_rows[h]
+        changed = {}
+        for c, i in col_pos.items():
+            if partial and c == key: continue
+            current = row[i] if i < len(row) else ""
+            # En parcial no conocemos el valor actual: se escriben las columnas recibidas
+            if partial or _sheet_cell(current) != _sheet_cell(rec[c]): changed[i + 1] = rec[c]
+        for c1, c2 in _row_runs(changed):
+            updates.append({"range": f"{rowcol_to_a1(r, c1)}:{rowcol_to_a1(r, c2)}", "values": [[changed[c] for c in range(c1, c2 + 1)]]})
+            stats["celdas"] += c2 - c1 + 1
+
+    if updates:
+        worksheet.batch_update(updates)
+    if new_rows:
+        worksheet.append_rows(new_rows, table_range="A1")
+        stats["nuevas"] = len(new_rows)
+
+    # Al final y solo si hay datos: borrar lo que ya no está (de abajo arriba, una petición)
+    stale += [r for h, (r, _row) in sheet_rows.items() if h not in seen]
+    if stale and not df.empty and not partial:
+        requests = []
+        for r1, r2 in reversed(_row_runs(stale)):
+            requests.append({"deleteDimension": {"range": {"sheetId": worksheet.id, "dimension": "ROWS", "startIndex": r1 - 1, "endIndex": r2}}})
+        worksheet.spreadsheet.batch_update({"requests": requests})
+        stats["borradas"] = len(stale)
+    return stats
+
+# Inicializar conexión global (una por proceso, compartida entre reruns, sesiones e hilos)
+@st.cache_resource(show_spinner=False)
+def get_gsheets_connection():
+    try:
+        return GSheetsConnection(st.secrets) if "gcp_service_account" in st.secrets else None
+    except:
+        return None
+
+GS_CONN = get_gsheets_connection()
 
 # --- SISTEMA DE ALERTA DE CRISIS ---
 CRISIS_KEYWORDS = ["policía", "policia", "denuncia", "robo", "ladrón", "estafa", "chinches", "plaga", "sangre", "moho", "inhabitable", "amenaza", "agresión", "cucaracha"]
 
-def check_crisis(text):
-    text_lower = text.lower()
-    for kw in CRISIS_KEYWORDS:
-        if kw in text_lower:
-            return True
-    return False
+# Nota de Booking en el texto: "Puntuación: 6,5", "⭐ 8.0 | ..." o entera antes de " |" ("⭐ 10 | ...").
+# Siempre tras su prefijo: un número suelto ("Habitación 2 | ...") no es la nota
+BOOKING_SCORE_RE = r"(?:⭐|Puntuación:)\s*(\d+[.,]\d+|\d+(?= \|))"
 
-def is_review_negative(row):
+def score_negativity(df, category=None):
     """
-    Analiza si una reseña es negativa basándose en el texto y la plataforma.
-    Devuelve: (bool_es_negativa, str_nota_visual)
+    ¿Es negativa cada reseña? Todo el histórico de una vez: añade Score (nota de la reseña),
+    IsNegative y NotaUI. La nota es la Rating estructurada de la reseña (JSON / tarjetas) y,
+    si falta, la de su texto (str.extract); solo las filas sin nota de su plataforma pasan
+    por las palabras clave (category si ya se ha calculado, si no detect_category).
     """
-    text = row.get("Text", "")
-    plat = row.get("Platform", "")
-    
-    # Sanitize
-    if not isinstance(text, str):
-        text = str(text) if pd.notna(text) else ""
-        
-    # 1. Booking (Busca patrón "Puntuación: 6,5")
-    match_bk = re.search(r"[⭐|Puntuación:]\s*(\d+[.,]\d+)", text)
-    if match_bk:
-        try: 
-            score = float(match_bk.group(1).replace(",", "."))
-            if plat == "Booking":
-                return (score < 7.5, f"{score:.1f}")
-        except: pass
-    
-    # 2. Airbnb (Busca patrón "Valoración: 3 estrellas")
-    match_ab = re.search(r"Valoración:\s*(\d+)\s*estrella", text, re.IGNORECASE)
-    if match_ab:
-        try: 
-            stars = int(match_ab.group(1))
-            if plat == "Airbnb":
-                    return (stars <= 3, f"{stars} ⭐")
-        except: pass
-        
-    # 3. Fallback IA (Categorías críticas detectadas por keywords)
-    cat = detect_category(text)
-    if cat not in ["General", "Otros"]:
-        # Si tiene categoría específica (Limpieza, Ruido, etc) asumimos que puede ser negativa o worth checking
-        return (True, "IA Detect")
-        
-    return (False, "-")
+    df = df.copy()
+    if df.empty or "Text" not in df.columns:
+        df["Score"], df["IsNegative"], df["NotaUI"] = None, False, "-"
+        return df
+    text = df["Text"].where(df["Text"].notna(), "").astype(str)
+    plat = df["Platform"].astype(object) if "Platform" in df.columns else pd.Series("", index=df.index)
+
+    # 1. Booking ("Puntuación: 6,5") y 2. Airbnb ("Valoración: 3 estrellas"), si no hay Rating
+    rating = pd.to_numeric(df["Rating"], errors="coerce") if "Rating" in df.columns else pd.Series(float("nan"), index=df.index)
+    bk = pd.to_numeric(text.str.extract(BOOKING_SCORE_RE)[0].str.replace(",", "."), errors="coerce")
+    ab = pd.to_numeric(text.str.extract(r"Valoración:\s*(\d+)\s*estrella", flags=re.IGNORECASE)[0], errors="coerce")
+    bk, ab = rating.fillna(bk).astype(float), rating.fillna(ab).astype(float)
+    is_bk = (plat == "Booking") & bk.notna()
+    is_ab = ~is_bk & (plat == "Airbnb") & ab.notna()
+
+    # 3. Fallback IA: categoría específica por palabras clave
+    rest = ~(is_bk | is_ab)
+    category = text[rest].map(detect_category) if category is None else category[rest]
+    flagged = ~category.isin(["General", "Otros"])
+
+    negative = pd.Series(False, index=df.index)
+    negative[is_bk] = bk[is_bk] < 7.5
+    negative[is_ab] = ab[is_ab] <= 3
+    negative[rest] = flagged
+    nota = pd.Series("-", index=df.index, dtype=object)
+    nota[is_bk] = bk[is_bk].map("{:.1f}".format)
+    nota[is_ab] = ab[is_ab].round().astype(int).astype(str) + " ⭐"
+    nota[rest & negative] = "IA Detect"
+    df["Score"] = bk.where(is_bk, ab.where(is_ab))
+    df["IsNegative"], df["NotaUI"] = negative, nota.astype("category")
+    return df
+
+def enrich_review_rows(df):
+    """
+    Columnas derivadas del texto (DERIVED_COLS), calculadas al entrar en el SQLite con una
+    pasada del motor de palabras clave por reseña. Category solo se rellena si falta (el
+    triaje manual no se pisa); Crisis queda marcada si ya lo estaba o si el texto la delata.
+    """
+    if df.empty or "Text" not in df.columns: return df
+    text = df["Text"].where(df["Text"].notna(), "").astype(str)
+    found = pd.DataFrame(text.map(KEYWORD_ENGINE.classify).tolist(), index=df.index, columns=["Category", "Crisis", "Concepts"])
+    df = score_negativity(df, category=found["Category"])
+    df["Concepts"] = found["Concepts"].map(lambda c: json.dumps(c, ensure_ascii=False))
+    if "Category" not in df.columns:
+        df["Category"] = found["Category"]
+    else:
+        current = df["Category"].astype(object)
+        df["Category"] = current.where(current.notna() & (current != ""), found["Category"])
+    crisis = df["Crisis"].map(_flag) == 1 if "Crisis" in df.columns else False
+    df["Crisis"] = crisis | found["Crisis"].astype(bool)
+    return df
+
+# --- CONFIGURACIÓN DE CONCEPTOS GLOBAL (Para Análisis y Categorización) ---
+CONCEPTS_DICT = {
+    "Limpieza": {
+        "pos": ["limpio", "impecable", "pulcro", "clean", "limpísimo", "brilla"],
+        "neg": ["sucio", "polvo", "mancha", "pelo", "dirty", "olor", "insecto", "cucaracha"]
+    },
+    "Ubicación": {
+        "pos": ["ubicación", "location", "cerca", "vistas", "playa", "céntrico", "situación"],
+        "neg": ["lejos", "far", "mal situado", "barrio"]
+    },
+    "Ruido/Descanso": {
+        "pos": ["silencioso", "tranquilo", "quiet", "paz", "dormir bien"],
+        "neg": ["ruido", "noise", "ralente", "obras", "fiesta", "paredes finas", "tráfico"]
+    },
+    "Cama/Confort": {
+        "pos": ["cómoda", "comfortable", "descanso", "confortable", "almohada bien"],
+        "neg": ["incómoda", "dura", "blanda", "colchón", "almohada", "dolor de espalda", "muelles"]
+    },
+    "Anfitrión/Trato": {
+        "pos": ["amable", "atento", "simpático", "host", "help", "ayuda", "rápido"],
+        "neg": ["borde", "lento", "grosero", "no contesta", "esperar"]
+    },
+    "Instalaciones": {
+        "pos": ["buen wifi", "internet rápido", "ducha buena", "presión", "bien equipado"],
+        "neg": ["wifi", "internet", "agua fría", "no funciona", "roto", "averiado", "cortes", "viejo"]
+    },
+    "Check-in/Out": {
+        "pos": ["fácil", "autónomo", "rápido", "instrucciones claras"],
+        "neg": ["llaves", "esperar", "difícil", "no encontré", "lío"]
+    }
+}
+CATEGORIES_LIST = list(CONCEPTS_DICT.keys()) + ["General", "Otros"]
+
+# --- MOTOR DE PALABRAS CLAVE ---
+# Todas las palabras (conceptos + crisis) en una sola regex, compilada una vez. Cada texto
+# se recorre una vez y el coste ya no crece con el tamaño de los diccionarios. Sin tildes
+# ni mayúsculas en ambos lados: "ubicacion" cuenta como "ubicación".
+def fold_text(text):
+    """Minúsculas y sin tildes (solo para buscar: también quita ñ y emojis)."""
+    return unicodedata.normalize("NFKD", text.lower()).encode("ascii", "ignore").decode("ascii")
+
+def _trie_regex(words):
+    """Regex en forma de árbol de prefijos ("sucio|sangre" -> "s(?:angre|ucio)"): en cada
+    posición el motor sigue una sola rama, no prueba las palabras una a una. Con varias
+    posibles, la más larga (opcionales codiciosos)."""
+    trie = {}
+    for w in words:
+        node = trie
+        for ch in w: node = node.setdefault(ch, {})
+        node[""] = {}
+    def build(node):
+        alts = [re.escape(ch) + build(sub) for ch, sub in sorted(node.items()) if ch]
+        if not alts: return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        return f"(?:{body})?" if "" in node else body
+    return build(trie)
+
+class KeywordEngine:
+    """
+    Búsqueda de subcadenas como `kw in text`, pero de todas a la vez. La regex va en un
+    lookahead para probar cada posición: casa la palabra más larga que empieza ahí, y
+    las que contiene (p.ej. "almohada" en "almohada bien") se añaden desde inside[].
+    Así salen todas las coincidencias, también las solapadas.
+    """
+
+    def __init__(self, concepts, crisis):
+        self.tags = {}  # palabra -> [(tipo, categoría, orden en su lista)]
+        for cat, keywords in concepts.items():
+            for kind in ("neg", "pos"):
+                for i, kw in enumerate(keywords[kind]):
+                    self.tags.setdefault(fold_text(kw), []).append((kind, cat, i))
+        for kw in crisis:
+            self.tags.setdefault(fold_text(kw), []).append(("crisis", None, 0))
+        # Original de cada palabra, para enseñarla como en el diccionario
+        self.words = {fold_text(kw): kw for kws in [crisis] + [k["pos"] + k["neg"] for k in concepts.values()] for kw in kws}
+
+        self.inside = {w: [k for k in self.tags if k in w] for w in self.tags}
+        self.pattern = re.compile(f"(?=({_trie_regex(self.tags)}))")
+
+        # detect_category: primero las negativas (definen el problema), luego las positivas,
+        # por orden del diccionario. Rango de cada palabra -> gana el menor.
+        order = [(cat, kw) for kind in ("neg", "pos") for cat, keywords in concepts.items() for kw in keywords[kind]]
+        # concepts(): en el orden del diccionario (categoría, y dentro pos antes que neg)
+        self.concept_order = {(cat, kind): i for i, (cat, kind) in enumerate((c, k) for c in concepts for k in ("pos", "neg"))}
+        self.rank = {}
+        for i, (cat, kw) in enumerate(order):
+            self.rank.setdefault(fold_text(kw), (i, cat))
+
+    def hits(self, text):
+        """Palabras (sin tildes) que aparecen en text."""
+        if not isinstance(text, str) or not text: return set()
+        found = set()
+        for w in set(self.pattern.findall(fold_text(text))):
+            found.update(self.inside[w])
+        return found
+
+    def classify(self, text):
+        """(categoría, crisis, conceptos) con una sola pasada por el texto."""
+        found = self.hits(text)
+        return self.category(found), self.is_crisis(found), self.concepts(found)
+
+    # Aceptan el texto o sus hits() ya calculados
+    def category(self, text):
+        found = text if isinstance(text, set) else self.hits(text)
+        ranked = [self.rank[w] for w in found if w in self.rank]
+        return min(ranked)[1] if ranked else "General"
+
+    def is_crisis(self, text):
+        found = text if isinstance(text, set) else self.hits(text)
+        return any(t[0] == "crisis" for w in found for t in self.tags[w])
+
+    def concepts(self, text):
+        """[(categoría, 'pos'|'neg', palabra)]: la primera de cada lista que aparece, en el orden de CONCEPTS_DICT."""
+        best = {}
+        for w in (text if isinstance(text, set) else self.hits(text)):
+            for kind, cat, i in self.tags[w]:
+                if kind != "crisis" and ((cat, kind) not in best or i < best[(cat, kind)][0]):
+                    best[(cat, kind)] = (i, self.words[w])
+        return [(cat, kind, best[(cat, kind)][1]) for cat, kind in sorted(best, key=self.concept_order.get)]
+
+KEYWORD_ENGINE = KeywordEngine(CONCEPTS_DICT, CRISIS_KEYWORDS)
+
+def detect_category(text):
+    # Prioridad: menciones negativas primero, ya que definen la categoría del problema
+    return KEYWORD_ENGINE.category(text)
 
 # --- FUNCIONES DE CARGA/GUARDADO ---
 json_file = "alojamientos.json"
 cleaners_file = "cleaners.json"
-csv_file = "historico_reviews.csv"
-reviews_csv = "historico_reviews.csv"
+fingerprints_file = "listing_fingerprints.json"
+csv_file = "historico_reviews.csv"  # Formato antiguo: se importa una vez a reviews.db
 
-@st.cache_data(ttl=60, show_spinner=False)
-def load_reviews_db():
-    """Carga la base de datos de reseñas (CSV local o GSheets)."""
-    # Invalidar caché si se llama explícitamente (trick: Streamlit cache doesn't support manual invalidation easily, 
-    # but relies on TTL. For 'Sync', we might need to clear cache).
+MONTHS_ES = {
+    "enero": 1, "febrero": 2, "marzo": 3, "abril": 4, "mayo": 5, "junio": 6,
+    "julio": 7, "agosto": 8, "septiembre": 9, "octubre": 10, "noviembre": 11, "diciembre": 12
+}
+
+def parse_review_date(txt):
+    """Fecha a partir del texto de la reseña (relativa o absoluta en español), o None."""
+    from datetime import timedelta
+    if not isinstance(txt, str): return None
+    now = datetime.now()
     
-    df = pd.DataFrame()
+    # 1. Relativos (Hace X)
+    m_d = re.search(r"Hace (\d+)\s*días", txt, re.IGNORECASE)
+    if m_d: return now - timedelta(days=int(m_d.group(1)))
+    
+    m_w = re.search(r"Hace (\d+)\s*semana", txt, re.IGNORECASE)
+    if m_w: return now - timedelta(weeks=int(m_w.group(1)))
+    
+    m_m = re.search(r"Hace (\d+)\s*mes", txt, re.IGNORECASE)
+    if m_m: return now - timedelta(days=int(m_m.group(1))*30)
+    
+    # 2. Absolutos (20 de Octubre de 2024)
+    m_long = re.search(r"(\d{1,2}) de (\w+) de (\d{4})", txt, re.IGNORECASE)
+    if m_long:
+        try:
+            month_str = m_long.group(2).lower()
+            if month_str in MONTHS_ES:
+                return datetime(int(m_long.group(3)), MONTHS_ES[month_str], int(m_long.group(1)))
+        except: pass
+        
+    return None
 
-    # 1. Intentar cargar de la Nube (Prioridad)
-    if GS_CONN and GS_CONN.connect():
-        df_cloud = GS_CONN.get_data()
-        if not df_cloud.empty:
-            df = df_cloud
+def review_hash(row):
+    """ID estable de un registro: el Hash que ya tenga o uno nuevo a partir de sus datos."""
+    if isinstance(row.get("Hash"), str) and len(row["Hash"]) > 5: return row["Hash"]
+    import hashlib
+    # Excluimos 'Text' del hash para que si añadimos texto luego, no cambie el ID y podamos deduplicar
+    # Usamos Date + Name + Platform + Rating
+    combo = f"{row.get('Date')}{row.get('Name')}{row.get('Platform')}{row.get('Rating')}"
+    return hashlib.md5(combo.encode('utf-8')).hexdigest()
+
+# --- NORMALIZACIÓN VECTORIZADA ---
+# Versiones por columnas de review_hash / parse_review_date / reescalado de notas: mismo resultado
+# que las de una fila, sin df.apply(axis=1) ni bucles por índice (ver `python app.py bench-normalize`).
+
+def review_hashes(df):
+    """review_hash de todas las filas de golpe (mismos IDs: mismo texto de entrada al md5)."""
+    import hashlib
+    n = len(df)
+    cols = [df[c].tolist() if c in df.columns else [None] * n for c in ("Hash", "Date", "Name", "Platform", "Rating")]
+    return pd.Series([h if isinstance(h, str) and len(h) > 5
+                      else hashlib.md5(f"{d}{nm}{p}{r}".encode("utf-8")).hexdigest()
+                      for h, d, nm, p, r in zip(*cols)], index=df.index, dtype=object)
+
+def review_keys(df, dated=True):
+    """
+    Hash de una reseña individual: Nombre + Plataforma + Texto y, si los datos estructurados
+    (JSON / tarjetas) traen autor (Reviewer), también el autor y el día de la reseña cuando
+    es una fecha ISO. Así dos huéspedes con el mismo "Todo bien" son dos reseñas. No depende
+    de fechas relativas (cambian cada día) ni de la nota del alojamiento: no cambia entre syncs.
+    dated=False: la variante sin día (p.ej. si la fecha venía como "agosto de 2024").
+    """
+    import hashlib
+    n = len(df)
+    reviewers = df["Reviewer"].tolist() if "Reviewer" in df.columns else [None] * n
+    days = [None] * n
+    if dated and "Date" in df.columns:
+        days = pd.to_datetime(df["Date"], format="ISO8601", errors="coerce").dt.strftime("%Y-%m-%d").tolist()
+    keys = []
+    for nm, p, t, who, day in zip(df["Name"].tolist(), df["Platform"].tolist(), df["Text"].tolist(), reviewers, days):
+        extra = f"|{who}|{day if isinstance(day, str) else ''}" if isinstance(who, str) and who else ""
+        keys.append(hashlib.md5(f"{nm}{p}{t}{extra}".encode("utf-8")).hexdigest())
+    return pd.Series(keys, index=df.index, dtype=object)
+
+def parse_review_dates(texts, now=None):
+    """parse_review_date sobre una columna: Series datetime (NaT si el texto no trae fecha)."""
+    texts = texts.where(texts.map(lambda t: isinstance(t, str)), "").astype(str)
+    now = pd.Timestamp(now or datetime.now())
+    out = pd.Series(pd.NaT, index=texts.index, dtype="datetime64[us]")
+    # 1. Relativos (Hace X), con la misma prioridad que parse_review_date: días > semanas > meses
+    for pattern, days in ((r"Hace (\d+)\s*días", 1), (r"Hace (\d+)\s*semana", 7), (r"Hace (\d+)\s*mes", 30)):
+        n = pd.to_numeric(texts.str.extract(pattern, flags=re.IGNORECASE)[0], errors="coerce")
+        out = out.fillna(now - pd.to_timedelta(n * days, unit="D"))
+    # 2. Absolutos (20 de Octubre de 2024); fechas imposibles (31 de febrero) -> NaT
+    m = texts.str.extract(r"(\d{1,2}) de (\w+) de (\d{4})", flags=re.IGNORECASE)
+    absolute = pd.to_datetime(pd.DataFrame({"year": pd.to_numeric(m[2], errors="coerce"),
+                                            "month": m[1].str.lower().map(MONTHS_ES),
+                                            "day": pd.to_numeric(m[0], errors="coerce")}), errors="coerce")
+    return out.fillna(absolute)
+
+def rescale_ratings(ratings, rescue=False):
+    """
+    Escala de notas en una sola pasada: 456 -> 4.56 (Airbnb x100), 85 -> 8.5 (Booking x10).
+    rescue: además deshace el x0.1 del reparador antiguo (0.55 -> 5.5); solo al importar, no es idempotente.
+    """
+    r = pd.to_numeric(ratings, errors="coerce")
+    scaled = r.where(~(r > 100), r / 100.0)
+    scaled = scaled.where(~((scaled > 10) & (scaled <= 100)), scaled / 10.0)
+    if rescue: scaled = scaled.where(~((scaled < 1.1) & (scaled > 0.01)), scaled * 10)
+    return scaled
+
+def _synthetic_history(rows, seed=0):
+    """Histórico sintético con los casos que repara la ingesta (escalas mezcladas, sin fecha, sin Hash)."""
+    rnd = random.Random(seed)
+    months = list(MONTHS_ES)
+    texts = [lambda: f"Hace {rnd.randint(1, 20)} días", lambda: f"Hace {rnd.randint(1, 8)} semanas",
+             lambda: f"Hace {rnd.randint(1, 11)} meses", lambda: f"{rnd.randint(1, 31)} de {rnd.choice(months)} de {rnd.randint(2019, 2025)}",
+             lambda: "Todo perfecto, muy limpio", lambda: None]
+    data = []
+    for i in range(rows):
+        platform = rnd.choice(["Airbnb", "Booking"])
+        base = rnd.uniform(3.5, 5.0) if platform == "Airbnb" else rnd.uniform(6.0, 10.0)
+        rating = round(base * rnd.choice([1, 1, 10, 100, 0.1]), 2)
+        dated = rnd.random() < 0.6
+        data.append({"Date": f"2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}" if dated else None,
+                     "Platform": platform, "Name": f"Piso {i % 250}", "Rating": rating,
+                     "Text": rnd.choice(texts)(), "Hash": None if rnd.random() < 0.5 else f"h{i:08d}"})
+    return pd.DataFrame(data)
+
+def bench_normalize(rows=100_000):
+    """Compara la normalización fila a fila (review_hash / parse_review_date) con la vectorizada."""
+    df = _synthetic_history(rows)
+    now = datetime.now()
+
+    t0 = time.perf_counter()
+    legacy = df.copy()
+    legacy["Date"] = pd.to_datetime(legacy["Date"], errors="coerce")
+    legacy["Rating"] = pd.to_numeric(legacy["Rating"], errors="coerce")
+    m = legacy["Rating"] > 100
+    legacy.loc[m, "Rating"] = legacy.loc[m, "Rating"] / 100.0
+    m = (legacy["Rating"] > 10) & (legacy["Rating"] <= 100)
+    legacy.loc[m, "Rating"] = legacy.loc[m, "Rating"] / 10.0
+    m = (legacy["Rating"] < 1.1) & (legacy["Rating"] > 0.01)
+    legacy.loc[m, "Rating"] = legacy.loc[m, "Rating"] * 10
+    legacy["Hash"] = legacy.apply(review_hash, axis=1)
+    for idx in legacy[legacy["Date"].isnull()].index:
+        new_date = parse_review_date(legacy.at[idx, "Text"])
+        if new_date: legacy.at[idx, "Date"] = new_date
+    t_legacy = time.perf_counter() - t0
 
-    # 2. Fallback: CSV Local (si Nube falló o está vacía)
-    if df.empty and os.path.exists(csv_file):
-        df = pd.read_csv(csv_file)
+    t0 = time.perf_counter()
+    fast = df.copy()
+    fast["Date"] = pd.to_datetime(fast["Date"], errors="coerce")
+    fast["Rating"] = rescale_ratings(fast["Rating"], rescue=True)
+    fast["Hash"] = review_hashes(fast)
+    bad = fast["Date"].isnull()
+    fast["Date"] = fast["Date"].fillna(parse_review_dates(fast.loc[bad, "Text"], now=now))
+    t_fast = time.perf_counter() - t0
 
+    # Mismo resultado (parse_review_date toma now() en cada fila: las fechas relativas se comparan
+    # con la duración del bench como margen)
+    drift = pd.Timedelta(seconds=t_legacy + t_fast + 1)
+    same_dates = ((legacy["Date"] - fast["Date"]).abs() <= drift) | (legacy["Date"].isna() & fast["Date"].isna())
+    checks = {"Hash": (legacy["Hash"] == fast["Hash"]).all(),
+              "Rating": ((legacy["Rating"] - fast["Rating"]).abs().fillna(0) < 1e-9).all(),
+              "Date": same_dates.all()}
 
-    # 3. Si sigue vacía, devolver estructura base
+    print(f"Normalización de {rows:,} filas".replace(",", "."))
+    print(f"  fila a fila : {t_legacy:8.2f} s")
+    print(f"  vectorizada : {t_fast:8.2f} s   (x{t_legacy / max(t_fast, 1e-9):.1f})")
+    for col, ok in checks.items():
+        print(f"  {col:<7} {'idéntico' if ok else '❌ DIFIERE'}")
+    return 0 if all(checks.values()) else 1
+
+# --- INSTANTÁNEA COMPARTIDA DEL HISTÓRICO ---
+# Cada escritura en el SQLite sube meta.storage_version en su misma transacción. El
+# histórico se lee una vez por versión y se comparte entre reruns, sesiones y tarjetas:
+# comprobar la versión es una consulta por clave, y nunca se sirve algo anterior a la
+# última escritura (sin TTL ni .clear() manuales).
+# Las páginas reciben vistas sin copia (load_*): solo es seguro con copy-on-write, que es
+# lo único que hay desde pandas 3 (requirements.txt). En pandas 2.x hay que activarlo.
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.options.mode.copy_on_write = True
+
+class ReviewSnapshot:
+    """
+    Último histórico leído (reseñas y notas de ficha) y la storage_version con la que se
+    leyó. No se modifica nunca. Las reseñas traen de disco IsNegative/NotaUI y el resto de
+    DERIVED_COLS (enrich_review_rows): ningún panel vuelve a analizar el texto.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = None
+        self.tables = None  # reviews, status (listing_status), monthly/rating_daily/review_daily
+        self.loads = 0
+
+    @staticmethod
+    def _read():
+        return {"reviews": read_local_reviews(), "status": read_listing_status(), "monthly": read_monthly_ratings(),
+                "rating_daily": read_rating_daily(), "review_daily": read_review_daily()}
+
+    def _load(self):
+        # 1. Almacén local (Prioridad: no depende de la red ni del tamaño de la hoja)
+        version = storage_version()
+        tables = self._read()
+
+        # 2. Local vacío (p.ej. contenedor nuevo en la Nube): hidratar desde GSheets
+        if tables["reviews"].empty and tables["status"].empty and GS_CONN and GS_CONN.connect():
+            df_cloud = pd.concat([GS_CONN.get_data(), GS_CONN.get_data(SNAPSHOTS_SHEET, create=True)], ignore_index=True)
+            if not df_cloud.empty:
+                write_local_history(df_cloud)
+                version = storage_version()
+                tables = self._read()
+        return version, tables
+
+    def get(self, table="reviews"):
+        if self.tables is None or self.version != storage_version():
+            with self._lock:
+                # Otro hilo puede haberla recargado mientras esperábamos
+                if self.tables is None or self.version != storage_version():
+                    # Versión leída antes que los datos: si alguien escribe entre medias, la
+                    # siguiente llamada ve una versión mayor y recarga (nunca al revés)
+                    self.version, self.tables = self._load()
+                    self.loads += 1
+        return self.tables[table]
+
+@st.cache_resource(show_spinner=False)
+def get_review_snapshot():
+    return ReviewSnapshot()
+
+def load_reviews_db():
+    """
+    Base de datos de reseñas (SQLite local; si está vacía, desde GSheets).
+    Devuelve una vista sin copia de la instantánea compartida. Con copy-on-write, lo que
+    el llamador cambie (columnas, .loc, filtros) se copia aparte y la compartida no se toca.
+    """
+    snap = get_review_snapshot()
+    df = snap.get()
+
+    # Si sigue vacía, devolver estructura base
     if df.empty:
-        st.error("⚠️ DATA ERROR: No se han encontrado datos en Nube ni Local. Ve a Configuración y Repara.")
+        if snap.get("status").empty:
+            st.error("⚠️ DATA ERROR: No se han encontrado datos en Nube ni Local. Ve a Configuración y Repara.")
         return pd.DataFrame(columns=["Date", "Platform", "Name", "Text", "Url", "Hash", "Category", "Cleaner", "Rating"])
 
+    # Lo guardado ya está reparado (validate_review_rows + migraciones): lectura tal cual
+    return df.copy(deep=False)
+
+def load_listing_status():
+    """Última y anterior nota de cada ficha (listing_status). Vista como load_reviews_db."""
+    return get_review_snapshot().get("status").copy(deep=False)
+
+def load_monthly_ratings():
+    """Sumas y recuentos de notas por ficha y mes (rating_monthly). Vista como load_reviews_db."""
+    return get_review_snapshot().get("monthly").copy(deep=False)
+
+def load_rating_daily():
+    """Sumas y recuentos de notas por plataforma y día (rating_daily). Vista como load_reviews_db."""
+    return get_review_snapshot().get("rating_daily").copy(deep=False)
+
+def load_review_daily():
+    """Reseñas, negativas y crisis por día, ficha, categoría y limpiadora (review_daily). Vista como load_reviews_db."""
+    return get_review_snapshot().get("review_daily").copy(deep=False)
+
+def normalize_reviews(df):
+    """
+    Repara un histórico de origen externo (GSheets o el CSV antiguo) antes de importarlo.
+    Solo para ingesta: lo que ya está en el SQLite no se vuelve a pasar por aquí
+    (el RESCATE x10 no es idempotente).
+    """
     # --- NORMALIZACIÓN AUTOMÁTICA (AUTO-REPAIR) ---
     # 1. Asegurar Esqueleto (Columnas mínimas)
     for col in ["Platform", "Name", "Text", "Url", "Cleaner", "Category", "Hash", "Rating", "Date"]:
@@ -183,79 +749,19 @@ def load_reviews_db():
             
     # 2. Corregir Tipos de Datos
     df["Date"] = pd.to_datetime(df["Date"], errors='coerce')
-    df["Rating"] = pd.to_numeric(df["Rating"], errors="coerce")
-    
-    # 3. Corregir Escala de Notas (Inteligente)
-    # A) Corregir números enormes (ej: 456 Airbnb -> 4.56)
-    mask_huge = df["Rating"] > 100
-    df.loc[mask_huge, "Rating"] = df.loc[mask_huge, "Rating"] / 100.0
 
-    # B) Corregir dobles dígitos Booking (ej: 85 -> 8.5)
-    mask_double = (df["Rating"] > 10) & (df["Rating"] <= 100)
-    df.loc[mask_double, "Rating"] = df.loc[mask_double, "Rating"] / 10.0
+    # 3. Corregir Escala de Notas (x100 Airbnb, x10 Booking y RESCATE del reparador antiguo:
+    # ninguna nota legítima es menor que 1.1)
+    df["Rating"] = rescale_ratings(df["Rating"], rescue=True)
 
-    # C) RESCATE: Corregir lo que el "Reparador" anterior rompió (ej: 55 se convirtió en 0.55)
-    # Asumimos que ninguna nota legítima es menor que 1.1
-    mask_broken = (df["Rating"] < 1.1) & (df["Rating"] > 0.01)
-    df.loc[mask_broken, "Rating"] = df.loc[mask_broken, "Rating"] * 10
-
-    
     # 4. Generar Hash faltante
     if df["Hash"].isnull().any() or (df["Hash"] == "").any():
-        import hashlib
-        def _gen_h(row):
-            if isinstance(row.get("Hash"), str) and len(row["Hash"]) > 5: return row["Hash"]
-            # Excluimos 'Text' del hash para que si añadimos texto luego, no cambie el ID y podamos deduplicar
-            # Usamos Date + Name + Platform + Rating
-            combo = f"{row.get('Date')}{row.get('Name')}{row.get('Platform')}{row.get('Rating')}"
-            return hashlib.md5(combo.encode('utf-8')).hexdigest()
-        df["Hash"] = df.apply(_gen_h, axis=1)
+        df["Hash"] = review_hashes(df)
     # 5. Reparación de Fechas (Auto-Correction)
-    # Solo si la fecha es inválida o queremos asegurar
-    # (Hacemos un pase rápido por las filas que tengan Texto pero fecha dudosa)
-    from datetime import datetime, timedelta
-    
-    def _parse_relative_date(txt):
-        if not isinstance(txt, str): return None
-        now = datetime.now()
-        
-        # 1. Relativos (Hace X)
-        m_d = re.search(r"Hace (\d+)\s*días", txt, re.IGNORECASE)
-        if m_d: return now - timedelta(days=int(m_d.group(1)))
-        
-        m_w = re.search(r"Hace (\d+)\s*semana", txt, re.IGNORECASE)
-        if m_w: return now - timedelta(weeks=int(m_w.group(1)))
-        
-        m_m = re.search(r"Hace (\d+)\s*mes", txt, re.IGNORECASE)
-        if m_m: return now - timedelta(days=int(m_m.group(1))*30)
-        
-        # 2. Absolutos (20 de Octubre de 2024)
-        m_long = re.search(r"(\d{1,2}) de (\w+) de (\d{4})", txt, re.IGNORECASE)
-        if m_long:
-            try:
-                day = int(m_long.group(1))
-                month_str = m_long.group(2).lower()
-                year = int(m_long.group(3))
-                month_map = {
-                    "enero": 1, "febrero": 2, "marzo": 3, "abril": 4, "mayo": 5, "junio": 6,
-                    "julio": 7, "agosto": 8, "septiembre": 9, "octubre": 10, "noviembre": 11, "diciembre": 12
-                }
-                if month_str in month_map:
-                    return datetime(year, month_map[month_str], day)
-            except: pass
-            
-        return None
-
-    # Aplicar corrección solo si la fecha es NaT o vacía? 
-    # O mejor siempre para Booking/Airbnb relativos recientes?
-    # Por eficiencia, lo haremos solo si Date es NaT
-    mask_bad_date = df["Date"].isnull() | (df["Date"] == "")
+    # Solo si la fecha es NaT: se deduce del texto ("Hace 3 días", "20 de octubre de 2024")
+    mask_bad_date = df["Date"].isnull()
     if mask_bad_date.any():
-        # Iteramos solo las malas
-        for idx in df[mask_bad_date].index:
-            new_date = _parse_relative_date(df.at[idx, "Text"])
-            if new_date:
-                df.at[idx, "Date"] = new_date
+        df["Date"] = df["Date"].fillna(parse_review_dates(df.loc[mask_bad_date, "Text"]))
 
     # --- NORMALIZACIÓN FINAL ---
     # Asegurar tipos finales
@@ -273,21 +779,800 @@ def load_reviews_db():
 
     return df
 
-def save_reviews_db(df):
-    """Guarda la base de datos (CSV local y GSheets si está conectado)."""
-    # 1. Guardar en Nube (Si hay conexión)
-    if GS_CONN and GS_CONN.connect():
-        try:
-            # Convertir fechas a string para JSON/Sheets
-            df_cloud = df.copy()
-            if "Date" in df_cloud.columns:
-                df_cloud["Date"] = df_cloud["Date"].dt.strftime('%Y-%m-%d %H:%M:%S')
-            GS_CONN.save_data(df_cloud)
-        except Exception as e:
-            print(f"Error saving to cloud: {e}")
-        
-    # 2. Guardar Local siempre (Backup)
-    df.to_csv(reviews_csv, index=False)
+def split_history(df, repair=True):
+    """
+    Histórico en el formato antiguo (una fila por ficha y sync con todas sus reseñas unidas
+    por " || ") -> (notas de ficha, reseñas individuales). Las filas que ya son una reseña
+    (Hash == review_keys, con o sin día) pasan tal cual.
+    repair: normalizar antes las filas antiguas (ingesta); no para datos ya guardados.
+    """
+    df = df.copy()
+    for col in ["Hash", "Name", "Platform", "Text", "Date", "Rating"]:
+        if col not in df.columns: df[col] = None
+    hashes = df["Hash"].astype(object)
+    is_item = (hashes == review_keys(df)) | (hashes == review_keys(df, dated=False))
+    items, legacy = df[is_item], df[~is_item]
+    if legacy.empty: return legacy[["Hash", "Date", "Platform", "Name", "Rating"]], items
+    legacy = normalize_reviews(legacy) if repair else legacy.assign(Date=pd.to_datetime(legacy["Date"], errors="coerce"))
+
+    snapshots = legacy[pd.to_numeric(legacy["Rating"], errors="coerce").notna()]
+    snapshots = snapshots[[c for c in ["Hash", "Date", "Platform", "Name", "URL", "Url", "Rating"] if c in snapshots.columns]]
+
+    # Cada texto unido, una reseña: fecha de la primera sync en que apareció y la última
+    # clasificación que se le hizo (Categoría, Limpieza, banderas) en cualquiera de sus filas
+    texts = legacy["Text"].where(legacy["Text"].map(lambda t: isinstance(t, str)), "").astype(object).str.split(" || ", regex=False)
+    exploded = legacy.drop(columns=["Hash", "Rating"]).assign(Text=texts).explode("Text")
+    exploded["Text"] = exploded["Text"].fillna("").str.strip()
+    exploded = exploded[exploded["Text"] != ""].sort_values("Date", kind="stable")
+    if exploded.empty: return snapshots, items
+    exploded["Hash"] = review_keys(exploded)
+    triage = [c for c in ["Category", "Cleaner"] + REVIEW_FLAG_COLS if c in exploded.columns]
+    # "General"/False son el relleno de normalize_reviews y del CSV, no un triaje: sin
+    # valor, para que enrich_review_rows los clasifique
+    if "Category" in exploded.columns:
+        exploded["Category"] = exploded["Category"].where(~exploded["Category"].isin(["General", ""]))
+    if "Crisis" in exploded.columns:
+        exploded["Crisis"] = exploded["Crisis"].where(exploded["Crisis"].map(_flag) == 1)
+    first = exploded.drop_duplicates(subset=["Hash"], keep="first")[["Hash", "Date", "Platform", "Name", "Text"]]
+    if triage: first = first.join(exploded.groupby("Hash")[triage].last(), on="Hash")
+    return snapshots, pd.concat([items, first], ignore_index=True).drop_duplicates(subset=["Hash"], keep="first")
+
+def update_review(hash_id, **changes):
+    """Cambia campos de una reseña (p.ej. Category, Cleaner, Crisis): local al instante, Nube en diferido."""
+    queue_review_rows(pd.DataFrame([{"Hash": hash_id, **changes}]))
+
+# --- ALMACÉN LOCAL (SQLite) ---
+# Sustituye a historico_reviews.csv: columnas tipadas, índices para las consultas
+# habituales y escrituras por fila en transacción. La primera vez importa el CSV.
+reviews_db_file = "reviews.db"
+REVIEW_SCHEMA = {
+    "Hash": "TEXT PRIMARY KEY",
+    "Date": "TEXT",       # 'YYYY-MM-DD HH:MM:SS' (ordena bien como texto)
+    "Platform": "TEXT",
+    "Name": "TEXT",
+    "URL": "TEXT",        # SQLite no distingue mayúsculas: la antigua 'Url' se guarda aquí
+    "Rating": "REAL",
+    "Text": "TEXT",
+    "Reviewer": "TEXT",   # Autor, si lo dieron los datos estructurados (parte del Hash)
+    "Category": "TEXT",
+    "Cleaner": "TEXT",
+    "New": "INTEGER",     # 0/1
+    "Crisis": "INTEGER",  # 0/1
+    # Derivadas del texto al guardar (enrich_review_rows); las páginas las leen tal cual
+    "Score": "REAL",      # Nota de la reseña: Rating o, si falta, su texto (Booking 0-10, Airbnb estrellas)
+    "IsNegative": "INTEGER",  # 0/1
+    "NotaUI": "TEXT",
+    "Concepts": "TEXT",   # JSON [[categoría, "pos"|"neg", palabra], ...]
+}
+REVIEW_FLAG_COLS = ["New", "Crisis", "IsNegative"]
+DERIVED_COLS = ["Score", "IsNegative", "NotaUI", "Concepts"]
+# Tipos en memoria del histórico (ver apply_review_dtypes). Pocas fichas, plataformas,
+# categorías y limpiadoras -> category; banderas con hueco -> boolean; notas en float32
+# (sobra precisión para 1 decimal); textos y claves en cadenas de Arrow.
+REVIEW_DTYPES = {
+    "Platform": "category",
+    "Name": "category",
+    "URL": "category",
+    "Category": "category",
+    "Cleaner": "category",
+    "New": "boolean",
+    "Crisis": "boolean",
+    "Rating": "float32",
+    "Text": pd.StringDtype("pyarrow", na_value=float("nan")),
+    "Reviewer": pd.StringDtype("pyarrow", na_value=float("nan")),
+    "Hash": pd.StringDtype("pyarrow", na_value=float("nan")),
+    "Score": "float32",
+    "IsNegative": "boolean",
+    "NotaUI": "category",
+    "Concepts": pd.StringDtype("pyarrow", na_value=float("nan")),
+}
+REVIEW_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_reviews_listing ON reviews (Name, Platform, Date)",
+    "CREATE INDEX IF NOT EXISTS ix_reviews_new ON reviews (New) WHERE New = 1",
+    "CREATE INDEX IF NOT EXISTS ix_reviews_crisis ON reviews (Crisis) WHERE Crisis = 1",
+]
+
+# Nota de cada ficha en cada sync (una fila compacta, sin texto). Las reseñas van aparte,
+# una fila por reseña en reviews (Hash = review_keys) y solo la primera vez que se ven.
+SNAPSHOT_SCHEMA = {
+    "Hash": "TEXT PRIMARY KEY",  # review_hashes: Fecha + Nombre + Plataforma + Nota
+    "Date": "TEXT",
+    "Platform": "TEXT",
+    "Name": "TEXT",
+    "URL": "TEXT",
+    "Rating": "REAL",
+}
+SNAPSHOT_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_snapshots_listing ON rating_snapshots (Name, Platform, Date)",
+]
+SNAPSHOTS_SHEET = "Snapshots"  # Pestaña de GSheets con rating_snapshots
+
+# Resúmenes de notas antiguas (ver compact_rating_snapshots). Rating/Date son la última nota
+# del periodo y su fecha, así que el delta "respecto a la vez anterior" sigue siendo exacto.
+ROLLUP_SCHEMA = {
+    "Name": "TEXT",
+    "Platform": "TEXT",
+    "Period": "TEXT",      # 'day' | 'month'
+    "Start": "TEXT",       # 'YYYY-MM-DD' (día o día 1 del mes)
+    "Count": "INTEGER",    # Nº de notas resumidas
+    "RatingSum": "REAL",   # Para medias ponderadas (Sum / Count)
+    "RatingMin": "REAL",
+    "RatingMax": "REAL",
+    "Rating": "REAL",      # Última nota del periodo
+    "Date": "TEXT",        # Fecha de esa última nota
+}
+
+# Agregados de notas mantenidos al escribir (ver AGREGADOS DE NOTAS): el Dashboard los lee
+# tal cual, sin ordenar ni agrupar el histórico.
+STATUS_SCHEMA = {          # listing_status: una fila por (Name, Platform)
+    "Name": "TEXT",
+    "Platform": "TEXT",
+    "Rating": "REAL",      # Última nota
+    "Date": "TEXT",        # Su fecha
+    "PrevRating": "REAL",  # La nota anterior (delta "respecto a la vez anterior")
+    "PrevDate": "TEXT",
+}
+MONTHLY_SCHEMA = {         # rating_monthly: notas sueltas + resúmenes, por mes
+    "Name": "TEXT",
+    "Platform": "TEXT",
+    "Month": "TEXT",       # 'YYYY-MM'
+    "Count": "INTEGER",
+    "RatingSum": "REAL",
+}
+RATING_DAILY_SCHEMA = {    # rating_daily: lo mismo por plataforma y día (KPIs del periodo)
+    "Platform": "TEXT",
+    "Day": "TEXT",         # 'YYYY-MM-DD' (un resumen mensual cae en su día 1)
+    "Count": "INTEGER",
+    "RatingSum": "REAL",
+}
+REVIEW_DAILY_SCHEMA = {    # review_daily: reseñas por día, ficha, plataforma, categoría y limpiadora
+    "Day": "TEXT",
+    "Name": "TEXT",        # Claves sin NULL ('' = sin valor) para que el upsert las encuentre
+    "Platform": "TEXT",
+    "Category": "TEXT",
+    "Cleaner": "TEXT",
+    "Count": "INTEGER",
+    "Negatives": "INTEGER",  # IsNegative
+    "Crisis": "INTEGER",     # Crisis sin resolver
+    "RatingCount": "INTEGER",
+    "RatingSum": "REAL",
+}
+
+@contextlib.contextmanager
+def local_db():
+    """Conexión al SQLite local. El bloque es una transacción (commit al salir, rollback si falla)."""
+    conn = sqlite3.connect(reviews_db_file, timeout=30)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+# --- VERSIÓN DEL ESQUEMA Y MIGRACIONES ---
+# meta.schema_version dice en qué forma están los datos guardados. Cada migración se
+# ejecuta una sola vez, en su propia transacción junto con el nuevo número de versión, y
+# deja el resultado en disco: cargar ya no repara nada.
+SCHEMA_VERSION = 9
+
+def _migrate_v1(conn):
+    """v1: datos reparados en disco (escala de notas, fechas deducidas del texto, sin duplicados)."""
+    df = pd.read_sql_query("SELECT rowid AS rid, Date, Name, Platform, Rating, Text FROM reviews ORDER BY rowid", conn)
+    # Solo los reescalados idempotentes (>100 y >10); el RESCATE x10 ya se aplicó al importar
+    fixed = rescale_ratings(df["Rating"])
+    changed = fixed.notna() & (fixed != df["Rating"])
+    conn.executemany("UPDATE reviews SET Rating = ? WHERE rowid = ?", zip(fixed[changed].tolist(), df.loc[changed, "rid"].tolist()))
+
+    bad = df["Date"].isna() | (df["Date"] == "")
+    found = parse_review_dates(df.loc[bad, "Text"]).dropna().dt.strftime("%Y-%m-%d %H:%M:%S")
+    df.loc[found.index, "Date"] = found
+    conn.executemany("UPDATE reviews SET Date = ? WHERE rowid = ?", zip(found.tolist(), df.loc[found.index, "rid"].tolist()))
+
+    # Misma reseña (Fecha, Nombre, Plataforma): se queda la última
+    dup = df.duplicated(subset=["Date", "Name", "Platform"], keep="last")
+    conn.executemany("DELETE FROM reviews WHERE rowid = ?", [(int(r),) for r in df.loc[dup, "rid"]])
+    print(f"🗄️ Migración v1: {int(changed.sum())} notas reescaladas, {int(dup.sum())} duplicados eliminados")
+
+def _migrate_v2(conn):
+    """v2: las filas por ficha y sync se separan en rating_snapshots y una fila por reseña."""
+    df = pd.read_sql_query("SELECT * FROM reviews ORDER BY rowid", conn)
+    # Ya reparadas en v1: no se vuelven a normalizar (el RESCATE x10 no es idempotente)
+    snapshots, items = split_history(df, repair=False)
+    _write_snapshots(snapshots, conn=conn)
+    _write_reviews(items, replace=True, conn=conn)
+    print(f"🗄️ Migración v2: {len(df)} filas -> {len(snapshots)} notas de ficha + {len(items)} reseñas")
+
+def _migrate_v3(conn):
+    """v3: columnas derivadas del texto guardadas en disco (ver enrich_review_rows)."""
+    existing = {row[1].lower() for row in conn.execute("PRAGMA table_info(reviews)")}
+    for c in DERIVED_COLS:
+        if c.lower() not in existing: conn.execute(f'ALTER TABLE reviews ADD COLUMN "{c}" {REVIEW_SCHEMA[c]}')
+    print(f"🗄️ Migración v3: {backfill_derived_columns(conn)} reseñas enriquecidas")
+
+def _migrate_v4(conn):
+    """v4: listing_status y rating_monthly calculadas desde las notas ya guardadas."""
+    rebuild_rating_aggregates(conn)
+    print("🗄️ Migración v4: agregados de notas (última nota por ficha y meses) creados")
+
+def _migrate_v5(conn):
+    """v5: agregados diarios (rating_daily, review_daily) y triggers de v4 rehechos con ellos."""
+    for name, sql in AGGREGATE_TRIGGERS.items():
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        conn.execute(sql)
+    rebuild_rating_aggregates(conn)
+    print("🗄️ Migración v5: agregados diarios de notas y reseñas creados")
+
+def _migrate_v6(conn):
+    """v6: Score desde la Rating de cada reseña (antes solo del texto)."""
+    print(f"🗄️ Migración v6: {backfill_derived_columns(conn)} reseñas puntuadas de nuevo")
+
+def _migrate_v7(conn):
+    """v7: pending_edits apunta a qué pestaña va cada cambio (también notas de ficha)."""
+    existing = {row[1].lower() for row in conn.execute("PRAGMA table_info(pending_edits)")}
+    if "sheet" not in existing: conn.execute("ALTER TABLE pending_edits ADD COLUMN Sheet TEXT DEFAULT 'Reviews'")
+
+def _migrate_v8(conn):
+    """v8: columna Reviewer (autor de la reseña; entra en el Hash de las nuevas)."""
+    existing = {row[1].lower() for row in conn.execute("PRAGMA table_info(reviews)")}
+    if "reviewer" not in existing: conn.execute('ALTER TABLE reviews ADD COLUMN "Reviewer" TEXT')
+
+def _migrate_v9(conn):
+    """v9: la nota del texto de Booking solo tras su prefijo (BOOKING_SCORE_RE)."""
+    print(f"🗄️ Migración v9: {backfill_derived_columns(conn)} reseñas puntuadas de nuevo")
+
+REVIEW_MIGRATIONS = {1: _migrate_v1, 2: _migrate_v2, 3: _migrate_v3, 4: _migrate_v4, 5: _migrate_v5, 6: _migrate_v6, 7: _migrate_v7, 8: _migrate_v8,
+                     9: _migrate_v9}
+
+def _schema_version(conn):
+    row = conn.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+    return int(row[0]) if row else 0
+
+def _set_schema_version(conn, version):
+    conn.execute("INSERT OR REPLACE INTO meta VALUES ('schema_version', ?)", (str(version),))
+
+def _bump_storage_version(conn):
+    """Marca que reviews ha cambiado; llamar dentro de la transacción que escribe."""
+    conn.execute("INSERT INTO meta VALUES ('storage_version', '1') "
+                 "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+
+def storage_version():
+    """Contador de escrituras en reviews (ver ReviewSnapshot)."""
+    init_local_store()
+    with local_db() as conn:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'storage_version'").fetchone()
+    return int(row[0]) if row else 0
+
+@st.cache_resource(show_spinner=False)
+def init_local_store():
+    """Crea tablas e índices, importa una sola vez historico_reviews.csv y aplica las migraciones pendientes."""
+    with local_db() as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        cols = ", ".join(f'"{c}" {t}' for c, t in REVIEW_SCHEMA.items())
+        conn.execute(f"CREATE TABLE IF NOT EXISTS reviews ({cols})")
+        snapshot_cols = ", ".join(f'"{c}" {t}' for c, t in SNAPSHOT_SCHEMA.items())
+        conn.execute(f"CREATE TABLE IF NOT EXISTS rating_snapshots ({snapshot_cols})")
+        rollup_cols = ", ".join(f'"{c}" {t}' for c, t in ROLLUP_SCHEMA.items())
+        conn.execute(f"CREATE TABLE IF NOT EXISTS rating_rollups ({rollup_cols}, PRIMARY KEY (Name, Platform, Period, Start))")
+        status_cols = ", ".join(f'"{c}" {t}' for c, t in STATUS_SCHEMA.items())
+        conn.execute(f"CREATE TABLE IF NOT EXISTS listing_status ({status_cols}, PRIMARY KEY (Name, Platform))")
+        monthly_cols = ", ".join(f'"{c}" {t}' for c, t in MONTHLY_SCHEMA.items())
+        conn.execute(f"CREATE TABLE IF NOT EXISTS rating_monthly ({monthly_cols}, PRIMARY KEY (Name, Platform, Month))")
+        daily_cols = ", ".join(f'"{c}" {t}' for c, t in RATING_DAILY_SCHEMA.items())
+        conn.execute(f"CREATE TABLE IF NOT EXISTS rating_daily ({daily_cols}, PRIMARY KEY (Platform, Day))")
+        review_daily_cols = ", ".join(f'"{c}" {t}' for c, t in REVIEW_DAILY_SCHEMA.items())
+        conn.execute(f"CREATE TABLE IF NOT EXISTS review_daily ({review_daily_cols}, PRIMARY KEY (Day, Name, Platform, Category, Cleaner))")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS pending_edits (id INTEGER PRIMARY KEY AUTOINCREMENT, Hash TEXT, changes TEXT, created TEXT, Sheet TEXT DEFAULT 'Reviews')")
+        for sql in REVIEW_INDEXES + SNAPSHOT_INDEXES: conn.execute(sql)
+        migrated = conn.execute("SELECT value FROM meta WHERE key = 'csv_migrated'").fetchone()
+        empty = conn.execute("SELECT COUNT(*) FROM reviews").fetchone()[0] == 0
+        # BD nueva: todo lo que entre pasa por la validación, ya nace en la última versión
+        if empty and _schema_version(conn) == 0: _set_schema_version(conn, SCHEMA_VERSION)
+
+    for version in sorted(REVIEW_MIGRATIONS):
+        with local_db() as conn:
+            if _schema_version(conn) >= version: continue
+            REVIEW_MIGRATIONS[version](conn)
+            _set_schema_version(conn, version)
+            _bump_storage_version(conn)
+
+    # Triggers de agregados solo sobre el esquema que leen (IsNegative llega en v3): una BD
+    # antigua los recibe de _migrate_v5, después de que las migraciones anteriores reescriban
+    with local_db() as conn:
+        if _schema_version(conn) >= 5:
+            for sql in AGGREGATE_TRIGGERS.values(): conn.execute(sql)
+
+    if not migrated and os.path.exists(csv_file):
+        df_csv = pd.read_csv(csv_file)
+        if empty and not df_csv.empty:
+            _write_history(df_csv)
+        with local_db() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('csv_migrated', ?)", (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),))
+        print(f"🗄️ {csv_file} importado a {reviews_db_file} ({len(df_csv)} filas)")
+    return True
+
+def _flag(value):
+    if value is pd.NA: return None  # Columnas "boolean" (apply_review_dtypes)
+    if isinstance(value, str): value = value.strip().lower()
+    if value in (True, 1, "true", "1"): return 1
+    if value in (False, 0, "false", "0"): return 0
+    return None
+
+def _to_db_frame(df):
+    """DataFrame -> valores de SQLite (fechas a texto, banderas a 0/1, NaN a NULL)."""
+    out = df.copy()
+    if "Url" in out.columns:
+        url = out["Url"].where(out["Url"].notna() & (out["Url"] != ""))
+        out["URL"] = out["URL"].where(out["URL"].notna() & (out["URL"] != ""), url) if "URL" in out.columns else url
+        out = out.drop(columns=["Url"])
+    if "Date" in out.columns:
+        out["Date"] = pd.to_datetime(out["Date"], errors="coerce").dt.strftime("%Y-%m-%d %H:%M:%S")
+    for c in REVIEW_FLAG_COLS:
+        if c in out.columns: out[c] = out[c].map(_flag)
+    # float32 (apply_review_dtypes) no lo admite sqlite3: a float de Python
+    out = out.astype({c: "float64" for c in out.columns if pd.api.types.is_float_dtype(out[c])})
+    out = out.astype(object)
+    return out.where(out.notna(), None)
+
+def validate_review_rows(df):
+    """
+    Validación de ingesta: todo lo que se escribe en el SQLite sale de aquí ya en la forma
+    de SCHEMA_VERSION. Solo toca las columnas presentes (las ediciones traen Hash + campo).
+    Desde v2 cada fila es una reseña y la única clave es el Hash: dos reseñas de la misma
+    ficha pueden compartir fecha.
+    """
+    df = df.copy()
+    if "Hash" not in df.columns:
+        raise ValueError("Las filas a guardar necesitan la columna 'Hash'")
+    if {"Date", "Name", "Platform"} <= set(df.columns):
+        no_hash = df["Hash"].isna() | (df["Hash"] == "")
+        if no_hash.any(): df.loc[no_hash, "Hash"] = review_hashes(df[no_hash])
+    df = df[df["Hash"].notna() & (df["Hash"] != "")]
+
+    if "Rating" in df.columns:
+        rating = rescale_ratings(df["Rating"])
+        df["Rating"] = rating.where(rating >= 0)
+    if "Date" in df.columns:
+        df["Date"] = pd.to_datetime(df["Date"], errors="coerce")
+        if "Text" in df.columns and df["Date"].isna().any():
+            bad = df["Date"].isna()
+            df["Date"] = df["Date"].fillna(parse_review_dates(df.loc[bad, "Text"]))
+
+    return enrich_review_rows(df.drop_duplicates(subset=["Hash"], keep="last"))
+
+def _upsert_frame(conn, table, out):
+    """Inserta/actualiza por Hash las filas de out (ya en valores de SQLite)."""
+    cols = list(out.columns)
+    names = ", ".join(f'"{c}"' for c in cols)
+    marks = ", ".join("?" for _ in cols)
+    updates = ", ".join(f'"{c}" = excluded."{c}"' for c in cols if c != "Hash") or '"Hash" = excluded."Hash"'
+    conn.executemany(
+        f"INSERT INTO {table} ({names}) VALUES ({marks}) ON CONFLICT(Hash) DO UPDATE SET {updates}",
+        out.itertuples(index=False, name=None),
+    )
+
+def _write_reviews(df, replace=False, pending=None, conn=None, keep=()):
+    """
+    Valida e inserta/actualiza filas por Hash en una transacción. replace: el df es el histórico entero.
+    pending: filas (Hash, changes JSON, created, Sheet) para pending_edits, en la misma transacción.
+    conn: transacción ya abierta (migraciones); si no, se abre una.
+    keep: columnas que no se escriben aunque enrich_review_rows las calcule.
+    """
+    df = validate_review_rows(df)
+    out = _to_db_frame(df.drop(columns=list(keep), errors="ignore"))
+    with (contextlib.nullcontext(conn) if conn else local_db()) as conn:
+        # Columnas que no están en el esquema (p.ej. añadidas en la hoja): se crean sin tipo
+        existing = {row[1].lower() for row in conn.execute("PRAGMA table_info(reviews)")}
+        for c in out.columns:
+            if c.lower() not in existing: conn.execute(f'ALTER TABLE reviews ADD COLUMN "{c}"')
+        if replace: conn.execute("DELETE FROM reviews")
+        _upsert_frame(conn, "reviews", out)
+        if pending: _journal_pending(conn, pending)
+        _bump_storage_version(conn)
+
+def _journal_pending(conn, pending):
+    conn.executemany("INSERT INTO pending_edits (Hash, changes, created, Sheet) VALUES (?, ?, ?, ?)", pending)
+
+def _write_snapshots(df, replace=False, pending=None, conn=None):
+    """
+    Notas de ficha a rating_snapshots (clave Hash; si falta se calcula con review_hashes).
+    replace: el df es el histórico entero (sustituye también a rating_rollups).
+    pending: como en _write_reviews.
+    """
+    df = df.copy()
+    if "Hash" not in df.columns: df["Hash"] = None
+    df["Hash"] = review_hashes(df)
+    df["Rating"] = rescale_ratings(df["Rating"])
+    df = df[df["Rating"].notna()].drop_duplicates(subset=["Hash"], keep="last")
+    out = _to_db_frame(df)
+    out = out[[c for c in SNAPSHOT_SCHEMA if c in out.columns]]
+    with (contextlib.nullcontext(conn) if conn else local_db()) as conn:
+        if replace:
+            # El df trae el histórico entero: los resúmenes de lo compactado ya van dentro
+            conn.execute("DELETE FROM rating_snapshots")
+            conn.execute("DELETE FROM rating_rollups")
+        _upsert_frame(conn, "rating_snapshots", out)
+        # Los triggers solo suman: si se ha vaciado la tabla, fichas que ya no están seguirían ahí
+        if replace: rebuild_rating_aggregates(conn)
+        if pending: _journal_pending(conn, pending)
+        _bump_storage_version(conn)
+
+def apply_review_dtypes(df):
+    """
+    Histórico con los tipos compactos de REVIEW_DTYPES (solo las columnas presentes).
+    Las categorías salen de los propios datos: filtrar o comparar con un valor que no
+    está (p.ej. una limpiadora nueva) da False, no error.
+    """
+    for c in REVIEW_FLAG_COLS:
+        if c in df.columns and df[c].dtype != "boolean":
+            df[c] = df[c].map({1: True, 0: False, True: True, False: False})
+    return df.astype({c: t for c, t in REVIEW_DTYPES.items() if c in df.columns})
+
+def frame_memory_report(df):
+    """Memoria por columna (MB): tipos actuales frente a todo como object (la carga antigua)."""
+    now = df.memory_usage(deep=True, index=False)
+    before = df.astype(object).memory_usage(deep=True, index=False)
+    report = pd.DataFrame({"Tipo": df.dtypes.astype(str), "MB antes": before / 2**20, "MB ahora": now / 2**20})
+    report.loc["Total"] = ["", report["MB antes"].sum(), report["MB ahora"].sum()]
+    return report.round(2)
+
+def read_local_reviews():
+    init_local_store()
+    with local_db() as conn:
+        df = pd.read_sql_query("SELECT * FROM reviews ORDER BY rowid", conn)
+    df["Date"] = pd.to_datetime(df["Date"], format="%Y-%m-%d %H:%M:%S", errors="coerce")
+    return apply_review_dtypes(df)
+
+def read_local_snapshots():
+    init_local_store()
+    with local_db() as conn:
+        df = pd.read_sql_query("SELECT * FROM rating_snapshots ORDER BY Date", conn)
+    df["Date"] = pd.to_datetime(df["Date"], format="%Y-%m-%d %H:%M:%S", errors="coerce")
+    return df
+
+def read_listing_status():
+    init_local_store()
+    with local_db() as conn:
+        df = pd.read_sql_query("SELECT * FROM listing_status", conn)
+    for c in ("Date", "PrevDate"):
+        df[c] = pd.to_datetime(df[c], format="%Y-%m-%d %H:%M:%S", errors="coerce")
+    return df
+
+def read_monthly_ratings():
+    init_local_store()
+    with local_db() as conn:
+        df = pd.read_sql_query("SELECT * FROM rating_monthly WHERE Count > 0 ORDER BY Month", conn)
+    df["Month"] = pd.to_datetime(df["Month"], format="%Y-%m", errors="coerce")
+    return df
+
+def read_rating_daily():
+    init_local_store()
+    with local_db() as conn:
+        df = pd.read_sql_query("SELECT * FROM rating_daily WHERE Count > 0 ORDER BY Day", conn)
+    df["Day"] = pd.to_datetime(df["Day"], format="%Y-%m-%d", errors="coerce")
+    return df
+
+def read_review_daily():
+    init_local_store()
+    with local_db() as conn:
+        df = pd.read_sql_query("SELECT * FROM review_daily WHERE Count > 0 ORDER BY Day", conn)
+    df["Day"] = pd.to_datetime(df["Day"], format="%Y-%m-%d", errors="coerce")
+    for c in ("Name", "Platform", "Category", "Cleaner"):
+        df[c] = df[c].replace("", None)
+    return df
+
+def existing_review_hashes(hashes):
+    """Los Hash de la lista que ya están en reviews."""
+    init_local_store()
+    hashes, found = list(hashes), set()
+    with local_db() as conn:
+        for i in range(0, len(hashes), 500):  # Límite de parámetros de SQLite
+            chunk = hashes[i:i + 500]
+            marks = ", ".join("?" for _ in chunk)
+            found.update(r[0] for r in conn.execute(f"SELECT Hash FROM reviews WHERE Hash IN ({marks})", chunk))
+    return found
+
+def backfill_derived_columns(conn=None):
+    """
+    Recalcula DERIVED_COLS de todo el histórico (p.ej. tras cambiar CONCEPTS_DICT o la
+    lectura de notas) y rellena Category/Crisis vacías. Las Category/Crisis ya guardadas no
+    se reclasifican: la automática no se distingue de la del triaje manual (ni un False de un
+    "Marcar como Resuelto"), así que un cambio en CRISIS_KEYWORDS solo afecta a las reseñas
+    nuevas. Devuelve las reseñas tocadas.
+    """
+    if conn is None: init_local_store()
+    with (contextlib.nullcontext(conn) if conn else local_db()) as conn:
+        df = pd.read_sql_query("SELECT Hash, Platform, Rating, Text, Category, Crisis FROM reviews", conn)
+        unset = df["Crisis"].isna()
+        if unset.any(): _write_reviews(df[unset], conn=conn)
+        if not unset.all(): _write_reviews(df[~unset], conn=conn, keep=["Crisis"])
+    return len(df)
+
+def _write_history(df):
+    snapshots, items = split_history(df)
+    with local_db() as conn:
+        _write_snapshots(snapshots, replace=True, conn=conn)
+        _write_reviews(items, replace=True, conn=conn)
+
+def write_local_history(df):
+    """Histórico de origen externo (CSV antiguo, GSheets) -> reviews + rating_snapshots (reemplaza ambas)."""
+    init_local_store()
+    _write_history(df)
+
+# --- RETENCIÓN DE NOTAS (resúmenes diarios y mensuales) ---
+# Cada sync añade una nota por ficha. Las de los últimos SNAPSHOT_RAW_DAYS se guardan
+# sueltas; las anteriores se resumen por día y, pasado SNAPSHOT_DAILY_DAYS, por mes
+# (rating_rollups) y rebuild_rating_aggregates los suma a los agregados, así que el
+# histórico crece por periodo y no con cada sync. La pestaña Snapshots de GSheets conserva el detalle.
+SNAPSHOT_RAW_DAYS = 30
+SNAPSHOT_DAILY_DAYS = 365
+# Las dos últimas notas de cada ficha no se resumen nunca: son la última y la anterior de
+# listing_status, y así rebuild_rating_aggregates da el mismo delta que los triggers
+_KEEP_LATEST_RAW = (
+    "Hash NOT IN (SELECT Hash FROM (SELECT Hash, ROW_NUMBER() OVER "
+    "(PARTITION BY Name, Platform ORDER BY Date DESC) AS n FROM rating_snapshots "
+    "WHERE Rating IS NOT NULL AND Date IS NOT NULL) WHERE n <= 2)"
+)
+
+_ROLLUP_UPSERT = (
+    "INSERT INTO rating_rollups (Name, Platform, Period, Start, Count, RatingSum, RatingMin, RatingMax, Rating, Date) {select} "
+    "ON CONFLICT(Name, Platform, Period, Start) DO UPDATE SET "
+    "Count = Count + excluded.Count, RatingSum = RatingSum + excluded.RatingSum, "
+    "RatingMin = MIN(RatingMin, excluded.RatingMin), RatingMax = MAX(RatingMax, excluded.RatingMax), "
+    "Rating = CASE WHEN excluded.Date >= Date THEN excluded.Rating ELSE Rating END, "
+    "Date = MAX(Date, excluded.Date)"
+)
+
+def compact_rating_snapshots(now=None):
+    """
+    Resume y borra, en una transacción, las notas sueltas anteriores a SNAPSHOT_RAW_DAYS (por
+    día) y los días anteriores a SNAPSHOT_DAILY_DAYS (por mes). Los cortes caen en inicio de
+    día / de mes, así que nunca se resume un periodo a medias, salvo las dos últimas notas de
+    cada ficha (_KEEP_LATEST_RAW): se suman a su día cuando lleguen otras más recientes.
+    Devuelve lo que ha movido.
+    """
+    init_local_store()
+    now = now or datetime.now()
+    raw_cutoff = (pd.Timestamp(now).normalize() - pd.Timedelta(days=SNAPSHOT_RAW_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    daily_cutoff = (pd.Timestamp(now) - pd.Timedelta(days=SNAPSHOT_DAILY_DAYS)).strftime("%Y-%m-01")
+    with local_db() as conn:
+        # Last: la nota de la fila más reciente de cada periodo (igual en todo el grupo)
+        conn.execute(_ROLLUP_UPSERT.format(select=(
+            "SELECT Name, Platform, 'day', Day, COUNT(*), SUM(Rating), MIN(Rating), MAX(Rating), MAX(Last), MAX(Date) FROM ("
+            "  SELECT *, substr(Date, 1, 10) AS Day, FIRST_VALUE(Rating) OVER "
+            "  (PARTITION BY Name, Platform, substr(Date, 1, 10) ORDER BY Date DESC) AS Last "
+            f"  FROM rating_snapshots WHERE Date < ? AND Rating IS NOT NULL AND {_KEEP_LATEST_RAW}"
+            ") WHERE true GROUP BY Name, Platform, Day"
+        )), (raw_cutoff,))
+        raw = conn.execute(f"DELETE FROM rating_snapshots WHERE Date < ? AND Rating IS NOT NULL AND {_KEEP_LATEST_RAW}", (raw_cutoff,)).rowcount
+        conn.execute(_ROLLUP_UPSERT.format(select=(
+            "SELECT Name, Platform, 'month', Month, SUM(Count), SUM(RatingSum), MIN(RatingMin), MAX(RatingMax), MAX(Last), MAX(Date) FROM ("
+            "  SELECT *, substr(Start, 1, 7) || '-01' AS Month, FIRST_VALUE(Rating) OVER "
+            "  (PARTITION BY Name, Platform, substr(Start, 1, 7) ORDER BY Date DESC) AS Last "
+            "  FROM rating_rollups WHERE Period = 'day' AND Start < ?"
+            ") WHERE true GROUP BY Name, Platform, Month"
+        )), (daily_cutoff,))
+        days = conn.execute("DELETE FROM rating_rollups WHERE Period = 'day' AND Start < ?", (daily_cutoff,)).rowcount
+        if raw or days: _bump_storage_version(conn)
+    stats = {"notas resumidas": raw, "días resumidos": days}
+    if raw or days: print(f"🗜️ Notas compactadas: {stats}")
+    return stats
+
+# --- AGREGADOS DE NOTAS Y RESEÑAS (última nota por ficha, meses y días) ---
+# Triggers de SQLite sobre rating_snapshots, rating_rollups y reviews: cada escritura ajusta
+# listing_status y las tablas de AGGREGATE_SPECS en su misma transacción, venga de una sync,
+# de GSheets, del inbox o de compact_rating_snapshots (que mueve notas de una tabla a otra:
+# el mes y el día no cambian).
+# listing_status solo avanza: resumir o borrar notas antiguas no cambia la última. Las
+# notas sin fecha no cuentan (no se sabe de qué mes son ni si son la última).
+_STATUS_UPSERT = (
+    "INSERT INTO listing_status (Name, Platform, Rating, Date) SELECT NEW.Name, NEW.Platform, NEW.Rating, NEW.Date "
+    "WHERE NEW.Rating IS NOT NULL AND NEW.Date IS NOT NULL "
+    "ON CONFLICT(Name, Platform) DO UPDATE SET "
+    # Más reciente: la última pasa a anterior. Entre la anterior y la última (llega tarde): nueva anterior
+    "PrevRating = CASE WHEN excluded.Date > Date THEN Rating "
+    "  WHEN excluded.Date < Date AND (PrevDate IS NULL OR excluded.Date >= PrevDate) THEN excluded.Rating ELSE PrevRating END, "
+    "PrevDate = CASE WHEN excluded.Date > Date THEN Date "
+    "  WHEN excluded.Date < Date AND (PrevDate IS NULL OR excluded.Date >= PrevDate) THEN excluded.Date ELSE PrevDate END, "
+    "Rating = CASE WHEN excluded.Date >= Date THEN excluded.Rating ELSE Rating END, "
+    "Date = MAX(Date, excluded.Date)"
+)
+
+# Qué suma cada tabla de agregados por cada fila de origen. "{row}" es NEW/OLD en los
+# triggers y el nombre de la tabla al reconstruir. Los valores se suman al insertar y se
+# restan al borrar; una edición (p.ej. Category o Crisis desde el inbox) resta la fila
+# vieja y suma la nueva.
+AGGREGATE_SPECS = [
+    {"source": "rating_snapshots", "target": "rating_monthly",
+     "keys": {"Name": "{row}.Name", "Platform": "{row}.Platform", "Month": "substr({row}.Date, 1, 7)"},
+     "values": {"Count": "1", "RatingSum": "{row}.Rating"},
+     "cond": "{row}.Rating IS NOT NULL AND {row}.Date IS NOT NULL"},
+    {"source": "rating_rollups", "target": "rating_monthly",
+     "keys": {"Name": "{row}.Name", "Platform": "{row}.Platform", "Month": "substr({row}.Start, 1, 7)"},
+     "values": {"Count": "{row}.Count", "RatingSum": "{row}.RatingSum"},
+     "cond": "true"},
+    {"source": "rating_snapshots", "target": "rating_daily",
+     "keys": {"Platform": "{row}.Platform", "Day": "substr({row}.Date, 1, 10)"},
+     "values": {"Count": "1", "RatingSum": "{row}.Rating"},
+     "cond": "{row}.Rating IS NOT NULL AND {row}.Date IS NOT NULL"},
+    {"source": "rating_rollups", "target": "rating_daily",
+     "keys": {"Platform": "{row}.Platform", "Day": "substr({row}.Start, 1, 10)"},
+     "values": {"Count": "{row}.Count", "RatingSum": "{row}.RatingSum"},
+     "cond": "true"},
+    {"source": "reviews", "target": "review_daily",
+     "keys": {"Day": "substr({row}.Date, 1, 10)", "Name": "IFNULL({row}.Name, '')", "Platform": "IFNULL({row}.Platform, '')",
+              "Category": "IFNULL({row}.Category, '')", "Cleaner": "IFNULL({row}.Cleaner, '')"},
+     "values": {"Count": "1", "Negatives": "IFNULL({row}.IsNegative, 0)", "Crisis": "IFNULL({row}.Crisis, 0)",
+                "RatingCount": "({row}.Rating IS NOT NULL)", "RatingSum": "IFNULL({row}.Rating, 0)"},
+     "cond": "{row}.Date IS NOT NULL"},
+]
+
+def _aggregate_sql(spec, row, sign=1, bulk=False):
+    """Sentencia que suma (sign=1) o resta (-1) la fila row de spec en su tabla de agregados."""
+    keys = {c: e.format(row=row) for c, e in spec["keys"].items()}
+    values = {c: e.format(row=row) for c, e in spec["values"].items()}
+    cond = spec["cond"].format(row=row)
+    if sign < 0:
+        sets = ", ".join(f"{c} = {c} - ({e})" for c, e in values.items())
+        where = " AND ".join(f"{c} = {e}" for c, e in keys.items())
+        return f"UPDATE {spec['target']} SET {sets} WHERE {where} AND {cond}"
+    cols = ", ".join([*keys, *values])
+    exprs = ", ".join([*keys.values(), *values.values()])
+    sets = ", ".join(f"{c} = {c} + excluded.{c}" for c in values)
+    source = f" FROM {spec['source']}" if bulk else ""
+    return (f"INSERT INTO {spec['target']} ({cols}) SELECT {exprs}{source} WHERE {cond} "
+            f"ON CONFLICT({', '.join(keys)}) DO UPDATE SET {sets}")
+
+def _aggregate_triggers():
+    """{nombre: CREATE TRIGGER} de insert/update/delete para cada tabla de origen."""
+    triggers = {}
+    for source, prefix in (("rating_snapshots", "tr_snapshots"), ("rating_rollups", "tr_rollups"), ("reviews", "tr_reviews")):
+        specs = [spec for spec in AGGREGATE_SPECS if spec["source"] == source]
+        add = [_aggregate_sql(spec, "NEW") for spec in specs]
+        sub = [_aggregate_sql(spec, "OLD", sign=-1) for spec in specs]
+        status = [_STATUS_UPSERT] if source == "rating_snapshots" else []
+        for event, body in (("INSERT", status + add), ("UPDATE", sub + status + add), ("DELETE", sub)):
+            name = f"{prefix}_{event.lower()}"
+            triggers[name] = f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {source} BEGIN {'; '.join(body)}; END"
+    return triggers
+
+AGGREGATE_TRIGGERS = _aggregate_triggers()
+
+def rebuild_rating_aggregates(conn):
+    """
+    Agregados desde cero (migración, histórico reemplazado): listing_status y AGGREGATE_SPECS.
+    La anterior de listing_status sale de las notas sueltas como en los triggers (compactar
+    conserva las dos últimas); solo una ficha resumida entera da la del periodo anterior.
+    """
+    for target in dict.fromkeys(spec["target"] for spec in AGGREGATE_SPECS):
+        conn.execute(f"DELETE FROM {target}")
+    for spec in AGGREGATE_SPECS:
+        conn.execute(_aggregate_sql(spec, spec["source"], bulk=True))
+    conn.execute("DELETE FROM listing_status")
+    conn.execute(
+        "INSERT INTO listing_status (Name, Platform, Rating, Date, PrevRating, PrevDate) "
+        "SELECT Name, Platform, Rating, Date, PrevRating, PrevDate FROM ("
+        "  SELECT *, LEAD(Rating) OVER w AS PrevRating, LEAD(Date) OVER w AS PrevDate, ROW_NUMBER() OVER w AS n FROM ("
+        "    SELECT Name, Platform, Rating, Date FROM rating_snapshots WHERE Rating IS NOT NULL AND Date IS NOT NULL"
+        "    UNION ALL SELECT Name, Platform, Rating, Date FROM rating_rollups"
+        "  ) WINDOW w AS (PARTITION BY Name, Platform ORDER BY Date DESC)"
+        ") WHERE n = 1")
+
+# --- CAMBIOS PENDIENTES (write-behind hacia GSheets) ---
+# Las ediciones del inbox y lo que trae cada sync (reseñas y notas de ficha) se aplican al
+# SQLite local en el momento (el siguiente rerun ya las ve) y, en la misma transacción, se
+# apuntan en pending_edits con su pestaña. Un hilo las junta por Hash (gana el último valor
+# de cada campo) y las sube a la hoja por lotes: clasificar 30 reseñas seguidas son un par
+# de escrituras en Sheets, no 30. Si la subida falla, el diario se conserva y se reintenta.
+EDIT_FLUSH_DELAY = 2   # Seg de calma antes de subir (agrupa ráfagas de ediciones)
+EDIT_FLUSH_RETRY = 30  # Seg entre reintentos si la Nube no responde
+PENDING_SHEET_TABLES = {"Reviews": "reviews", SNAPSHOTS_SHEET: "rating_snapshots"}
+
+def _pending_rows(df_rows, sheet):
+    """Filas para pending_edits: (Hash, cambios en JSON, fecha, pestaña)."""
+    # Valores Python (no numpy) para el JSON del diario
+    rows = df_rows.astype(object).where(df_rows.notna(), None).to_dict("records")
+    now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return [(r["Hash"], json.dumps(r, default=str, ensure_ascii=False), now_str, sheet) for r in rows]
+
+def queue_review_rows(df_rows):
+    """
+    Inserta/actualiza reseñas por Hash (se escriben todas las columnas de df_rows; un None
+    vacía el campo) en local, y deja la subida a GSheets pendiente para el flusher.
+    """
+    if df_rows.empty: return
+    init_local_store()
+    _write_reviews(df_rows, pending=_pending_rows(df_rows, "Reviews"))
+    get_edit_flusher().notify()
+
+def queue_snapshot_rows(df_rows):
+    """Añade notas de ficha a rating_snapshots; su pestaña de GSheets, vía el flusher."""
+    if df_rows.empty: return
+    init_local_store()
+    df_rows = df_rows.assign(Hash=review_hashes(df_rows))
+    _write_snapshots(df_rows, pending=_pending_rows(df_rows, SNAPSHOTS_SHEET))
+    get_edit_flusher().notify()
+
+def read_local_rows(sheet, hashes):
+    """Filas completas del SQLite para una pestaña (las que la hoja aún no tiene)."""
+    table = PENDING_SHEET_TABLES[sheet]
+    init_local_store()
+    with local_db() as conn:
+        df = pd.read_sql_query(f"SELECT * FROM {table} WHERE Hash IN ({', '.join('?' * len(hashes))})", conn, params=list(hashes))
+    return apply_review_dtypes(df) if table == "reviews" else df
+
+def count_pending_edits():
+    init_local_store()
+    with local_db() as conn:
+        return conn.execute("SELECT COUNT(*) FROM pending_edits").fetchone()[0]
+
+def flush_pending_edits():
+    """Sube a GSheets los cambios pendientes, agrupados. Devuelve cuántas filas se subieron."""
+    init_local_store()
+    with local_db() as conn:
+        rows = conn.execute("SELECT id, changes, IFNULL(Sheet, 'Reviews') FROM pending_edits ORDER BY id").fetchall()
+    if not rows: return 0
+    last_id = rows[-1][0]
+
+    if GS_CONN is None:
+        flushed = 0  # Modo local: no hay Nube que actualizar
+    elif not GS_CONN.connect():
+        raise RuntimeError("Sin conexión con GSheets; se reintentará")
+    else:
+        merged = {}
+        for _id, changes, sheet in rows:
+            change = json.loads(changes)
+            merged.setdefault((sheet, change["Hash"]), {}).update(change)
+        # Un upsert parcial por pestaña y combinación de columnas (p.ej. todas las 'Category' juntas)
+        groups = {}
+        for (sheet, _h), change in merged.items():
+            groups.setdefault((sheet, tuple(sorted(change))), []).append(change)
+        for (sheet, _cols), changes in groups.items():
+            full_rows = lambda hashes, sheet=sheet: read_local_rows(sheet, hashes)
+            if not GS_CONN.save_data(pd.DataFrame(changes), sheet_name=sheet, partial=True, complete=full_rows):
+                raise RuntimeError("GSheets no aceptó los cambios; se reintentará")
+        flushed = len(merged)
+
+    with local_db() as conn:
+        conn.execute("DELETE FROM pending_edits WHERE id <= ?", (last_id,))
+    return flushed
+
+class EditFlusher:
+    """Hilo que vacía pending_edits: tras cada aviso (con EDIT_FLUSH_DELAY de calma) y periódicamente."""
+    def __init__(self):
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self.last_flush = None
+        self.last_error = None
+        self._thread = threading.Thread(target=self._run, name="edit-flusher", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def notify(self):
+        self._wake.set()
+
+    def flush(self):
+        with self._lock:
+            try:
+                n = flush_pending_edits()
+                self.last_error = None
+                if n: self.last_flush = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                return n
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Error subiendo cambios pendientes: {e}")
+                return 0
+
+    def _run(self):
+        while True:
+            self._wake.wait(timeout=EDIT_FLUSH_RETRY)
+            self._wake.clear()
+            time.sleep(EDIT_FLUSH_DELAY)
+            self.flush()
+
+@st.cache_resource(show_spinner=False)
+def get_edit_flusher():
+    """Flusher compartido por todo el proceso (arranca con la app y sube lo que quedara)."""
+    return EditFlusher()
 
 def load_cleaners():
     if os.path.exists(cleaners_file):
@@ -301,6 +1586,7 @@ def save_cleaners(data):
         json.dump(data, f, indent=4)
 
 cleaners = load_cleaners()
+get_edit_flusher()  # Sube lo que quedara pendiente de una ejecución anterior
 
 # Escaneo Global de Crisis al Inicio
 try:
@@ -315,8 +1601,7 @@ try:
                     
                     c1, c2 = st.columns(2)
                     if c1.button("✅ Marcar como Resuelto", key=f"crisis_{row['Hash']}"):
-                        df_alert.loc[df_alert["Hash"] == row["Hash"], "Crisis"] = False
-                        save_reviews_db(df_alert)
+                        update_review(row["Hash"], Crisis=False)
                         st.rerun()
 except Exception as e:
     st.sidebar.error(f"🚨 Error Crítico en Carga Inicial: {e}")
@@ -339,377 +1624,1513 @@ def save_accommodations(data):
 
 accommodations = load_accommodations()
 
+def load_fingerprints():
+    """Huella de la última sync por URL: {"Reviews", "Rating", "Checked", "Changed"}."""
+    if os.path.exists(fingerprints_file):
+        with open(fingerprints_file, "r") as f:
+            try: return json.load(f)
+            except: return {}
+    return {}
+
+def save_fingerprints(data):
+    with open(fingerprints_file, "w") as f:
+        json.dump(data, f, indent=4)
+
 # --- FUNCIONES DE SCRAPING --- (Resto igual)
 
 # --- FUNCIONES DE SCRAPING ---
 # --- FUNCIONES DE SCRAPING ---
 # --- FUNCIONES DE SCRAPING ---
-def get_listing_data(page, url, platform_type):
+CHROMIUM_ARGS = ["--no-sandbox", "--disable-dev-shm-usage"]
+DESKTOP_VIEWPORT = {'width': 1920, 'height': 1080}
+DESKTOP_UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+# Motor asíncrono: nº de pestañas (contextos) simultáneas y límite por plataforma
+# (SCRAPE_CONCURRENCY = 1 vuelve al modo secuencial clásico)
+SCRAPE_CONCURRENCY = 6
+SCRAPE_PLATFORM_LIMITS = {"Airbnb": 3, "Booking": 3}
+
+AIRBNB_CARD_SEL = 'div[data-testid="pdp-reviews-review-item"], div[data-review-id], div._1gjypya, div[role="listitem"]'
+BOOKING_TEXT_SEL = """
+    [data-testid='review-subtext'],
+    [data-testid='featured-review-text'],
+    [data-testid='review-text'],
+    [data-testid='review-title'],
+    .c-review__body,
+    .c-review__title
+"""
+BOOKING_BLOCK_SEL = """
+    div[data-testid='property-section-reviews'] div,
+    ul[data-testid='reviews-list'] li div,
+    .c-review-block,
+    .review_list_new_item_block
+"""
+BOOKING_SCORE_SEL = ['div[data-testid="review-score-component"] div', '.ac4a7896c7']
+
+# Palabras prohibidas Booking (bloques de la ficha que no son opiniones)
+BOOKING_IGNORE = [
+    "Tipo de alojamiento", "Número de personas", "Buscar", "Ver disponibilidad",
+    "Gestionado por", "Puntuación de los comentarios", "Entrada Desde", "Salida Hasta",
+    "Condiciones sobre", "política de cancelación", "cancelación", "Información del alojamiento",
+    "Vivienda", "Beachfront", "Apartamento", "Apartment",
+    "Ubicación excelente", "Ver mapa", "Atracciones turísticas",
+    "Preguntas frecuentes", "Lo que más gustó a quienes",
+    "¿Cuántas personas", "pueden dormir", "se permiten mascotas", "hay cuna",
+    "aparcar", "desayunos", "restaurante",
+    "Información legal", "gestiona, autoriza o representa", "Esta etiqueta no",
+    "despedidas de soltero", "celebrar fiestas", "normas de la casa",
+    "precio de las cunas", "pagar por separado", "precio total",
+    "¿Qué hay cerca?", "lugares de interés", "Aeropuerto", "cafeterías",
+    "¿Cuánto cuesta alojarse", "¿Qué se puede hacer",
+    "Condiciones para estancias", "alojar niños", "de cualquier edad",
+    "Transporte público", "Tren", "Metro", "autobús",
+    "algunas opciones de alojamiento", "Encontrarás más información",
+    "Los precios en", "pueden variar en función",
+    "¿Cómo lo estamos haciendo?", "Me resulta fácil", "opción que necesito"
+]
+
+def _filter_airbnb_texts(candidates):
+    """Fallback Airbnb: textos planos (div[dir='ltr']) sin duplicados ni menús."""
+    reviews_data = []
+    seen = set()
+    for t in candidates:
+         t_clean = t.strip()
+         if t_clean in seen: continue
+         if len(t_clean) < 15: continue
+         if "Traducir" in t_clean or "Mostrar más" in t_clean or "Evaluación" in t_clean: continue
+
+         reviews_data.append(f"💬 {t_clean}")
+         seen.add(t_clean)
+    return reviews_data
+
+def _filter_booking_texts(candidates):
+    """Filtra los bloques de texto de Booking quedándose solo con opiniones."""
+    valid_texts = []
+    seen = set() # Deduplicación
+    for t in candidates:
+        t_clean = t.strip()
+        if t_clean in seen: continue
+
+        # 1. Filtro de Longitud
+        if len(t_clean) < 15: continue
+        # 2. Filtro de "Basura Conocida"
+        if any(bad.lower() in t_clean.lower() for bad in BOOKING_IGNORE): continue
+
+        # 3. Filtros extra
+        if "?" in t_clean and len(t_clean) < 100: continue
+        if "m²" in t_clean and "cocina" in t_clean.lower(): continue
+
+        valid_texts.append(t_clean)
+        seen.add(t_clean)
+    return valid_texts
+
+# --- CAPTURA DE RESEÑAS DESDE JSON (respuestas de la API) ---
+# Los modales de reseñas ya piden los datos a la API de cada plataforma. Escuchando
+# page.on("response") obtenemos nota, autor, fecha y texto por reseña sin tocar el DOM.
+# Los parsers son funciones puras: se pueden probar offline con respuestas grabadas.
+REVIEW_API_PATTERNS = {
+    "Airbnb": re.compile(r"/api/v3/StaysPdpReviews", re.IGNORECASE),
+    "Booking": re.compile(r"/dml/graphql|reviewlist", re.IGNORECASE),
+}
+
+def _iter_json_dicts(obj):
+    """Recorre en orden todos los dict anidados de un payload JSON."""
+    if isinstance(obj, dict):
+        yield obj
+        for v in obj.values(): yield from _iter_json_dicts(v)
+    elif isinstance(obj, list):
+        for v in obj: yield from _iter_json_dicts(v)
+
+def _json_date(value):
+    """ISO ('2024-10-20T...') o epoch en segundos -> 'YYYY-MM-DD'. Si no, el texto tal cual."""
+    if value in (None, ""): return None
+    if isinstance(value, (int, float)):
+        try: return datetime.fromtimestamp(value).strftime("%Y-%m-%d")
+        except Exception: return None
+    m = re.match(r"(\d{4}-\d{2}-\d{2})", str(value))
+    return m.group(1) if m else str(value)
+
+def parse_airbnb_reviews_payload(data):
+    """StaysPdpReviews -> [{"Reviewer", "Rating", "Date", "Text"}]."""
+    reviews = []
+    for d in _iter_json_dicts(data):
+        if "comments" not in d or not ("rating" in d or "reviewer" in d): continue
+        localized = d.get("localizedReview") or {}
+        text = (localized.get("comments") if isinstance(localized, dict) else None) or d.get("comments")
+        if not isinstance(text, str) or not text.strip(): continue
+        reviewer = d.get("reviewer") or {}
+        reviews.append({
+            "Reviewer": (reviewer.get("firstName") or reviewer.get("name") or "Anónimo") if isinstance(reviewer, dict) else "Anónimo",
+            "Rating": d.get("rating"),
+            "Date": _json_date(d.get("createdAt")) or d.get("localizedDate"),
+            "Text": text.strip(),
+        })
+    return reviews
+
+def parse_booking_reviews_payload(data):
+    """GraphQL ReviewList de Booking -> [{"Reviewer", "Rating", "Date", "Text"}]."""
+    reviews = []
+    for d in _iter_json_dicts(data):
+        if "reviewScore" not in d or not ("textDetails" in d or "guestDetails" in d): continue
+        details = d.get("textDetails") or {}
+        parts = [details.get(k) for k in ("title", "positiveText", "negativeText")]
+        text = " | ".join(p.strip() for p in parts if isinstance(p, str) and p.strip())
+        if not text: continue
+        guest = d.get("guestDetails") or {}
+        reviews.append({
+            "Reviewer": guest.get("username") or "Anónimo",
+            "Rating": d.get("reviewScore"),
+            "Date": _json_date(d.get("reviewedDate")),
+            "Text": text,
+        })
+    return reviews
+
+REVIEW_PAYLOAD_PARSERS = {"Airbnb": parse_airbnb_reviews_payload, "Booking": parse_booking_reviews_payload}
+
+def format_review_text(platform, review):
+    """Mismo formato que el texto sacado del DOM (compatible con score_negativity)."""
+    if platform == "Booking" and review.get("Rating") is not None:
+        return f"⭐ {float(review['Rating']):.1f} | {review['Text']}"
+    return f"👤 {review['Reviewer']}: {review['Text']}"
+
+class ReviewCapture:
+    """Escucha las respuestas JSON de reseñas de una página y acumula reseñas sin duplicados."""
+    def __init__(self, platform, keep_raw=False):
+        self.platform = platform
+        self.pattern = REVIEW_API_PATTERNS.get(platform)
+        self.parser = REVIEW_PAYLOAD_PARSERS.get(platform)
+        self.reviews = []
+        self.payloads = 0
+        self.raw = [] if keep_raw else None  # Payloads tal cual (modo grabación -> fixtures)
+        self._pending = 0
+        self._seen = set()
+
+    def feed(self, data):
+        """Añade las reseñas de un payload (también sirve para respuestas grabadas)."""
+        if not self.parser: return 0
+        added = 0
+        for r in self.parser(data):
+            key = (r["Reviewer"], r["Date"], r["Text"][:80])
+            if key in self._seen: continue
+            self._seen.add(key)
+            self.reviews.append(r)
+            added += 1
+        self.payloads += 1
+        return added
+
+    def attach(self, page):
+        if self.pattern is None: return self
+        page.on("request", self._on_request)
+        page.on("response", self._on_response)
+        return self
+
+    def _on_request(self, request):
+        if self.pattern.search(request.url): self._pending += 1
+
+    async def _on_response(self, response):
+        if not self.pattern.search(response.url): return
+        try:
+            if "json" not in (response.headers.get("content-type") or ""): return
+            data = await response.json()
+            if self.raw is not None: self.raw.append({"url": response.url, "body": data})
+            self.feed(data)
+        except Exception: pass
+        finally:
+            self._pending = max(0, self._pending - 1)
+
+    async def wait(self, page, timeout_ms=2000):
+        """Si hay peticiones de reseñas en vuelo, espera (como mucho timeout_ms) a que lleguen."""
+        waited = 0
+        while self._pending > 0 and waited < timeout_ms:
+            await page.wait_for_timeout(100)
+            waited += 100
+
+    def as_texts(self):
+        return [format_review_text(self.platform, r) for r in self.reviews]
+
+# --- EXTRACCIÓN DOM EN UNA SOLA LLAMADA (evaluate) ---
+# Cada inner_text() es un viaje de ida y vuelta al navegador. Estos extractores corren
+# dentro de la página y devuelven todas las tarjetas de golpe como JSON.
+# Reciben una lista de selectores y usan el primero que tenga tarjetas.
+AIRBNB_CARDS_JS = """
+(selectors) => {
+  const txt = (root, sel) => { const el = root.querySelector(sel); return el ? el.innerText.trim() : ""; };
+  for (const sel of selectors) {
+    const cards = Array.from(document.querySelectorAll(sel));
+    if (!cards.length) continue;
+    return {selector: sel, cards: cards.map(card => {
+      const raw = (card.innerText || "").trim();
+      const stars = card.querySelector("[aria-label*='estrella'], [aria-label*='star'], [aria-label*='Valoración']");
+      const score = stars ? (stars.getAttribute("aria-label") || "").match(/(\\d+(?:[.,]\\d+)?)/) : null;
+      const date = raw.match(/(hace\\s+\\d+\\s+\\S+|\\d{1,2} de \\S+ de \\d{4}|\\S+ de \\d{4})/i);
+      return {
+        name: txt(card, "h2, h3, div[font-weight='bold']"),
+        body: txt(card, "span[data-testid='pdp-reviews-review-item-text'], div[dir='ltr']"),
+        score: score ? score[1] : "",
+        date: date ? date[1] : "",
+        raw: raw,
+      };
+    })};
+  }
+  return {selector: null, cards: []};
+}
+"""
+
+BOOKING_CARDS_JS = """
+(selectors) => {
+  const txt = (root, sel) => { const el = root.querySelector(sel); return el ? el.innerText.trim() : ""; };
+  const parts = ["[data-testid='review-title']", "[data-testid='review-positive-text']", "[data-testid='review-negative-text']"];
+  for (const sel of selectors) {
+    const cards = Array.from(document.querySelectorAll(sel));
+    if (!cards.length) continue;
+    return {selector: sel, cards: cards.map(card => ({
+      name: (txt(card, "[data-testid='review-avatar'], .bui-avatar-block__title").split("\\n")[0] || "").trim(),
+      body: parts.map(p => txt(card, p)).filter(Boolean).join(" | "),
+      score: txt(card, "[data-testid='review-score'], .bui-review-score__badge"),
+      date: txt(card, "[data-testid='review-date'], .c-review-block__date"),
+      raw: (card.innerText || "").trim(),
+    }))};
+  }
+  return {selector: null, cards: []};
+}
+"""
+
+REVIEW_CARDS_JS = {"Airbnb": AIRBNB_CARDS_JS, "Booking": BOOKING_CARDS_JS}
+BOOKING_CARD_SEL = ['[data-testid="review-card"]', 'li.review_item']
+
+def _card_score(score_text):
+    m = re.search(r"(\d+(?:[.,]\d+)?)", score_text or "")
+    return float(m.group(1).replace(",", ".")) if m else None
+
+async def extract_review_cards(page, platform, selectors):
+    """
+    Una sola llamada evaluate: devuelve (selector_usado, reseñas) con el mismo formato
+    que el JSON de la API ({"Reviewer", "Rating", "Date", "Text"}) más "Raw" y "ScoreText".
+    """
     try:
-        # User-Agent handling is done at context level
-        # st.write(f"🌍 {url}") # Demasiado ruido
-        # OPTIMIZACIÓN: No esperar a que carguen todas las imágenes (domcontentloaded)
-        page.goto(url, timeout=30000, wait_until="domcontentloaded")
-        
+        res = await page.evaluate(REVIEW_CARDS_JS[platform], list(selectors))
+    except Exception:
+        return None, []
+    reviews = []
+    for c in (res or {}).get("cards") or []:
+        reviews.append({
+            "Reviewer": c.get("name") or "Anónimo",
+            "Rating": _card_score(c.get("score")),
+            "Date": c.get("date") or None,
+            "Text": c.get("body") or "",
+            "Raw": c.get("raw") or "",
+            "ScoreText": c.get("score") or "",
+        })
+    return (res or {}).get("selector"), reviews
+
+# --- HUELLA DE FICHA (Sync incremental) ---
+# Nº de reseñas + nota de cabecera, leídos nada más cargar la ficha en una sola llamada.
+# Si coinciden con la última sincronización, nos saltamos clicks, scroll y extracción.
+LISTING_FINGERPRINT_JS = """
+(platform) => {
+  const body = document.body ? document.body.innerText : "";
+  let scope = body;
+  if (platform === "Booking") {
+    const el = document.querySelector('[data-testid="review-score-component"]') || document.querySelector('.ac4a7896c7');
+    if (el) scope = el.innerText;
+  }
+  const countRe = platform === "Booking" ? /(\\d[\\d.]*)\\s+(comentarios|opiniones|reviews)/i : /(\\d[\\d.]*)\\s+(evaluaciones|reseñas|reviews)/i;
+  const scoreRe = platform === "Booking" ? /(\\d+[,.]\\d+)/ : /(?:^|\\n|\\s)(\\d[,.]\\d{2})(?:\\s|\\n|·|$)/;
+  const c = scope.match(countRe) || body.match(countRe);
+  const s = scope.match(scoreRe);
+  return {
+    count: c ? parseInt(c[1].replace(/\\./g, ""), 10) : null,
+    score: s ? parseFloat(s[1].replace(",", ".")) : null,
+  };
+}
+"""
+
+async def read_listing_fingerprint(page, platform):
+    """Devuelve {"Reviews": n, "Rating": x} (None en lo que no se pudo leer)."""
+    try:
+        fp = await page.evaluate(LISTING_FINGERPRINT_JS, platform) or {}
+    except Exception:
+        fp = {}
+    return {"Reviews": fp.get("count"), "Rating": fp.get("score")}
+
+def fingerprint_unchanged(previous, current):
+    """Solo damos por buena una huella completa (nº de reseñas y nota) e idéntica a la anterior."""
+    if not previous or not current: return False
+    if current.get("Reviews") is None or current.get("Rating") is None: return False
+    return (previous.get("Reviews") == current["Reviews"]
+            and previous.get("Rating") is not None
+            and round(float(previous["Rating"]), 2) == round(float(current["Rating"]), 2))
+
+async def get_listing_data(page, url, platform_type, log=None, previous_fp=None, trace=None, capture=None):
+    """
+    Lee nota y comentarios de una ficha (async_playwright, página del pool).
+    Devuelve (rating, text, reviews, fingerprint):
+    - reviews: reseñas estructuradas (JSON de la API o tarjetas del DOM).
+    - fingerprint: {"Reviews", "Rating"} de cabecera. Si coincide con previous_fp no se
+      extrae nada: text es None y fingerprint["Unchanged"] es True.
+    trace (dict opcional): se rellena con qué vía/selector dio la nota y el texto, el estado
+    HTTP, si la página es un captcha/bloqueo y el error si lo hubo (benchmark y política).
+    capture (opcional): ReviewCapture propio, p.ej. con keep_raw para grabar fixtures.
+    """
+    log = log or st.write
+    trace = {} if trace is None else trace
+    trace.update({"rating_sel": None, "text_source": None, "http_status": None, "blocked": False, "error": None})
+    capture = (capture or ReviewCapture(platform_type)).attach(page)
+    try:
+        response = await page.goto(url, timeout=30000, wait_until="domcontentloaded")
+        if response is not None: trace["http_status"] = response.status
+        if await page.evaluate(BLOCK_CHECK_JS) is True or trace["http_status"] in BLOCKED_HTTP:
+            # Captcha / bloqueo anti-bot: no hay nada que leer y reintentar lo empeora
+            trace["blocked"] = True
+            return None, None, [], {}
+
+        # Chequeo barato: si nada cambió desde la última sync, no hace falta más
+        fingerprint = await read_listing_fingerprint(page, platform_type)
+        if fingerprint_unchanged(previous_fp, fingerprint):
+            log(f"⏭️ Sin cambios ({fingerprint['Reviews']} reseñas, nota {fingerprint['Rating']}): {url}")
+            return fingerprint["Rating"], None, [], {**fingerprint, "Unchanged": True}
+
         # Lazy Loading Scroll (Simple y Rápido)
-        # En lugar de lógica compleja, bajamos al fondo y subimos un poco
-        page.keyboard.press("End")
-        page.wait_for_timeout(1000)
-        page.keyboard.press("PageUp")
-        page.wait_for_timeout(500)
-        
-        # DEBUG: Confirmar dónde estamos
-        try: 
-            p_title = page.title()
-            st.write(f"📄 Título: {p_title}")
+        await page.keyboard.press("End")
+        await page.wait_for_timeout(1000)
+        await page.keyboard.press("PageUp")
+        await page.wait_for_timeout(500)
+
+        try:
+            p_title = await page.title()
+            log(f"📄 Título: {p_title}")
         except: pass
-        
+
         rating = None
         text = None
-        
-        # Palabras prohibidas (header/footer y menús repetitivos)
-        # HEMOS QUITADO: "habitaciones", "baños", "llegada", "fotos", "noche" (Son comunes en reviews)
-        # Palabras prohibidas (header/footer y menús repetitivos)
-        # Indultamos palabras genéricas pero prohibimos las FRASES DE ETIQUETA ("Highlights")
-        IGNORE_m = [
-            "Alojamientos", "Experiencias", "Regístrate", "Inicia sesión", "Menú", 
-            "Traducción", "Anfitrión", "Evaluación", "NUEVO", "Búsqueda", 
-            "Compartir", "Guardar", "pestaña", "fechas", "precios", "consultar", 
-            "Alojamiento entero", "Superanfitrión", "cancelación",
-            "Muy buena comunicación", "Llegada autónoma", "Date un buen chapuzón", "años de experiencia",
-            "Mostrar más", "traducido automáticamente", "Mostrar el original"
-        ]
-        
+        dom_reviews = []
+
         if platform_type == "Airbnb":
             # --- AIRBNB (Fast Click & Read) ---
             try:
-                # Click "Mostrar todas" si existe (Timeouts cortos para no atascarse)
                 clicked = False
                 btn = page.locator('[data-testid="pdp-show-all-reviews-button"]').first
-                if btn.count() > 0 and btn.is_visible():
-                    btn.click(timeout=1000)
+                if await btn.count() > 0 and await btn.is_visible():
+                    await btn.click(timeout=1000)
                     clicked = True
-                
+
                 if not clicked:
                      try:
-                         page.get_by_text(re.compile(r"(\d+ (evaluaciones|reviews)|Mostrar)", re.IGNORECASE)).first.click(timeout=1000)
+                         await page.get_by_text(re.compile(r"(\d+ (evaluaciones|reviews)|Mostrar)", re.IGNORECASE)).first.click(timeout=1000)
                      except: pass
-                
-                page.wait_for_timeout(1000) 
+
+                await page.wait_for_timeout(1000)
             except: pass
 
-            # ... (Rating logic remains) ...
             try:
                 r_loc = page.get_by_text(re.compile(r"^\d+,\d{2}$")).first
-                if r_loc.count() > 0: rating = float(r_loc.inner_text().replace(',', '.'))
+                if await r_loc.count() > 0:
+                    rating = float((await r_loc.inner_text()).replace(',', '.'))
+                    trace["rating_sel"] = "text ^d,dd$"
                 else:
-                    r_loc = page.locator('span.a8jhwvl').first 
-                    if r_loc.count() > 0: rating = float(r_loc.inner_text().split()[0].replace(',', '.'))
+                    r_loc = page.locator('span.a8jhwvl').first
+                    if await r_loc.count() > 0:
+                        rating = float((await r_loc.inner_text()).split()[0].replace(',', '.'))
+                        trace["rating_sel"] = "span.a8jhwvl"
             except: pass
-            
+
             # --- TEXTO ---
             try:
-                reviews_data = []
+                # Intento 0: JSON de la API (estructurado, sin round-trips al DOM)
+                await capture.wait(page)
+                reviews_data = capture.as_texts()
+                if reviews_data: trace["text_source"] = "json"
+
+                # Intento 1: Tarjetas Estructuradas (Modal o Página) en una sola llamada
+                if not reviews_data:
+                    card_sel, cards = await extract_review_cards(page, "Airbnb", [AIRBNB_CARD_SEL])
+                    dom_reviews = [c for c in cards if len(c["Text"]) > 10]
+                    reviews_data = [format_review_text("Airbnb", c) for c in dom_reviews]
+                    if reviews_data: trace["text_source"] = f"cards {card_sel}"
+
+                if not reviews_data:
+                    reviews_data = _filter_airbnb_texts(await page.locator("div[dir='ltr']").all_inner_texts())
+                    if reviews_data: trace["text_source"] = "div[dir='ltr']"
+
+                if reviews_data:
+                    text = " || ".join(reviews_data)
+                    log(f"✅ Airbnb Comentarios ({len(reviews_data)}): *{text[:200]}...*")
+
+            except Exception as e:
+                print(f"Airbnb Scrape error: {e}")
+        elif platform_type == "Booking":
+            # --- BOOKING (Click + Silent Scrape) ---
+            try:
+                clicked = False
+                for sel in ["[data-testid='Property-Header-Nav-Tab-Trigger-reviews']", "#reviews-tab", "a#show_reviews_tab"]:
+                    try:
+                        if await page.locator(sel).first.is_visible():
+                            await page.locator(sel).first.click(timeout=1000)
+                            clicked = True
+                            break
+                    except: pass
+
+                if not clicked:
+                    try:
+                        await page.get_by_text(re.compile(r"(Comentarios|Reviews|Opiniones|Huéspedes)", re.IGNORECASE)).first.click(timeout=1000)
+                    except: pass
+
+                await page.wait_for_timeout(2000)
+            except: pass
+
+            try:
+                for sel in BOOKING_SCORE_SEL:
+                    loc = page.locator(sel).first
+                    if await loc.count() > 0:
+                        val = re.search(r"(\d+[,.]\d+)", await loc.inner_text())
+                        if val:
+                             rating = float(val.group(1).replace(',', '.'))
+                             trace["rating_sel"] = sel
+                             break
+            except: pass
+
+            try:
+                await capture.wait(page)
+                if capture.reviews:
+                    valid_texts = capture.as_texts()
+                    trace["text_source"] = "json"
+                else:
+                    # Fallback DOM: primero tarjetas completas (una llamada), luego bloques de texto
+                    card_sel, cards = await extract_review_cards(page, "Booking", BOOKING_CARD_SEL)
+                    dom_reviews = [c for c in cards if len(c["Text"]) >= 15]
+                    valid_texts = [format_review_text("Booking", c) for c in dom_reviews]
+                    if valid_texts: trace["text_source"] = f"cards {card_sel}"
+                if not valid_texts:
+                    candidates = await page.locator(BOOKING_TEXT_SEL).all_inner_texts()
+                    trace["text_source"] = "booking text selectors"
+                    if not candidates:
+                        candidates = await page.locator(BOOKING_BLOCK_SEL).all_inner_texts()
+                        trace["text_source"] = "booking block selectors"
+                    valid_texts = _filter_booking_texts(candidates)
+                    if not valid_texts: trace["text_source"] = None
+
+                if valid_texts:
+                    text = " || ".join(valid_texts)
+                    log(f"✅ Booking Comentarios detectados ({len(valid_texts)}): *{text[:100]}...*")
+
+            except Exception: pass
+
+        if capture.reviews:
+            log(f"⚡ {platform_type}: {len(capture.reviews)} reseñas leídas del JSON de la API")
+
+        return rating, text, capture.reviews or dom_reviews, fingerprint
+
+    except Exception as e:
+        # Sin log: el informe por URL (ScrapePolicy) lo recoge desde trace
+        trace["error"] = str(e).splitlines()[0][:200] if str(e) else type(e).__name__
+        return None, None, [], {}
+
+def _build_scrape_tasks(accommodations_list):
+    """Lista de (nombre, plataforma, url) a visitar, en el orden de alojamientos.json."""
+    tasks = []
+    for acc in accommodations_list:
+        if acc.get("airbnb"): tasks.append((acc["name"], "Airbnb", acc["airbnb"]))
+        if acc.get("booking"): tasks.append((acc["name"], "Booking", acc["booking"]))
+    return tasks
+
+def _install_chromium():
+    """Primer inicio en Nube: descarga el navegador de Playwright."""
+    import subprocess
+    print("⚠️ Primer inicio en Nube: Instalando navegador... (Puede tardar 1 min)")
+    subprocess.run([sys.executable, "-m", "playwright", "install", "chromium"], check=True)
+
+# --- INTERCEPTACIÓN DE RED (Bloqueo de recursos) ---
+# Solo necesitamos texto y nota: imágenes, vídeo, fuentes, mapas y trackers se abortan
+# antes de salir del navegador. Perfiles por plataforma (tipos + dominios).
+NETWORK_BLOCKING = True
+
+_TRACKER_DOMAINS = (
+    "google-analytics.com", "googletagmanager.com", "doubleclick.net", "googlesyndication.com",
+    "googleadservices.com", "facebook.net", "facebook.com", "bing.com", "hotjar.com",
+    "clarity.ms", "criteo.com", "criteo.net", "tiktok.com", "optimizely.com", "branch.io",
+    "maps.googleapis.com", "maps.gstatic.com", "youtube.com", "ytimg.com",
+)
+
+BLOCK_PROFILES = {
+    "Airbnb": {
+        "block_types": {"image", "media", "font", "texttrack", "manifest"},
+        "deny_domains": _TRACKER_DOMAINS,
+        # Scripts/XHR de terceros fuera de esta lista también se bloquean
+        "allow_domains": ("airbnb.es", "airbnb.com", "muscache.com", "airbnbapi.com"),
+    },
+    "Booking": {
+        "block_types": {"image", "media", "font", "texttrack", "manifest"},
+        "deny_domains": _TRACKER_DOMAINS,
+        "allow_domains": ("booking.com", "bstatic.com"),
+    },
+}
+_THIRD_PARTY_BLOCK_TYPES = {"script", "xhr", "fetch", "ping", "eventsource", "websocket", "other"}
+
+# Tamaño medio por tipo (bytes) para estimar lo ahorrado: una petición abortada no tiene tamaño real
+BLOCKED_BYTES_ESTIMATE = {
+    "image": 60_000, "media": 800_000, "font": 45_000, "script": 90_000,
+    "xhr": 8_000, "fetch": 8_000, "stylesheet": 30_000,
+}
+
+def _host_matches(host, domains):
+    return any(host == d or host.endswith("." + d) for d in domains)
+
+class RequestBlocker:
+    """Decide qué peticiones abortar según el perfil de la plataforma y lleva la cuenta."""
+    def __init__(self, profiles=None):
+        self.profiles = profiles or BLOCK_PROFILES
+        self.blocked = {}  # tipo -> nº peticiones abortadas
+        self.allowed = 0
+        self.bytes_saved = 0
+
+    def should_block(self, platform, url, resource_type):
+        profile = self.profiles.get(platform)
+        if not profile or resource_type == "document": return False
+        host = (urlsplit(url).hostname or "").lower()
+        if _host_matches(host, profile["deny_domains"]): return True
+        if resource_type in profile["block_types"]: return True
+        allow = profile.get("allow_domains")
+        if allow and not _host_matches(host, allow) and resource_type in _THIRD_PARTY_BLOCK_TYPES:
+            return True
+        return False
+
+    def record(self, resource_type, blocked):
+        if blocked:
+            self.blocked[resource_type] = self.blocked.get(resource_type, 0) + 1
+            self.bytes_saved += BLOCKED_BYTES_ESTIMATE.get(resource_type, 5_000)
+        else:
+            self.allowed += 1
+
+    def route_handler(self, platform):
+        async def _handle(route):
+            req = route.request
+            blocked = self.should_block(platform, req.url, req.resource_type)
+            self.record(req.resource_type, blocked)
+            try:
+                if blocked: await route.abort()
+                else: await route.fallback()  # fallback: deja pasar a otros handlers (p.ej. HAR)
+            except Exception: pass  # Página cerrada mientras tanto
+        return _handle
+
+    def snapshot(self):
+        return {"blocked": sum(self.blocked.values()), "allowed": self.allowed, "bytes_saved": self.bytes_saved}
+
+    def summary(self):
+        return {
+            "Peticiones bloqueadas": sum(self.blocked.values()),
+            "Peticiones permitidas": self.allowed,
+            "Ahorro estimado (MB)": round(self.bytes_saved / 1_048_576, 1),
+            "Por tipo": dict(self.blocked),
+        }
+
+# --- POLÍTICA DE SCRAPING (límite por plataforma, reintentos y cortacircuitos) ---
+# Todo lo que sale hacia Airbnb/Booking pasa por aquí: un cubo de fichas por plataforma
+# (subir la concurrencia ya no dispara el ritmo de peticiones), reintentos con backoff
+# exponencial y jitter para fallos transitorios, y un cortacircuitos que deja de insistir
+# en una plataforma que está devolviendo captchas.
+SCRAPE_RATE_LIMITS = {"Airbnb": (0.5, 2), "Booking": (0.5, 2)}  # (peticiones/seg, ráfaga)
+SCRAPE_DEFAULT_RATE = (0.5, 2)
+SCRAPE_MAX_ATTEMPTS = 3        # Intentos por URL ante errores transitorios
+SCRAPE_BACKOFF = (2.0, 30.0)   # (base, tope) en seg: espera aleatoria en [0, base·2^(n-1)]
+CIRCUIT_THRESHOLD = 3          # Captchas/bloqueos seguidos que abren el circuito
+CIRCUIT_COOLDOWN = 600         # Seg en pausa antes de dejar pasar una visita de prueba
+TRANSIENT_HTTP = {408, 425, 429, 500, 502, 503, 504}
+BLOCKED_HTTP = {403}
+
+BLOCK_CHECK_JS = """
+() => {
+  const t = (document.title + ' ' + location.href).toLowerCase();
+  if (/captcha|challenge|access denied|are you a human|eres humano|robot/.test(t)) return true;
+  return !!document.querySelector('#px-captcha, iframe[src*="captcha"], iframe[src*="challenges"], form#challenge-form');
+}
+"""
+
+SCRAPE_OUTCOMES = {
+    "ok": "✅ OK",
+    "no_text": "⚠️ Sin texto",
+    "unchanged": "⏭️ Sin cambios",
+    "empty": "❓ Sin nota",
+    "error": "🔥 Error",
+    "blocked": "🚫 Captcha/bloqueo",
+    "circuit_open": "⛔ Circuito abierto",
+}
+
+def classify_scrape(rating, text, fp, trace):
+    """Resultado de una visita a partir de lo que devolvió get_listing_data y su trace."""
+    if trace.get("blocked"): return "blocked"
+    if trace.get("error") or trace.get("http_status") in TRANSIENT_HTTP: return "error"
+    if fp.get("Unchanged"): return "unchanged"
+    if rating is None: return "empty"
+    return "ok" if text else "no_text"
+
+class TokenBucket:
+    """`rate` peticiones/seg sostenidas, con ráfagas de hasta `burst`."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class CircuitBreaker:
+    """
+    closed -> (CIRCUIT_THRESHOLD bloqueos seguidos) -> open -> (cooldown) -> half_open.
+    En half_open pasa una sola visita de prueba: si sale bien se cierra, si no vuelve a abrirse.
+    """
+    def __init__(self, threshold=CIRCUIT_THRESHOLD, cooldown=CIRCUIT_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None: return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed": return True
+        if state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        """Error transitorio: no cuenta como bloqueo, pero libera la visita de prueba."""
+        self._probing = False
+
+    def record_block(self):
+        """Devuelve True si este bloqueo abre el circuito (o lo reabre tras la prueba)."""
+        self.failures += 1
+        was_probe, self._probing = self._probing, False
+        if self.opened_at is None and self.failures >= self.threshold:
+            self.trips += 1
+            self.opened_at = time.monotonic()
+            return True
+        if was_probe:
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+class ScrapePolicy:
+    """Cubos y cortacircuitos por plataforma. Vive en el pool: se comparte entre syncs del proceso."""
+    def __init__(self, rate_limits=None, max_attempts=SCRAPE_MAX_ATTEMPTS):
+        self.rate_limits = {**SCRAPE_RATE_LIMITS, **(rate_limits or {})}
+        self.max_attempts = max(1, max_attempts)
+        self.buckets = {}
+        self.breakers = {}
+
+    def bucket(self, platform):
+        if platform not in self.buckets:
+            self.buckets[platform] = TokenBucket(*self.rate_limits.get(platform, SCRAPE_DEFAULT_RATE))
+        return self.buckets[platform]
+
+    def breaker(self, platform):
+        return self.breakers.setdefault(platform, CircuitBreaker())
+
+    @staticmethod
+    def backoff(attempt):
+        base, cap = SCRAPE_BACKOFF
+        return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+    async def visit(self, name, platform, url, fetch, log=None, should_stop=None, slot=contextlib.nullcontext):
+        """
+        Visita una URL con la política aplicada. fetch(trace) hace un intento y devuelve
+        (rating, text, reviews, fingerprint). slot() es el hueco de concurrencia (semáforos)
+        que se ocupa durante cada intento, no durante el backoff.
+        Devuelve (rating, text, reviews, fingerprint, outcome), donde outcome es la fila del informe por URL.
+        Si should_stop() se activa antes de un intento, outcome["Outcome"] queda en None.
+        """
+        breaker = self.breaker(platform)
+        outcome = {"Name": name, "Platform": platform, "URL": url, "Outcome": None,
+                   "Attempts": 0, "Seconds": 0.0, "HTTP": None, "Detail": None}
+        rating, text, reviews, fp = None, None, [], {}
+        t0 = time.perf_counter()
+        for attempt in range(1, self.max_attempts + 1):
+            trace = {}
+            async with slot():
+                if should_stop and should_stop():
+                    outcome["Outcome"] = None
+                    break
+                # Se mira al conseguir hueco: el circuito pudo abrirse mientras esperaba
+                if not breaker.allow():
+                    outcome.update({"Outcome": "circuit_open", "Detail": f"{platform} en pausa por captchas"})
+                    break
+                await self.bucket(platform).acquire()
+                try:
+                    rating, text, reviews, fp = await fetch(trace)
+                except Exception as e:  # p.ej. el navegador no arranca: cuenta como transitorio
+                    rating, text, reviews, fp = None, None, [], {}
+                    trace["error"] = str(e).splitlines()[0][:200] if str(e) else type(e).__name__
+            kind = classify_scrape(rating, text, fp, trace)
+            outcome.update({"Outcome": kind, "Attempts": attempt, "HTTP": trace.get("http_status"),
+                            "Detail": trace.get("error") or trace.get("text_source")})
+            if kind == "blocked":
+                if breaker.record_block() and log:
+                    log(f"⛔ {platform}: captchas seguidos, circuito abierto {CIRCUIT_COOLDOWN // 60} min")
+                break
+            if kind != "error":
+                breaker.record_success()
+                break
+            breaker.record_failure()
+            if attempt == self.max_attempts or (should_stop and should_stop()): break
+            delay = self.backoff(attempt)
+            if log: log(f"🔁 {name} ({platform}): reintento {attempt + 1}/{self.max_attempts} en {delay:.1f}s")
+            await asyncio.sleep(delay)
+        outcome["Seconds"] = round(time.perf_counter() - t0, 2)
+        return rating, text, reviews, fp, outcome
+
+    def status(self):
+        return {
+            plat: {
+                "Circuito": self.breaker(plat).state,
+                "Bloqueos seguidos": self.breaker(plat).failures,
+                "Aperturas": self.breaker(plat).trips,
+                "Límite": f"{rate}/s (ráfaga {burst})",
+            }
+            for plat, (rate, burst) in self.rate_limits.items()
+        }
+
+def outcome_report(outcomes):
+    """Informe por URL como DataFrame (columna Resultado legible)."""
+    df = pd.DataFrame(outcomes, columns=["Name", "Platform", "URL", "Outcome", "Attempts", "Seconds", "HTTP", "Detail"])
+    df.insert(3, "Resultado", df["Outcome"].map(SCRAPE_OUTCOMES).fillna(df["Outcome"]))
+    return df.drop(columns=["Outcome"])
 
-                # Intento 1: Tarjetas Estructuradas (Modal o Página)
-                airbnb_cards = page.locator('div[data-testid="pdp-reviews-review-item"], div[data-review-id], div._1gjypya, div[role="listitem"]').all()
+# --- POOL DE NAVEGADOR PERSISTENTE ---
+# Un único Chromium por proceso, compartido por todas las sesiones y reruns.
+# Playwright no se puede usar desde varios hilos, así que el pool vive en su propio
+# hilo con un event loop asyncio; el resto de la app le manda corrutinas.
+BROWSER_RECYCLE_AFTER = 25  # Navegaciones por contexto antes de recrearlo (memoria/cookies)
 
-                for card in airbnb_cards:
-                    try:
-                        name = card.locator("h2, h3, div[font-weight='bold']").first.inner_text().strip()
-                    except: name = "Anónimo"
-                    
-                    try:
-                        body = card.locator("span[data-testid='pdp-reviews-review-item-text'], div[dir='ltr']").first.inner_text().strip()
-                    except: body = ""
+class BrowserPool:
+    def __init__(self, size=SCRAPE_CONCURRENCY, recycle_after=BROWSER_RECYCLE_AFTER):
+        self.size = max(1, size)
+        self.recycle_after = recycle_after
+        self.launches = 0
+        self.navigations = 0
+        self._pw = None
+        self._browser = None
+        self._generation = 0
+        self._contexts = None  # asyncio.Queue de contextos libres
+        self._uses = {}        # contexto -> navegaciones hechas
+        self._lock = asyncio.Lock()
+        self._closed = False
+        self.blocker = RequestBlocker()
+        self.policy = ScrapePolicy()
+        self.loop = asyncio.new_event_loop()  # En Windows ya es Proactor (policy de arriba)
+        self._thread = threading.Thread(target=self.loop.run_forever, name="browser-pool", daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)
 
-                    if body and len(body) > 10:
-                        reviews_data.append(f"👤 {name}: {body}")
+    def submit(self, coro):
+        """Programa una corrutina en el hilo del pool. Devuelve un concurrent Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
 
-                # Intento 2: Fallback Texto plano (div[dir='ltr'])
-                if not reviews_data:
-                    candidates = page.locator("div[dir='ltr']").all_inner_texts()
-                    seen = set()
-                    for t in candidates:
-                         t_clean = t.strip()
-                         if t_clean in seen: continue
-                         if len(t_clean) < 15: continue
-                         if "Traducir" in t_clean or "Mostrar más" in t_clean or "Evaluación" in t_clean: continue
-                         
-                         reviews_data.append(f"💬 {t_clean}")
-                         seen.add(t_clean)
-                
-                # Output Final Airbnb
-                if reviews_data:
-                    final_reviews = reviews_data # Sin límite
-                    combined_text = " || ".join(final_reviews)
-                    st.write(f"✅ Airbnb Comentarios ({len(final_reviews)}): *{combined_text[:200]}...*")
-                    text = combined_text
-                else:
-                     st.write(f"⚠️ Airbnb: No se encontraron comentarios. (URL: {url})")
+    def run(self, coro, timeout=None):
+        """Ejecuta una corrutina en el pool y espera el resultado (desde cualquier hilo)."""
+        return self.submit(coro).result(timeout)
 
-            except Exception as e:
-                print(f"Airbnb Scrape error: {e}")
-        elif platform_type == "Booking":
-            # --- BOOKING (Click + Silent Scrape) ---
-            try:
-                # Intentamos clicar en la pestaña de comentarios (varios selectores)
-                clicked = False
-                for sel in ["[data-testid='Property-Header-Nav-Tab-Trigger-reviews']", "#reviews-tab", "a#show_reviews_tab"]:
-                    try:
-                        if page.locator(sel).first.is_visible():
-                            page.locator(sel).first.click(timeout=1000)
-                            clicked = True
-                            break
-                    except: pass
-                
-                # Si fallan los selectores técnicos, probamos por texto (idiomas comunes)
-                if not clicked:
-                    try:
-                        page.get_by_text(re.compile(r"(Comentarios|Reviews|Opiniones|Huéspedes)", re.IGNORECASE)).first.click(timeout=1000)
-                    except: pass
-                
-                # Damos tiempo a que cargue (Booking es lento/lazy)
-                page.wait_for_timeout(2000)
-            except: pass
-            
-            # Rating logic...
+    def is_healthy(self):
+        return self._browser is not None and self._browser.is_connected()
+
+    def status(self):
+        return {
+            "Navegador activo": self.is_healthy(),
+            "Arranques": self.launches,
+            "Navegaciones": self.navigations,
+            "Contextos libres": self._contexts.qsize() if self._contexts else 0,
+            "Tamaño pool": self.size,
+            "Red": self.blocker.summary(),
+            "Política": self.policy.status(),
+        }
+
+    async def _new_context(self):
+        ctx = await self._browser.new_context(viewport=DESKTOP_VIEWPORT, user_agent=DESKTOP_UA)
+        self._uses[ctx] = 0
+        return ctx
+
+    async def _ensure_browser(self):
+        # Health-check: si el navegador murió (OOM, crash) se relanza con contextos nuevos
+        async with self._lock:
+            if self.is_healthy(): return
+            await self._close_browser()
+            if self._pw is None:
+                self._pw = await async_playwright().start()
             try:
-                candidates_score = ['div[data-testid="review-score-component"] div', '.ac4a7896c7']
-                for sel in candidates_score:
-                    loc = page.locator(sel).first
-                    if loc.count() > 0:
-                        val = re.search(r"(\d+[,.]\d+)", loc.inner_text())
-                        if val:
-                             rating = float(val.group(1).replace(',', '.'))
-                             break
+                self._browser = await self._pw.chromium.launch(headless=True, args=CHROMIUM_ARGS)
+            except Exception:
+                _install_chromium()
+                self._browser = await self._pw.chromium.launch(headless=True, args=CHROMIUM_ARGS)
+            self.launches += 1
+            self._generation += 1
+            self._uses = {}
+            # Quien espere en la cola vieja no recibirá ya ningún contexto: se le despierta
+            if self._contexts is not None: self._contexts.put_nowait(None)
+            self._contexts = asyncio.Queue()
+            for _ in range(self.size):
+                self._contexts.put_nowait(await self._new_context())
+
+    async def _close_browser(self):
+        if self._browser is not None:
+            try: await self._browser.close()
             except: pass
-            
-            # Texto logic...
-            try:
-                IGNORE_B = [
-                    "Tipo de alojamiento", "Número de personas", "Buscar", "Ver disponibilidad",
-                    "Gestionado por", "Puntuación de los comentarios", "Entrada Desde", "Salida Hasta",
-                    "Condiciones sobre", "política de cancelación", "cancelación", "Información del alojamiento",
-                    "Vivienda", "Beachfront", "Apartamento", "Apartment",
-                    "Ubicación excelente", "Ver mapa", "Atracciones turísticas",
-                    "Preguntas frecuentes", "Lo que más gustó a quienes",
-                    "¿Cuántas personas", "pueden dormir", "se permiten mascotas", "hay cuna",
-                    "aparcar", "desayunos", "restaurante",
-                    "Información legal", "gestiona, autoriza o representa", "Esta etiqueta no",
-                    "despedidas de soltero", "celebrar fiestas", "normas de la casa",
-                    "precio de las cunas", "pagar por separado", "precio total",
-                    "¿Qué hay cerca?", "lugares de interés", "Aeropuerto", "cafeterías",
-                    "¿Cuánto cuesta alojarse", "¿Qué se puede hacer",
-                    "Condiciones para estancias", "alojar niños", "de cualquier edad",
-                    "Transporte público", "Tren", "Metro", "autobús",
-                    "algunas opciones de alojamiento", "Encontrarás más información",
-                    "Los precios en", "pueden variar en función",
-                    "¿Cómo lo estamos haciendo?", "Me resulta fácil", "opción que necesito"
-                ]
-                
-                # Intentamos coger bloques de texto en la sección de reviews
-                # ESTRATEGIA: La clásica que funcionaba. Selectores de texto + Filtrado.
-                candidates = page.locator("""
-                    [data-testid='review-subtext'], 
-                    [data-testid='featured-review-text'], 
-                    [data-testid='review-text'],
-                    [data-testid='review-title'],
-                    .c-review__body,
-                    .c-review__title
-                """).all_inner_texts()
-                
-                if not candidates:
-                    candidates = page.locator("""
-                        div[data-testid='property-section-reviews'] div, 
-                        ul[data-testid='reviews-list'] li div,
-                        .c-review-block,
-                        .review_list_new_item_block
-                    """).all_inner_texts()
-
-                valid_texts = []
-                seen = set() # Deduplicación
-                for t in candidates:
-                    t_clean = t.strip()
-                    if t_clean in seen: continue
-                    
-                    # 1. Filtro de Longitud
-                    if len(t_clean) < 15: continue
-                    # 2. Filtro de "Basura Conocida"
-                    if any(bad.lower() in t_clean.lower() for bad in IGNORE_B): continue
-                    
-                    # 3. Filtros extra
-                    if "?" in t_clean and len(t_clean) < 100: continue 
-                    if "m²" in t_clean and "cocina" in t_clean.lower(): continue
-                    
-                    valid_texts.append(t_clean)
-                    seen.add(t_clean)
-                
-                if valid_texts:
-                    # Ordenamos por longitud para que las reviews largas salgan primero (suelen ser las mejores)
-                    # valid_texts.sort(key=len, reverse=True) -> El usuario prefiere orden natural
-                    # Sin límite, todos los que pillemos
-                    text = " || ".join(valid_texts)
-                    st.write(f"✅ Booking Comentarios detectados ({len(valid_texts)}): *{text[:100]}...*")
+        self._browser = None
 
-            except Exception: pass
-        
-        if not text:
-            # text = "Comentario no detectado."
-            st.warning(f"❌ Sin texto: {url}")
-            
-        return rating, text
-        
-    except Exception as e:
-        st.error(f"🔥 Error scraping {url}: {e}")
-        return None, None
+    @contextlib.asynccontextmanager
+    async def page(self, platform=None):
+        """
+        Presta una pestaña nueva de un contexto caliente; al salir devuelve el contexto.
+        Con plataforma, instala el perfil de bloqueo de red (NETWORK_BLOCKING).
+        """
+        while True:
+            await self._ensure_browser()
+            generation, contexts = self._generation, self._contexts
+            ctx = await contexts.get()
+            if ctx is not None and generation == self._generation: break
+            # None: relanzado mientras se esperaba (o contexto perdido). Se pasa el aviso al
+            # siguiente que espere en esta cola y se vuelve a pedir, ya con el navegador nuevo
+            contexts.put_nowait(None)
+        page = None
+        try:
+            page = await ctx.new_page()
+            if NETWORK_BLOCKING and platform in BLOCK_PROFILES:
+                await page.route("**/*", self.blocker.route_handler(platform))
+            yield page
+        finally:
+            if page is not None:
+                try: await page.close()
+                except: pass
+            self.navigations += 1
+            self._uses[ctx] = self._uses.get(ctx, 0) + 1
+            if generation != self._generation:
+                # El navegador se relanzó mientras estaba prestado: el contexto ya no vale
+                self._uses.pop(ctx, None)
+            elif self._uses[ctx] >= self.recycle_after or not self.is_healthy():
+                self._uses.pop(ctx, None)
+                try: await ctx.close()
+                except: pass
+                try: ctx = await self._new_context()
+                except Exception:
+                    ctx = None
+                    await self._close_browser()  # El próximo préstamo relanzará
+                contexts.put_nowait(ctx)  # None si falló: despierta a quien espere (relanzará)
+            else:
+                contexts.put_nowait(ctx)
 
-def scrape_data_sync(accommodations_list):
-    results = []
-    with sync_playwright() as p:
+    @contextlib.asynccontextmanager
+    async def isolated_page(self, platform=None, record_har=None, replay_har=None):
+        """
+        Pestaña en un contexto desechable, fuera del pool (grabar/reproducir HAR).
+        El HAR grabado se escribe al cerrar el contexto.
+        """
+        await self._ensure_browser()
+        kwargs = {"viewport": DESKTOP_VIEWPORT, "user_agent": DESKTOP_UA}
+        if record_har: kwargs.update(record_har_path=record_har, record_har_content="embed")
+        ctx = await self._browser.new_context(**kwargs)
         try:
-            browser = p.chromium.launch(headless=True, args=["--no-sandbox", "--disable-dev-shm-usage"])
-        except Exception as e:
-            st.warning(f"⚠️ Primer inicio en Nube: Instalando navegador... (Puede tardar 1 min)")
-            import subprocess
-            import sys
-            try:
-                subprocess.run([sys.executable, "-m", "playwright", "install", "chromium"], check=True)
-                browser = p.chromium.launch(headless=True, args=["--no-sandbox", "--disable-dev-shm-usage"])
-            except Exception as e2:
-                st.error(f"❌ Error fatal instalando navegador: {e2}")
-                return []
+            if replay_har:
+                # Sin red: lo que no esté grabado se aborta
+                await ctx.route_from_har(replay_har, not_found="abort")
+            page = await ctx.new_page()
+            if NETWORK_BLOCKING and platform in BLOCK_PROFILES:
+                await page.route("**/*", self.blocker.route_handler(platform))
+            yield page
+        finally:
+            try: await ctx.close()
+            except: pass
 
-        # Simular Desktop real para evitar selectores móviles ocultos
-        page = browser.new_page(viewport={'width': 1920, 'height': 1080})
-        page.set_extra_http_headers({
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-        })
+    async def _shutdown(self):
+        await self._close_browser()
+        if self._pw is not None:
+            try: await self._pw.stop()
+            except: pass
+            self._pw = None
 
-        progress_text = "Sincronizando notas..."
-        my_bar = st.progress(0, text=progress_text)
+    def shutdown(self):
+        """Cierre limpio (atexit o botón de Configuración)."""
+        if self._closed or not self.loop.is_running(): return
+        self._closed = True
+        try: self.run(self._shutdown(), timeout=15)
+        except Exception as e: print(f"Error cerrando navegador: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
 
-        tasks = []
-        for acc in accommodations_list:
-            if acc.get("airbnb"): tasks.append((acc["name"], "Airbnb", acc["airbnb"]))
-            if acc.get("booking"): tasks.append((acc["name"], "Booking", acc["booking"]))
-            
-        total_tasks = len(tasks)
-        
-        for i, (name, platform, url) in enumerate(tasks):
-            # Update Progress BEFORE work starts
-            my_bar.progress(i / total_tasks, text=f"🔎 Procesando: {name} ({platform})...")
-            
-            rating, text = get_listing_data(page, url, platform)
-            if rating is not None:
-                results.append({
-                    "Date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "Platform": platform,
-                    "Name": name,
-                    "URL": url,
-                    "Rating": rating,
-                    "Text": text
-                })
-            else:
-                pass 
-                
-            # Update to next tick
-            my_bar.progress((i + 1) / total_tasks)
+@st.cache_resource(show_spinner=False)
+def get_browser_pool():
+    """Pool de navegador compartido por todo el proceso de Streamlit."""
+    return BrowserPool()
+
+async def scrape_data_async(accommodations_list, concurrency=SCRAPE_CONCURRENCY, platform_limits=None, on_progress=None, log=None, fingerprints=None,
+                            skip_urls=None, should_stop=None, on_result=None):
+    """
+    Motor asíncrono sobre el pool de navegador (debe correr en el loop del pool).
+    - concurrency: nº máximo de pestañas abiertas a la vez (1 = secuencial).
+    - platform_limits: máximo simultáneo por plataforma (por defecto SCRAPE_PLATFORM_LIMITS).
+    - fingerprints: huellas por URL de la última sync (modo incremental). Se actualizan
+      in situ; las fichas sin cambios no generan registro, solo su fecha de chequeo.
+    - skip_urls / should_stop / on_result: ganchos del trabajo en segundo plano (reanudar,
+      cancelar y publicar cada ficha terminada: on_result(name, platform, url, record, outcome)).
+    Cada visita pasa por pool.policy (límite por plataforma, reintentos, cortacircuitos);
+    outcome es su fila del informe por URL.
+    Devuelve los mismos registros que el modo secuencial, en el mismo orden.
+    """
+    pool = get_browser_pool()
+    tasks = [t for t in _build_scrape_tasks(accommodations_list) if not skip_urls or t[2] not in skip_urls]
+    if not tasks: return []
 
-        browser.close()
-        my_bar.empty()
-    return results
+    limits = {**SCRAPE_PLATFORM_LIMITS, **(platform_limits or {})}
+    global_sem = asyncio.Semaphore(max(1, concurrency))
+    platform_sems = {plat: asyncio.Semaphore(max(1, n)) for plat, n in limits.items()}
+    results = [None] * len(tasks)
+    done = 0
 
-def get_reviews_for_listing(url, platform):
+    async def _worker(i, name, platform, url):
+        nonlocal done
+        sem = platform_sems.setdefault(platform, asyncio.Semaphore(max(1, concurrency)))
+        previous_fp = fingerprints.get(url) if fingerprints is not None else None
+
+        @contextlib.asynccontextmanager
+        async def _slot():
+            async with global_sem, sem:
+                yield
+
+        async def _fetch(trace):
+            async with pool.page(platform) as page:
+                return await get_listing_data(page, url, platform, log=log, previous_fp=previous_fp, trace=trace)
+
+        rating, text, reviews, fp, outcome = await pool.policy.visit(name, platform, url, _fetch, log=log, should_stop=should_stop, slot=_slot)
+        if outcome["Outcome"] is None: return  # Cancelado antes de visitarla: se hará al reanudar
+        if should_stop and should_stop() and outcome["Outcome"] == "error": return
+
+        now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if fingerprints is not None and fp.get("Unchanged"):
+            fingerprints[url] = {**previous_fp, "Checked": now_str}
+        elif fingerprints is not None and rating is not None and (text or reviews or fp.get("Reviews") == 0):
+            # Solo con la extracción completa: si las reseñas fallaron, la próxima sync la repite
+            fingerprints[url] = {"Reviews": fp.get("Reviews"), "Rating": fp.get("Rating"), "Checked": now_str, "Changed": now_str}
+
+        if rating is not None and not fp.get("Unchanged"):
+            results[i] = {
+                "Date": now_str,
+                "Platform": platform,
+                "Name": name,
+                "URL": url,
+                "Rating": rating,
+                "Reviews": listing_review_items(text, reviews),
+            }
+        done += 1
+        if on_result: on_result(name, platform, url, results[i], outcome)
+        if on_progress: on_progress(done, len(tasks), name, platform)
+
+    net_before = pool.blocker.snapshot()
+    await asyncio.gather(*(_worker(i, *t) for i, t in enumerate(tasks)))
+    net_after = pool.blocker.snapshot()
+    if log and net_after["blocked"] > net_before["blocked"]:
+        saved_mb = (net_after["bytes_saved"] - net_before["bytes_saved"]) / 1_048_576
+        log(f"🛡️ Red: {net_after['blocked'] - net_before['blocked']} peticiones bloqueadas (~{saved_mb:.1f} MB ahorrados)")
+    return [r for r in results if r is not None]
+
+async def _get_reviews_for_listing_async(url, platform):
     reviews = []
     debug_log = []
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
-        page.set_extra_http_headers({
-             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36"
-        })
+    async with get_browser_pool().page(platform) as page:
+        capture = ReviewCapture(platform).attach(page)
         try:
-            page.goto(url, timeout=60000)
-            page.wait_for_timeout(4000)
+            await page.goto(url, timeout=60000)
+            await page.wait_for_timeout(4000)
             
             if platform == "Airbnb":
                 try:
                     btn = page.locator('[data-testid="pdp-show-all-reviews-button"]').first
-                    if btn.count() > 0:
-                        btn.evaluate("el => el.click()")
+                    if await btn.count() > 0:
+                        await btn.evaluate("el => el.click()")
                     else:
-                        buttons = (page.locator("button")
+                        buttons = await (page.locator("button")
                                    .filter(has_text=re.compile(r"evaluaci|review|opinio", re.IGNORECASE))
                                    .all())
                         for b in buttons:
-                            if len(b.inner_text()) < 50 and re.search(r"\d+", b.inner_text()):
-                                b.evaluate("el => el.click()")
+                            b_text = await b.inner_text()
+                            if len(b_text) < 50 and re.search(r"\d+", b_text):
+                                await b.evaluate("el => el.click()")
                                 break
                 except Exception as e:
                     debug_log.append(f"Airbnb click error: {e}")
 
-                page.wait_for_timeout(3000)
+                await page.wait_for_timeout(3000)
+                await capture.wait(page)
 
                 selectors = ['[data-review-id]', 'span[class*="ll4r2nl"]', 'div.r1are2x1']
-                reviews_found = []
-                for sel in selectors:
-                    elements = page.locator(sel).all()
-                    if elements:
-                        for el in elements[:50]:
-                            text = el.inner_text()
-                            if len(text) > 30 and text not in reviews_found:
-                                reviews_found.append(text)
-                        if reviews_found: break
+                reviews_found = capture.as_texts()[:50]
+                if not reviews_found:
+                    # Todas las tarjetas en una sola llamada (primer selector con resultados)
+                    _sel, cards = await extract_review_cards(page, "Airbnb", selectors)
+                    for c in cards[:50]:
+                        text = c["Raw"]
+                        if len(text) > 30 and text not in reviews_found:
+                            reviews_found.append(text)
                 reviews = reviews_found
 
             elif platform == "Booking":
                 try:
                     btn = page.locator('[data-testid="read-all-actionable"]').first
-                    if btn.count() > 0:
-                        btn.evaluate("el => el.click()")
+                    if await btn.count() > 0:
+                        await btn.evaluate("el => el.click()")
                     else:
                          btn_text = page.locator("button").filter(has_text=re.compile(r"Leer todos|See all", re.IGNORECASE)).first
-                         if btn_text.count() > 0:
-                             btn_text.evaluate("el => el.click()")
+                         if await btn_text.count() > 0:
+                             await btn_text.evaluate("el => el.click()")
                 except Exception as e:
                     debug_log.append(f"Booking click error: {e}")
 
-                page.wait_for_timeout(3000)
+                await page.wait_for_timeout(3000)
+                await capture.wait(page)
                 
-                selectors = ['[data-testid="review-card"]', 'li.review_item']
-                reviews_found = []
-                for sel in selectors:
-                    cards = page.locator(sel).all()
-                    if cards:
-                        for c in cards[:50]:
-                            # Intentar sacar la nota específica
-                            score_text = ""
-                            try:
-                                score_el = c.locator('[data-testid="review-score"]').first
-                                if score_el.count() > 0:
-                                    score_text = f"⭐ {score_el.inner_text()} | "
-                            except: pass
-
-                            txt = c.inner_text()
-                            # Filtrado menos agresivo para no borrar cosas útiles
-                            lines = [l for l in txt.split('\n') if len(l) > 2] 
-                            clean = score_text + "\n".join(lines)
-                            
-                            if len(clean) > 10:
-                                reviews_found.append(clean)
-                        if reviews_found: break
+                reviews_found = capture.as_texts()[:50]
+                if not reviews_found:
+                    _sel, cards = await extract_review_cards(page, "Booking", BOOKING_CARD_SEL)
+                    for c in cards[:50]:
+                        # Nota específica de la tarjeta (ya viene en la misma llamada)
+                        score_text = f"⭐ {c['ScoreText']} | " if c["ScoreText"] else ""
+
+                        # Filtrado menos agresivo para no borrar cosas útiles
+                        lines = [l for l in c["Raw"].split('\n') if len(l) > 2]
+                        clean = score_text + "\n".join(lines)
+
+                        if len(clean) > 10:
+                            reviews_found.append(clean)
                 reviews = reviews_found
                 
         except Exception as e:
             debug_log.append(str(e))
         
-        try:
-            browser.close()
-        except: pass
-        
     return reviews, debug_log
 
+def get_reviews_for_listing(url, platform):
+    """Consulta bajo demanda: reutiliza el navegador caliente (solo cuesta la carga de página)."""
+    try:
+        return get_browser_pool().run(_get_reviews_for_listing_async(url, platform), timeout=120)
+    except Exception as e:
+        return [], [str(e)]
+
+
+# --- GRABACIÓN / REPRODUCCIÓN / BENCHMARK DEL SCRAPER (offline) ---
+# record:   visita las fichas reales y guarda HAR + HTML + payloads JSON de reseñas.
+# replay:   repite la extracción sirviendo todo desde el HAR (sin red).
+# bench:    latencia por ficha, nº de reseñas extraídas y qué selector acertó.
+# fixtures: vuelve a parsear los payloads JSON grabados, sin navegador.
+snapshots_dir = "scraper_snapshots"
+
+def _snapshot_paths(name, platform):
+    slug = re.sub(r"[^\w]+", "_", f"{name}_{platform}".lower()).strip("_")
+    base = os.path.join(snapshots_dir, slug)
+    return {"har": base + ".har", "html": base + ".html", "meta": base + ".json", "reviews": base + ".reviews.json"}
+
+async def _bench_listing(pool, name, platform, url, mode):
+    paths = _snapshot_paths(name, platform)
+    row = {"Name": name, "Platform": platform, "Latency (s)": None, "Rating": None, "Reviews": 0, "Texts": 0,
+           "Rating sel": None, "Text source": None, "JSON payloads": 0, "Error": None}
+    if mode == "replay" and not os.path.exists(paths["har"]):
+        row["Error"] = "sin grabación"
+        return row
+
+    if mode == "record": page_cm = pool.isolated_page(platform, record_har=paths["har"])
+    elif mode == "replay": page_cm = pool.isolated_page(platform, replay_har=paths["har"])
+    else: page_cm = pool.page(platform)
+
+    trace = {}
+    capture = ReviewCapture(platform, keep_raw=(mode == "record"))
+    try:
+        async with page_cm as page:
+            t0 = time.perf_counter()
+            rating, text, reviews, _fp = await get_listing_data(page, url, platform, log=lambda m: None, trace=trace, capture=capture)
+            row["Latency (s)"] = round(time.perf_counter() - t0, 2)
+            if mode == "record":
+                with open(paths["html"], "w", encoding="utf-8") as f:
+                    f.write(await page.content())
+    except Exception as e:
+        row["Error"] = str(e)[:80]
+        return row
+
+    row.update({
+        "Rating": rating,
+        "Reviews": len(reviews),
+        "Texts": len(text.split(" || ")) if text else 0,
+        "Rating sel": trace.get("rating_sel"),
+        "Text source": trace.get("text_source"),
+        "JSON payloads": capture.payloads,
+    })
+    if mode == "record":
+        with open(paths["meta"], "w", encoding="utf-8") as f:
+            json.dump({"name": name, "platform": platform, "url": url, "recorded": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                       "rating": rating, "reviews": len(reviews), "text_source": row["Text source"]}, f, indent=4, ensure_ascii=False)
+        with open(paths["reviews"], "w", encoding="utf-8") as f:
+            json.dump({"platform": platform, "url": url, "payloads": capture.raw}, f, ensure_ascii=False)
+    return row
+
+async def run_scraper_bench(accommodations_list, mode="replay", concurrency=1, repeat=1, on_row=None):
+    """Ejecuta record/replay/live sobre las fichas y devuelve una fila de métricas por visita."""
+    pool = get_browser_pool()
+    if mode == "record": os.makedirs(snapshots_dir, exist_ok=True)
+    sem = asyncio.Semaphore(max(1, concurrency))
+    tasks = _build_scrape_tasks(accommodations_list) * max(1, repeat)
+
+    async def _one(name, platform, url):
+        async with sem:
+            row = await _bench_listing(pool, name, platform, url, mode)
+        if on_row: on_row(row)
+        return row
+
+    return await asyncio.gather(*(_one(*t) for t in tasks))
+
+def print_bench_report(rows, wall_time):
+    df = pd.DataFrame(rows)
+    print(df.to_string(index=False))
+    lat = df["Latency (s)"].dropna()
+    print(f"\nVisitas: {len(df)} · Errores: {df['Error'].notna().sum()} · Tiempo total: {wall_time:.1f}s")
+    if not lat.empty:
+        print(f"Latencia por ficha: media {lat.mean():.2f}s · p50 {lat.median():.2f}s · p95 {lat.quantile(0.95):.2f}s · máx {lat.max():.2f}s")
+    print(f"Reseñas extraídas: {int(df['Reviews'].sum())} estructuradas · {int(df['Texts'].sum())} textos")
+    print("\nAciertos de selectores (texto):")
+    print(df["Text source"].fillna("— sin texto —").value_counts().to_string())
+    print("\nAciertos de selectores (nota):")
+    print(df["Rating sel"].fillna("— sin nota —").value_counts().to_string())
+    print(f"\nRed: {get_browser_pool().blocker.summary()}")
+
+def load_review_fixture(path):
+    """Reseñas de un .reviews.json grabado, pasadas por ReviewCapture como en una visita real."""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    cap = ReviewCapture(data["platform"])
+    for p in data.get("payloads") or []: cap.feed(p["body"])
+    return cap
+
+def check_review_fixtures(directory=snapshots_dir):
+    """
+    Parsea offline los payloads JSON grabados (prueba de los parsers sin navegador). Falla si
+    una grabación con payloads no da ninguna reseña completa (cambió el formato de la API).
+    Los payloads de ejemplo, ya saneados, están en tests/fixtures (los tests comprueban campo a campo).
+    """
+    import glob
+    paths = sorted(glob.glob(os.path.join(directory, "*.reviews.json")))
+    if not paths: print(f"No hay payloads grabados en {directory}/ (usa 'record')."); return 1
+    failed = 0
+    for path in paths:
+        cap = load_review_fixture(path)
+        broken = [r for r in cap.reviews if not (r["Text"] and r["Date"] and r["Rating"] is not None)]
+        ok = cap.payloads == 0 or (cap.reviews and not broken)
+        failed += not ok
+        print(f"{'✅' if ok else '❌'} {os.path.basename(path)}: {cap.payloads} payloads -> {len(cap.reviews)} reseñas"
+              + (f" ({len(broken)} sin texto, fecha o nota)" if broken else ""))
+    return 1 if failed else 0
+
+# --- SINCRONIZACIÓN EN SEGUNDO PLANO ---
+# La sync corre en un hilo propio, no dentro del script de Streamlit: cerrar la pestaña,
+# un rerun o un timeout del websocket ya no la matan. Hay un único trabajo por proceso
+# (compartido por todos los usuarios) y su estado se guarda en sync_job.json.
+# Cada ficha terminada se apunta además en sync_journal.jsonl (con fsync) antes de seguir:
+# si el contenedor muere a mitad, al arrancar se recupera lo hecho y se reanuda desde ahí.
+sync_job_file = "sync_job.json"
+sync_journal_file = "sync_journal.jsonl"
+SYNC_JOB_LOG_LINES = 60
+
+def load_job_record():
+    if os.path.exists(sync_job_file):
+        with open(sync_job_file, "r") as f:
+            try: return json.load(f)
+            except: return {}
+    return {}
+
+def save_job_record(data):
+    tmp = sync_job_file + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=4, default=str)
+    os.replace(tmp, sync_job_file)
+
+def append_journal(entry):
+    """Añade una línea al diario de la sync y la fuerza a disco."""
+    with open(sync_journal_file, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, default=str, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def load_journal(job_id):
+    """Líneas del diario de un trabajo (ignora una última línea cortada a medias)."""
+    entries = []
+    if os.path.exists(sync_journal_file):
+        with open(sync_journal_file, "r", encoding="utf-8") as f:
+            for line in f:
+                try: entry = json.loads(line)
+                except: continue
+                if entry.get("job") == job_id: entries.append(entry)
+    return entries
+
+def reset_journal():
+    if os.path.exists(sync_journal_file): os.remove(sync_journal_file)
+
+def listing_review_items(text, reviews):
+    """
+    Reseñas sueltas de una ficha: los textos unidos con " || " (los mismos que se analizan)
+    con autor, fecha y nota de las reseñas estructuradas (JSON / tarjetas) si cuadran una a una.
+    """
+    texts = [t.strip() for t in text.split(" || ")] if text else []
+    if len(reviews or []) != len(texts): reviews = [{}] * len(texts)
+    return [{"Text": t, "Reviewer": r.get("Reviewer"), "Date": r.get("Date"), "Rating": r.get("Rating")}
+            for t, r in zip(texts, reviews) if t]
+
+def merge_scraped_results(new_data):
+    """
+    Guarda una sync (Nube + Local) sin reescribir el histórico: la nota de cada ficha va a
+    rating_snapshots y, de sus reseñas, solo las que aún no estaban en reviews.
+    """
+    df_new = pd.DataFrame(new_data)
+    snapshots = df_new[["Date", "Platform", "Name", "URL", "Rating"]].copy()
+    snapshots["Hash"] = review_hashes(snapshots)
+    queue_snapshot_rows(snapshots)
+
+    items = []
+    for rec in new_data:
+        # Registros de diarios anteriores a v2: solo traen el texto unido
+        reviews = rec["Reviews"] if "Reviews" in rec else listing_review_items(rec.get("Text"), [])
+        items += [{"Platform": rec["Platform"], "Name": rec["Name"], "URL": rec["URL"], "Synced": rec["Date"], **r} for r in reviews]
+    if not items: return
+    df_items = pd.DataFrame(items)
+    df_items["Hash"] = review_keys(df_items)
+    # Guardadas antes de que el Hash llevara autor y día: la primera con esa clave antigua es ella
+    legacy = review_keys(df_items.drop(columns=["Reviewer"], errors="ignore"))
+    seen_legacy = legacy.isin(existing_review_hashes(legacy)) & ~legacy.duplicated()
+    df_items = df_items[~df_items["Hash"].isin(existing_review_hashes(df_items["Hash"])) & ~seen_legacy].drop_duplicates(subset=["Hash"])
+    if df_items.empty: return
+    # Fecha de la reseña: ISO (JSON), texto ("Hace 2 semanas", "20 de octubre de 2024") o, si no, la de la sync
+    dates = pd.to_datetime(df_items["Date"], format="ISO8601", errors="coerce")
+    dates = dates.fillna(parse_review_dates(df_items["Date"])).fillna(pd.to_datetime(df_items["Synced"]))
+    df_items["Date"] = dates
+    df_items["Rating"] = pd.to_numeric(df_items["Rating"], errors="coerce")
+    queue_review_rows(df_items.drop(columns=["Synced"]))
+
+class SyncJob:
+    """
+    Estados: running -> (cancelling ->) cancelled | done | error.
+    Si el proceso muere con el trabajo en marcha, al arrancar queda como 'interrupted'.
+    Cancelado se puede reanudar: solo se visitan las URLs que faltan.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+        self._thread = None
+        self._fingerprints = {}
+        self.record = load_job_record()
+        if self.record.get("status") in ("running", "cancelling"):
+            self.record["status"] = "interrupted"
+        if self.record.get("status") in ("interrupted", "cancelled", "error"):
+            self._recover()
+        save_job_record(self.record)
+
+    def _recover(self):
+        """Reconstruye el progreso desde el diario (fuente de verdad de las fichas hechas)."""
+        entries = load_journal(self.record.get("id"))
+        if any(e.get("event") == "merged" for e in entries):
+            # Murió tras guardar en la BD pero antes de marcarse: no repetir el guardado
+            save_fingerprints({**load_fingerprints(), **self._journal_fingerprints(entries)})
+            self.record.update({"status": "done", "current": None})
+            reset_journal()
+            return
+        done = [e for e in entries if "url" in e]
+        if not done: return
+        self.record.update({
+            "done": len(done),
+            "done_urls": [e["url"] for e in done],
+            "results": [e["record"] for e in done if e.get("record") is not None],
+            "outcomes": [e["outcome"] for e in done if e.get("outcome")],
+        })
+
+    @staticmethod
+    def _journal_fingerprints(entries):
+        return {e["url"]: e["fingerprint"] for e in entries if e.get("url") and e.get("fingerprint")}
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self.record, default=str))
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def can_resume(self):
+        return not self.is_running() and self.record.get("status") in ("cancelled", "interrupted", "error")
+
+    def start(self, accommodations_list, incremental=True, resume=False):
+        """Arranca (o reanuda) la sync. Devuelve False si ya hay una en marcha."""
+        with self._lock:
+            if self.is_running(): return False
+            now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            if resume and self.can_resume():
+                self.record.update({"status": "running", "resumed": now_str, "error": None})
+            else:
+                reset_journal()
+                self.record = {
+                    "id": datetime.now().strftime("%Y%m%d%H%M%S"),
+                    "status": "running",
+                    "started": now_str,
+                    "finished": None,
+                    "incremental": incremental,
+                    "total": len(_build_scrape_tasks(accommodations_list)),
+                    "done": 0,
+                    "done_urls": [],
+                    "results": [],
+                    "outcomes": [],
+                    "current": None,
+                    "log": [],
+                    "error": None,
+                }
+            save_job_record(self.record)
+            self._cancel.clear()
+            self._thread = threading.Thread(target=self._run, args=(accommodations_list,), name="sync-job", daemon=True)
+            self._thread.start()
+            return True
+
+    def cancel(self):
+        with self._lock:
+            if not self.is_running(): return
+            self.record["status"] = "cancelling"
+            save_job_record(self.record)
+        self._cancel.set()
+
+    def _log(self, msg):
+        with self._lock:
+            self.record["log"] = (self.record["log"] + [str(msg)])[-SYNC_JOB_LOG_LINES:]
+
+    def _on_result(self, name, platform, url, record, outcome):
+        # Primero al diario (durable): si el proceso muere justo después, esta ficha no se repite
+        append_journal({"job": self.record["id"], "url": url, "record": record, "outcome": outcome,
+                        "fingerprint": self._fingerprints.get(url)})
+        with self._lock:
+            self.record["done"] += 1
+            self.record["done_urls"].append(url)
+            self.record["current"] = f"{name} ({platform})"
+            self.record.setdefault("outcomes", []).append(outcome)
+            if record is not None:
+                self.record["results"].append(record)
+            # Progreso para la UI; las fichas y sus resultados ya están en el diario
+            save_job_record({**self.record, "done_urls": [], "results": []})
+
+    def _run(self, accommodations_list):
+        incremental = self.record.get("incremental", True)
+        fingerprints = load_fingerprints() if incremental else {}
+        self._fingerprints = fingerprints
+        try:
+            pool = get_browser_pool()
+            pool.run(scrape_data_async(
+                accommodations_list,
+                log=self._log,
+                fingerprints=fingerprints,
+                skip_urls=set(self.record["done_urls"]),
+                should_stop=self._cancel.is_set,
+                on_result=self._on_result,
+            ))
+            if self._cancel.is_set():
+                with self._lock:
+                    self.record["status"] = "cancelled"
+                    save_job_record(self.record)
+                return
+
+            results = self.record["results"]
+            if results:
+                self._log(f"💾 Guardando {len(results)} registros...")
+                merge_scraped_results(results)
+                append_journal({"job": self.record["id"], "event": "merged"})
+                stats = compact_rating_snapshots()
+                if any(stats.values()): self._log(f"🗜️ Notas antiguas resumidas: {stats}")
+            # Solo con los resultados ya guardados: una huella sin su merge saltaría la ficha
+            # en la próxima sync incremental y sus reseñas no llegarían nunca
+            if not incremental:
+                fingerprints = {**load_fingerprints(), **fingerprints}
+            # Las fichas hechas antes de una reanudación solo tienen su huella en el diario
+            save_fingerprints({**fingerprints, **self._journal_fingerprints(load_journal(self.record["id"]))})
+            with self._lock:
+                self.record.update({"status": "done", "finished": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "current": None})
+                save_job_record(self.record)
+            reset_journal()
+        except Exception as e:
+            with self._lock:
+                self.record.update({"status": "error", "error": str(e)})
+                save_job_record(self.record)
+
+@st.cache_resource(show_spinner=False)
+def get_sync_job():
+    """Trabajo de sync compartido por todas las sesiones del proceso."""
+    return SyncJob()
+
+def _sync_job_live_view(job):
+    rec = job.snapshot()
+    if rec.get("status") not in ("running", "cancelling"):
+        # Terminó mientras mirábamos: recargar toda la app para ver los datos nuevos
+        st.rerun()
+    total = rec.get("total") or 1
+    label = "⏹️ Cancelando..." if rec["status"] == "cancelling" else f"🔎 {rec.get('current') or 'Conectando con navegador...'}"
+    st.progress(min(rec.get("done", 0) / total, 1.0), text=f"{label} · {rec.get('done', 0)}/{total}")
+    c1, c2 = st.columns([1, 4])
+    if rec["status"] == "running" and c1.button("⏹️ Cancelar", key="cancel_sync_job"):
+        job.cancel()
+    with c2.expander("📜 Log de la sincronización"):
+        st.code("\n".join(rec.get("log", [])[-20:]) or "...")
+    show_outcome_report(rec.get("outcomes"))
+
+def show_outcome_report(outcomes, expanded=False):
+    """Informe por URL de la sync: recuento por resultado y tabla con lo que no fue bien."""
+    if not outcomes: return
+    df = outcome_report(outcomes)
+    counts = df["Resultado"].value_counts()
+    problems = df[~df["Resultado"].isin([SCRAPE_OUTCOMES["ok"], SCRAPE_OUTCOMES["unchanged"]])]
+    with st.expander(f"📋 Informe por URL · {' · '.join(f'{k}: {v}' for k, v in counts.items())}", expanded=expanded):
+        if problems.empty:
+            st.caption("Todas las fichas se leyeron bien.")
+        st.dataframe(
+            problems if not problems.empty else df,
+            column_config={"URL": st.column_config.LinkColumn("URL"), "Seconds": st.column_config.NumberColumn("Seg", format="%.1f")},
+            hide_index=True,
+            use_container_width=True,
+        )
+
+@st.fragment(run_every=2)
+def _sync_job_live_fragment():
+    _sync_job_live_view(get_sync_job())
+
+def show_sync_job_status():
+    """Panel del trabajo compartido: progreso en vivo (sondeo cada 2 s) o resumen del último."""
+    job = get_sync_job()
+    rec = job.snapshot()
+    status = rec.get("status")
+    if status in ("running", "cancelling"):
+        _sync_job_live_fragment()
+    elif status == "done":
+        st.caption(f"✅ Última sincronización: {rec.get('finished')} · {len(rec.get('results', []))} registros nuevos de {rec.get('total')} fichas.")
+        show_outcome_report(rec.get("outcomes"))
+    elif status in ("cancelled", "interrupted", "error"):
+        msg = {"cancelled": "⏹️ Sincronización cancelada", "interrupted": "⚠️ Sincronización interrumpida (reinicio del servidor)", "error": f"❌ Error en sincronización: {rec.get('error')}"}[status]
+        c1, c2 = st.columns([3, 1])
+        c1.warning(f"{msg} · {rec.get('done', 0)}/{rec.get('total', 0)} fichas procesadas.")
+        if c2.button("▶️ Reanudar", key="resume_sync_job", use_container_width=True):
+            job.start(accommodations, resume=True)
+            st.rerun()
+        show_outcome_report(rec.get("outcomes"))
 
 # --- SIDEBAR & NAVEGACIÓN ---
 st.sidebar.title("🏨 Monitor Alojamientos")
@@ -729,12 +3150,52 @@ if st.sidebar.button("Aplicar Filtro"):
 rows_stat = st.sidebar.empty()
 date_range_info = st.sidebar.empty()
 
+def period_cutoff():
+    """Inicio de la ventana del filtro de periodo (None = todo el histórico)."""
+    now = datetime.now()
+    if "Semana" in date_filter:
+        return now - pd.Timedelta(days=7)
+    if "Mes" in date_filter:
+        return now - pd.Timedelta(days=30)
+    if "Trimestre" in date_filter:
+        return now - pd.Timedelta(days=90)
+    if "Este Año" in date_filter:
+        return datetime(now.year, 1, 1)
+    return None
+
+def status_in_period(status):
+    """
+    listing_status con el filtro de periodo, igual que si se calculara sobre las notas
+    filtradas: solo fichas con nota en la ventana, y Delta si la anterior también cae dentro.
+    """
+    cutoff = period_cutoff()
+    prev = status["PrevRating"]
+    if cutoff is not None:
+        status = status[status["Date"] >= cutoff]
+        prev = status["PrevRating"].where(status["PrevDate"] >= cutoff)
+    return status.assign(Delta=status["Rating"] - prev)
+
+def previous_period(cutoff):
+    """Ventana anterior a la del filtro: misma duración, justo antes del corte. (inicio, fin)"""
+    return cutoff - (datetime.now() - cutoff), cutoff
+
+def window_totals(daily, start=None, end=None, by=None):
+    """
+    Sumas de un agregado diario (rating_daily, review_daily) desde start (incluido) hasta
+    end (excluido), por días completos. by: columnas por las que agrupar.
+    """
+    mask = pd.Series(True, index=daily.index)
+    if start is not None: mask &= daily["Day"] >= pd.Timestamp(start).normalize()
+    if end is not None: mask &= daily["Day"] < pd.Timestamp(end).normalize()
+    rows = daily[mask].drop(columns=["Day"])
+    return rows.groupby(by).sum(numeric_only=True) if by else rows.sum(numeric_only=True)
+
 def filter_by_date(df, date_col="Date"):
     total_rows = len(df)
     
-    # Asegurar datetime (copia para no afectar original fuera si se reusa)
-    df = df.copy()
-    df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
+    # Asegurar datetime (la instantánea ya lo trae: sin conversión ni copia)
+    if not pd.api.types.is_datetime64_any_dtype(df[date_col]):
+        df = df.assign(**{date_col: pd.to_datetime(df[date_col], errors='coerce')})
     
     # Mostrar rango real de datos (Debug para usuario)
     if not df.empty:
@@ -747,95 +3208,32 @@ def filter_by_date(df, date_col="Date"):
         rows_stat.info(f"Mostrando: {total_rows} (Todas)")
         return df
 
-    now = datetime.now()
-    
-    if "Semana" in date_filter:
-        cutoff = now - pd.Timedelta(days=7)
-    elif "Mes" in date_filter:
-        cutoff = now - pd.Timedelta(days=30)
-    elif "Trimestre" in date_filter:
-        cutoff = now - pd.Timedelta(days=90)
-    elif "Este Año" in date_filter:
-        cutoff = datetime(now.year, 1, 1)
-    else:
+    cutoff = period_cutoff()
+    if cutoff is None:
         return df
         
     filtered_df = df[df[date_col] >= cutoff]
     rows_stat.info(f"Mostrando: {len(filtered_df)} / {total_rows}")
     return filtered_df
 
-# --- CONFIGURACIÓN DE CONCEPTOS GLOBAL (Para Análisis y Categorización) ---
-CONCEPTS_DICT = {
-    "Limpieza": {
-        "pos": ["limpio", "impecable", "pulcro", "clean", "limpísimo", "brilla"],
-        "neg": ["sucio", "polvo", "mancha", "pelo", "dirty", "olor", "insecto", "cucaracha"]
-    },
-    "Ubicación": {
-        "pos": ["ubicación", "location", "cerca", "vistas", "playa", "céntrico", "situación"],
-        "neg": ["lejos", "far", "mal situado", "barrio"]
-    },
-    "Ruido/Descanso": {
-        "pos": ["silencioso", "tranquilo", "quiet", "paz", "dormir bien"],
-        "neg": ["ruido", "noise", "ralente", "obras", "fiesta", "paredes finas", "tráfico"]
-    },
-    "Cama/Confort": {
-        "pos": ["cómoda", "comfortable", "descanso", "confortable", "almohada bien"],
-        "neg": ["incómoda", "dura", "blanda", "colchón", "almohada", "dolor de espalda", "muelles"]
-    },
-    "Anfitrión/Trato": {
-        "pos": ["amable", "atento", "simpático", "host", "help", "ayuda", "rápido"],
-        "neg": ["borde", "lento", "grosero", "no contesta", "esperar"]
-    },
-    "Instalaciones": {
-        "pos": ["buen wifi", "internet rápido", "ducha buena", "presión", "bien equipado"],
-        "neg": ["wifi", "internet", "agua fría", "no funciona", "roto", "averiado", "cortes", "viejo"]
-    },
-    "Check-in/Out": {
-        "pos": ["fácil", "autónomo", "rápido", "instrucciones claras"],
-        "neg": ["llaves", "esperar", "difícil", "no encontré", "lío"]
-    }
-}
-CATEGORIES_LIST = list(CONCEPTS_DICT.keys()) + ["General", "Otros"]
-
-def detect_category(text):
-    text_lower = text.lower()
-    # Prioridad: Buscar menciones negativas primero, ya que definen la categoría del problema
-    for cat, keywords in CONCEPTS_DICT.items():
-        for k in keywords["neg"]:
-            if k in text_lower: return cat
-            
-    # Si no, positivas
-    for cat, keywords in CONCEPTS_DICT.items():
-        for k in keywords["pos"]:
-            if k in text_lower: return cat
-            
-    return "General"
-
 # --- LÓGICA DE INTELIGENCIA ARTIFICIAL ---
 def analyze_sentiments(df_reviews):
     """
     Analizador Semántico 'Rule-Based' reutilizando el dict global.
     """
     results = []
+    types = {"pos": "Positivo", "neg": "Negativo"}
     
-    # Procesar cada review
-    for text in df_reviews["Text"].fillna("").astype(str):
-        text_lower = text.lower()
-        
-        for category, keywords in CONCEPTS_DICT.items():
-            # Buscar Positivos
-            for word in keywords["pos"]:
-                if word in text_lower:
-                    results.append({"Category": category, "Type": "Positivo", "Word": word})
-                    break # Solo contamos 1 vez por categoría por review
-            
-            # Buscar Negativos
-            for word in keywords["neg"]:
-                if word in text_lower:
-                    results.append({"Category": category, "Type": "Negativo", "Word": word})
-                    break 
-                    
-    return pd.DataFrame(results) 
+    # Conceptos guardados al entrar en el SQLite (Concepts); textos sueltos: se calculan
+    if "Concepts" in df_reviews.columns:
+        found = df_reviews["Concepts"].dropna().map(json.loads)
+    else:
+        found = df_reviews["Text"].fillna("").astype(str).map(KEYWORD_ENGINE.concepts)
+
+    # Solo contamos 1 vez por categoría y tipo por review
+    for concepts in found:
+        for category, kind, word in concepts:
+            results.append({"Category": category, "Type": types[kind], "Word": word})
                     
     return pd.DataFrame(results)
 
@@ -876,6 +3274,57 @@ def generate_smart_reply(review_text, platform, guest_name="Huésped"):
     reply += "Esperamos tener la oportunidad de recibirte de nuevo y ofrecerte una experiencia de 10.\n\nUn saludo."
     return reply
 
+# --- MODO CONSOLA (python app.py <comando>) ---
+# Bajo `streamlit run` sys.argv no lleva comando, así que esto solo actúa desde terminal.
+CLI_COMMANDS = ("record", "replay", "bench", "fixtures", "bench-normalize", "compact", "backfill")
+
+def run_cli(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog="python app.py", description="Herramientas de consola del monitor.")
+    parser.add_argument("command", choices=CLI_COMMANDS)
+    parser.add_argument("--live", action="store_true", help="bench contra las webs reales (por defecto usa las grabaciones)")
+    parser.add_argument("--name", help="solo alojamientos cuyo nombre contenga este texto")
+    parser.add_argument("--limit", type=int, help="máximo de alojamientos")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=1, help="veces que se visita cada ficha (bench)")
+    parser.add_argument("--rows", type=int, default=100_000, help="filas del histórico sintético (bench-normalize)")
+    parser.add_argument("--dir", default=snapshots_dir, help="carpeta de payloads grabados (fixtures)")
+    args = parser.parse_args(argv)
+
+    if args.command == "fixtures":
+        return check_review_fixtures(args.dir)
+    if args.command == "bench-normalize":
+        return bench_normalize(args.rows)
+    if args.command == "compact":
+        print(compact_rating_snapshots())
+        return 0
+    if args.command == "backfill":
+        print(f"{backfill_derived_columns()} reseñas con columnas derivadas recalculadas (Category/Crisis solo si faltaban)")
+        return 0
+
+    accs = [a for a in load_accommodations() if not args.name or args.name.lower() in a["name"].lower()]
+    if args.limit: accs = accs[:args.limit]
+    mode = {"record": "record", "replay": "replay", "bench": "live" if args.live else "replay"}[args.command]
+    repeat = args.repeat if args.command == "bench" else 1
+
+    def _on_row(row):
+        status = row["Error"] or f"{row['Latency (s)']}s · {row['Reviews']} reseñas · {row['Text source']}"
+        print(f"  {row['Name']} ({row['Platform']}) · {status}", flush=True)
+
+    pool = get_browser_pool()
+    t0 = time.perf_counter()
+    try:
+        rows = pool.run(run_scraper_bench(accs, mode=mode, concurrency=args.concurrency, repeat=repeat, on_row=_on_row))
+    finally:
+        wall = time.perf_counter() - t0
+        pool.shutdown()
+    print()
+    print_bench_report(rows, wall)
+    return 0
+
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS:
+    sys.exit(run_cli(sys.argv[1:]))
+
 # --- PÁGINA: LIMPIEZA ---
 if page_selection == "Limpieza":
     st.title("🧹 Gestión de Limpieza y Equipo")
@@ -1012,88 +3461,87 @@ if page_selection == "Inteligencia Artificial":
 
     st.divider()
     
-    reviews_csv = "historico_reviews.csv"
-    if os.path.exists(reviews_csv):
-        df_reviews = pd.read_csv(reviews_csv)
+    df_reviews = load_reviews_db()
+    if df_reviews.empty:
+         st.warning("El historial de opiniones está vacío. Ve a 'Comentarios' y Escanea primero.")
+    else:
+        # APLICAR FILTRO GLOBAL
+        df_reviews = filter_by_date(df_reviews)
         
-        if df_reviews.empty:
-             st.warning("El historial de opiniones está vacío. Ve a 'Comentarios' y Escanea primero.")
-        else:
-            # APLICAR FILTRO GLOBAL
-            df_reviews = filter_by_date(df_reviews)
+        st.info(f"Analizando {len(df_reviews)} opiniones ({date_filter})...")
+        
+        # Analizar
+        analysis_df = analyze_sentiments(df_reviews)
+        
+        if not analysis_df.empty:
+            col1, col2 = st.columns(2)
             
-            st.info(f"Analizando {len(df_reviews)} opiniones ({date_filter})...")
+            # Agrupar y contar
+            counts = analysis_df.groupby(["Category", "Type"]).size().unstack(fill_value=0)
             
-            # Analizar
-            analysis_df = analyze_sentiments(df_reviews)
+            # Asegurar columnas
+            if "Positivo" not in counts.columns: counts["Positivo"] = 0
+            if "Negativo" not in counts.columns: counts["Negativo"] = 0
             
-            if not analysis_df.empty:
-                col1, col2 = st.columns(2)
-                
-                # Agrupar y contar
-                counts = analysis_df.groupby(["Category", "Type"]).size().unstack(fill_value=0)
-                
-                # Asegurar columnas
-                if "Positivo" not in counts.columns: counts["Positivo"] = 0
-                if "Negativo" not in counts.columns: counts["Negativo"] = 0
-                
-                # --- LO MÁS AMADO ---
-                with col1:
-                    st.subheader("😍 Lo que ENAMORA")
-                    top_pos = counts["Positivo"].sort_values(ascending=True) # Orden para gráfico barra horizontal
-                    st.bar_chart(top_pos, color="#2ecc71", horizontal=True) # Verde
-                    
-                # --- LO MÁS ODIADO ---
-                with col2:
-                    st.subheader("😡 Lo que MOLESTA")
-                    top_neg = counts["Negativo"].sort_values(ascending=True)
-                    st.bar_chart(top_neg, color="#e74c3c", horizontal=True) # Rojo
-                    
-                st.divider()
+            # --- LO MÁS AMADO ---
+            with col1:
+                st.subheader("😍 Lo que ENAMORA")
+                top_pos = counts["Positivo"].sort_values(ascending=True) # Orden para gráfico barra horizontal
+                st.bar_chart(top_pos, color="#2ecc71", horizontal=True) # Verde
                 
-                # --- CONSEJO IA ---
-                st.subheader("💡 Consejo de Actuación")
-                worst_category = counts["Negativo"].idxmax()
-                count_worst = counts["Negativo"].max()
-                total_reviews = len(df_reviews)
-                pct = (count_worst / total_reviews) * 100
+            # --- LO MÁS ODIADO ---
+            with col2:
+                st.subheader("😡 Lo que MOLESTA")
+                top_neg = counts["Negativo"].sort_values(ascending=True)
+                st.bar_chart(top_neg, color="#e74c3c", horizontal=True) # Rojo
                 
-                txt = f"El problema más frecuente es **{worst_category}** (aparece en {count_worst} menciones)."
+            st.divider()
+            
+            # --- CONSEJO IA ---
+            st.subheader("💡 Consejo de Actuación")
+            worst_category = counts["Negativo"].idxmax()
+            count_worst = counts["Negativo"].max()
+            total_reviews = len(df_reviews)
+            pct = (count_worst / total_reviews) * 100
+            
+            txt = f"El problema más frecuente es **{worst_category}** (aparece en {count_worst} menciones)."
+            
+            if worst_category == "Cama/Confort":
+                advice = "Considera invertir en **toppers viscoelásticos** o renovar almohadas. Es la inversión más rentable para subir nota."
+            elif worst_category == "Ruido/Descanso":
+                advice = "Mejora el aislamiento o deja tapones de oídos de cortesía con una nota amable."
+            elif worst_category == "Limpieza":
+                advice = "Revisa el protocolo con tu equipo de limpieza. Los huéspedes son muy sensibles a pelos y olores."
+            elif worst_category == "Instalaciones (Agua/Luz/Wifi)":
+                advice = "Verifica el router o el termo. Un mantenimiento preventivo te ahorrará malas reviews."
+            else:
+                advice = "Revisa los comentarios específicos de esta categoría para entender el patrón."
                 
-                if worst_category == "Cama/Confort":
-                    advice = "Considera invertir en **toppers viscoelásticos** o renovar almohadas. Es la inversión más rentable para subir nota."
-                elif worst_category == "Ruido/Descanso":
-                    advice = "Mejora el aislamiento o deja tapones de oídos de cortesía con una nota amable."
-                elif worst_category == "Limpieza":
-                    advice = "Revisa el protocolo con tu equipo de limpieza. Los huéspedes son muy sensibles a pelos y olores."
-                elif worst_category == "Instalaciones (Agua/Luz/Wifi)":
-                    advice = "Verifica el router o el termo. Un mantenimiento preventivo te ahorrará malas reviews."
-                else:
-                    advice = "Revisa los comentarios específicos de esta categoría para entender el patrón."
-                    
-                st.success(f"{txt}\n\n**Recomendación:** {advice}")
+            st.success(f"{txt}\n\n**Recomendación:** {advice}")
 
-            else:
-                st.warning("No se detectaron palabras clave en las opiniones actuales.")
-    else:
-        st.error("No se encontró base de datos de opiniones. Ve a 'Comentarios' y escanea.")
+        else:
+            st.warning("No se detectaron palabras clave en las opiniones actuales.")
 
 # --- PÁGINA: DASHBOARD ---
 if page_selection == "Dashboard":
     st.title("📊 Monitor de Notas")
     
-    # Cargar todos los datos (Cloud o Local)
+    # Cargar todos los datos (Cloud o Local): reseñas sueltas y, de las notas de cada ficha,
+    # solo los agregados (AGREGADOS DE NOTAS Y RESEÑAS): ningún panel recorre el histórico
     df = load_reviews_db()
+    status = load_listing_status()
     
-    if not df.empty:
+    if not df.empty or not status.empty:
         if "Name" not in df.columns: df["Name"] = "Desconocido"
         
-        # APLICAR FILTRO GLOBAL A NOTAS
+        # APLICAR FILTRO GLOBAL A RESEÑAS; periodo actual y anterior para los agregados diarios
         df = filter_by_date(df)
+        cutoff = period_cutoff()
+        prev_start, prev_end = previous_period(cutoff) if cutoff is not None else (None, None)
+        review_daily = load_review_daily()
         
-        # Filtramos para quedarnos con el ÚLTIMO dato de cada (Nombre, Plataforma)
-        df_sorted = df.sort_values(by="Date", ascending=True)
-        latest_df = df_sorted.drop_duplicates(subset=["Name", "Platform"], keep="last")
+        # ÚLTIMO dato de cada (Nombre, Plataforma) y su delta: listing_status, ya mantenida al guardar
+        latest_df = status_in_period(status)
         
         # DEFINICIÓN DE VARIABLES FALTANTES (Rankings)
         airbnb_data = latest_df[latest_df["Platform"] == "Airbnb"]
@@ -1102,97 +3550,47 @@ if page_selection == "Dashboard":
         # 1. KPIs Globales (DINÁMICOS POR TIEMPO)
         col1, col2, col3 = st.columns([1, 1, 1])
         
-        # Cargar reseñas para calcular media del periodo
-        df_kpi_revs = load_reviews_db()
-        df_kpi_revs = filter_by_date(df_kpi_revs)
+        # Medias ponderadas de las notas de ficha (rating_daily: suma / nº de notas por día)
+        rating_daily = load_rating_daily()
+        weighted_mean = lambda t, plat: t.at[plat, "RatingSum"] / t.at[plat, "Count"] if plat in t.index and t.at[plat, "Count"] else None
         
-        avg_airbnb_period = None
-        avg_booking_period = None
+        # 1. Periodo Actual  2. Periodo Anterior: la misma duración justo antes (sin filtro no hay anterior)
+        current = window_totals(rating_daily, cutoff, by="Platform")
+        previous = window_totals(rating_daily, prev_start, prev_end, by="Platform") if cutoff is not None else current.iloc[0:0]
         
-        if not df_kpi_revs.empty and "Rating" in df_kpi_revs.columns:
-            # Asegurar numérico
-            df_kpi_revs["Rating"] = pd.to_numeric(df_kpi_revs["Rating"], errors="coerce")
-            
-            # 1. Periodo Actual
-            ab_revs = df_kpi_revs[df_kpi_revs["Platform"] == "Airbnb"]
-            bk_revs = df_kpi_revs[df_kpi_revs["Platform"] == "Booking"]
-            
-            if not ab_revs.empty: avg_airbnb_period = ab_revs["Rating"].mean()
-            if not bk_revs.empty: avg_booking_period = bk_revs["Rating"].mean()
-
-            # 2. Periodo Anterior (Simulado simple: misma ventana hacia atrás)
-            # Nota: Esto es aproximado para dar sensación de tendencia
-            # En una app real calcularíamos start_date - delta
-            # Aquí usaremos el "resto" de reviews que NO están en el filtro actual como "Pasado"
-            # O mejor, comparamos con la media GLOBAL HISTÓRICA para ver si estamos mejorando el promedio
-            
-            df_all_raw = load_reviews_db()
-            df_all_raw["Rating"] = pd.to_numeric(df_all_raw["Rating"], errors="coerce")
-            
-            global_ab = df_all_raw[df_all_raw["Platform"] == "Airbnb"]["Rating"].mean()
-            global_bk = df_all_raw[df_all_raw["Platform"] == "Booking"]["Rating"].mean()
-            
-            delta_ab = (avg_airbnb_period - global_ab) if avg_airbnb_period and global_ab else 0
-            delta_bk = (avg_booking_period - global_bk) if avg_booking_period and global_bk else 0
+        avg_airbnb_period, prev_airbnb = weighted_mean(current, "Airbnb"), weighted_mean(previous, "Airbnb")
+        avg_booking_period, prev_booking = weighted_mean(current, "Booking"), weighted_mean(previous, "Booking")
+        delta_ab = f"{avg_airbnb_period - prev_airbnb:+.2f} vs periodo anterior" if avg_airbnb_period and prev_airbnb else None
+        delta_bk = f"{avg_booking_period - prev_booking:+.2f} vs periodo anterior" if avg_booking_period and prev_booking else None
         
         # Fallback a "Snapshot" si no hay reviews en el periodo (o mostrar guión)
         col1.metric(
             "Media Periodo (Airbnb)", 
             f"{avg_airbnb_period:.2f}" if avg_airbnb_period else "-", 
-            f"{delta_ab:.2f} vs Global" if avg_airbnb_period else None,
+            delta_ab,
             border=True, 
-            help="Nota media de las reseñas recibidas en este periodo comparada con la media histórica."
+            help="Nota media de las fichas en este periodo comparada con la del periodo anterior de la misma duración."
         )
         col2.metric(
             "Media Periodo (Booking)", 
             f"{avg_booking_period:.2f}" if avg_booking_period else "-", 
-            f"{delta_bk:.2f} vs Global" if avg_booking_period else None, 
+            delta_bk, 
             border=True, 
-            help="Nota media de las reseñas recibidas en este periodo comparada con la media histórica."
+            help="Nota media de las fichas en este periodo comparada con la del periodo anterior de la misma duración."
         )
         
         with col3:
              st.write("") # Spacer
-             st.write("") # Spacer
-             if st.button("🔄 Sincronizar (Visible)", use_container_width=True, help="Ejecuta la sincronización en primer plano para ver el progreso detallado."):
+             full_rescan = st.checkbox("Re-escanear todo", help="Ignora las huellas (nº de reseñas + nota) y extrae todas las fichas aunque no hayan cambiado.")
+             sync_job = get_sync_job()
+             if st.button("🔄 Sincronizar", use_container_width=True, disabled=sync_job.is_running(), help="Lanza la sincronización en segundo plano. Puedes cerrar la pestaña: sigue corriendo y todos los usuarios ven el mismo progreso."):
                 if not accommodations:
                     st.error("Configura primero.")
                 else:
-                    # Ejecución en Primer Plano con Status de Streamlit
-                    with st.status("🚀 Iniciando Sincronización...", expanded=True) as status:
-                        st.write("Conectando con navegador...")
-                        try:
-                            # 1. Scraping
-                            new_data = scrape_data_sync(accommodations)
-                            
-                            if new_data:
-                                status.update(label="💾 Guardando datos...", state="running")
-                                df_new = pd.DataFrame(new_data)
-                                
-                                # 2. Guardar (La función save_reviews_db ya se encarga de mezclar y guardar en Nube/Local)
-                                # Pero load_reviews_db ya limpia duplicados, así que concat es seguro
-                                st.write(f"✅ Se encontraron {len(new_data)} reseñas nuevas.")
-                                
-                                current_db = load_reviews_db()
-                                full_db = pd.concat([current_db, df_new], ignore_index=True)
-                                
-                                # Guardar invocando la función maestra
-                                save_reviews_db(full_db)
-                                
-                                # Limpiar caché
-                                load_reviews_db.clear()
-                                
-                                status.update(label="✅ Sincronización Completa!", state="complete", expanded=False)
-                                st.success(f"¡Listo! {len(new_data)} reseñas procesadas.")
-                                time.sleep(1)
-                                st.rerun()
-                            else:
-                                status.update(label="⚠️ No se encontraron nuevos datos.", state="complete", expanded=False)
-                                st.info("El proceso terminó pero no trajo reseñas nuevas (o falló el scraping). Revisa los logs arriba si aparecen.")
-                                
-                        except Exception as e:
-                            status.update(label="❌ Error en Sincronización", state="error")
-                            st.error(f"Error detallado: {e}")
+                    sync_job.start(accommodations, incremental=not full_rescan)
+                    st.rerun()
+
+        show_sync_job_status()
 
         st.divider()
         
@@ -1204,16 +3602,20 @@ if page_selection == "Dashboard":
         with c_probs:
             st.subheader("🚦 Semáforo de Problemas (Quejas)")
             if not df.empty:
-                # Filtrar solo negativas para el gráfico (Texto + Nota) y contar Categorías
-                neg_mask = df.apply(lambda x: is_review_negative(x)[0] if "Text" in df.columns else False, axis=1)
-                df_probs = df[neg_mask]
+                # Negativas (Texto + Nota) por Categoría en el periodo, desde review_daily
+                by_cat = window_totals(review_daily, cutoff, by="Category")["Negatives"]
+                cat_counts = by_cat[by_cat > 0].sort_values(ascending=False).reset_index()
+                cat_counts.columns = ["Categoría", "Quejas"]
                 
-                if not df_probs.empty:
-                    cat_counts = df_probs["Category"].value_counts().reset_index()
-                    cat_counts.columns = ["Categoría", "Quejas"]
-                    
+                if not cat_counts.empty:
                     # Colores de alerta
                     st.bar_chart(cat_counts.set_index("Categoría"), color="#e74c3c", horizontal=True)
+                    totals = window_totals(review_daily, cutoff)
+                    summary = f"{int(totals['Negatives'])} quejas · {int(totals['Crisis'])} crisis sin resolver en el periodo"
+                    if cutoff is not None:
+                        before = window_totals(review_daily, prev_start, prev_end)
+                        summary += f" (periodo anterior: {int(before['Negatives'])} quejas · {int(before['Crisis'])} crisis)"
+                    st.caption(summary)
                 else:
                     st.success("✅ Tráfico limpio: No se detectan volúmenes de quejas en este periodo.")
             else:
@@ -1222,11 +3624,14 @@ if page_selection == "Dashboard":
         with c_staff:
             st.subheader("🧹 Snapshot Equipo")
             if not df.empty and "Cleaner" in df.columns and "Category" in df.columns:
-                # Filtrar quejas DE LIMPIEZA
-                clean_probs = df[(df["Category"] == "Limpieza") & (neg_mask)].copy()
-                if not clean_probs.empty:
-                    staff_counts = clean_probs["Cleaner"].value_counts().reset_index()
-                    staff_counts.columns = ["Staff", "Incidencias"]
+                # Quejas DE LIMPIEZA por persona (review_daily), y las del periodo anterior
+                cleaning = review_daily[review_daily["Category"] == "Limpieza"]
+                staff_counts = window_totals(cleaning, cutoff, by="Cleaner")[["Negatives"]].rename(columns={"Negatives": "Incidencias"})
+                if cutoff is not None:
+                    staff_counts["Periodo anterior"] = window_totals(cleaning, prev_start, prev_end, by="Cleaner")["Negatives"]
+                staff_counts = staff_counts[staff_counts["Incidencias"] > 0].sort_values("Incidencias", ascending=False)
+                if not staff_counts.empty:
+                    staff_counts = staff_counts.fillna(0).astype(int).rename_axis("Staff").reset_index()
                     st.dataframe(staff_counts, hide_index=True, use_container_width=True)
                 else:
                     st.info("🧹 Equipo brillando.")
@@ -1255,17 +3660,11 @@ if page_selection == "Dashboard":
         with c_recent:
             st.subheader("⚠️ Últimas Quejas")
             if not df.empty:
-                 # Reutilizamos logica de filtro de negativas
-                 neg_rows = []
-                 for i, row in df.iterrows():
-                     is_n, score = is_review_negative(row)
-                     if is_n:
-                         r = row.copy()
-                         r["NotaUI"] = score
-                         neg_rows.append(r)
+                 # Reutilizamos el filtro de negativas (IsNegative/NotaUI de la instantánea)
+                 neg_rows = df[df["IsNegative"]]
                  
-                 if neg_rows:
-                     df_n = pd.DataFrame(neg_rows).sort_values(by="Date", ascending=False).head(5)
+                 if not neg_rows.empty:
+                     df_n = neg_rows.sort_values(by="Date", ascending=False).head(5)
                      st.dataframe(df_n[["Date", "Name", "Text"]], use_container_width=True, hide_index=True)
                  else:
                      st.success("Sin quejas recientes.")
@@ -1320,14 +3719,9 @@ if page_selection == "Dashboard":
 
         st.divider()
         
-        # --- CÁLCULO DE DELTAS Y EVOLUCIÓN ---
-        # 1. Preparar datos para Deltas
-        df_sorted = df.sort_values(by=["Name", "Platform", "Date"])
-        df_sorted["Prev_Rating"] = df_sorted.groupby(["Name", "Platform"])["Rating"].shift(1)
-        df_sorted["Delta"] = df_sorted["Rating"] - df_sorted["Prev_Rating"]
-        
-        # Nos quedamos con la última fila de cada (Name, Platform) que tenga el Delta calculado (o 0 si es el primero)
-        latest_status = df_sorted.drop_duplicates(subset=["Name", "Platform"], keep="last").copy()
+        # --- DELTAS Y EVOLUCIÓN ---
+        # Última fila de cada (Name, Platform) con su Delta (NaN si es la primera): sin recorrer el histórico
+        latest_status = latest_df
         
         # Pivotar para tabla
         pivot_rating = latest_status.pivot(index="Name", columns="Platform", values="Rating")
@@ -1375,12 +3769,17 @@ if page_selection == "Dashboard":
         # --- GRÁFICO DE EVOLUCIÓN MENSUAL ---
         st.subheader("📈 Tendencia Mensual Global")
         
-        df["Date"] = pd.to_datetime(df["Date"])
-        df["Month"] = df["Date"].dt.to_period("M")
+        # Sumas por ficha y mes ya agregadas (rating_monthly). Con filtro, meses completos
+        # desde el del corte: un mes a medias daría una media engañosa
+        monthly = load_monthly_ratings()
+        cutoff = period_cutoff()
+        if cutoff is not None:
+            monthly = monthly[monthly["Month"] >= pd.Timestamp(cutoff).to_period("M").to_timestamp()]
         
-        # Agrupar por Mes y Plataforma -> Media de notas
-        monthly_trends = df.groupby(["Month", "Platform"])["Rating"].mean().reset_index()
-        monthly_trends["Month"] = monthly_trends["Month"].dt.to_timestamp()
+        # Agrupar por Mes y Plataforma -> Media de notas (ponderada: suma / nº de notas)
+        monthly_trends = monthly.groupby(["Month", "Platform"])[["RatingSum", "Count"]].sum()
+        monthly_trends["Rating"] = monthly_trends["RatingSum"] / monthly_trends["Count"]
+        monthly_trends = monthly_trends.reset_index()
         
         # Pivotar para gráfico de líneas limpio
         chart_data = monthly_trends.pivot(index="Month", columns="Platform", values="Rating")
@@ -1417,10 +3816,12 @@ elif page_selection == "Comentarios":
         
         if not inbox.empty:
             st.warning(f"Tienes {len(inbox)} opiniones sin leer.")
+            pending = count_pending_edits() if GS_CONN else 0
+            if pending:
+                st.caption(f"☁️ {pending} cambios guardados en local, subiendo a Google Sheets en segundo plano...")
             
             if st.button("Marcar todo como leído"):
-                df_reviews["New"] = False
-                save_reviews_db(df_reviews)
+                queue_review_rows(pd.DataFrame({"Hash": inbox["Hash"], "New": False}))
                 st.rerun()
             
             for index, row in inbox.iterrows():
@@ -1440,8 +3841,7 @@ elif page_selection == "Comentarios":
                     new_cat = c2.selectbox("🏷️ Categoría", CATEGORIES_LIST, index=CATEGORIES_LIST.index(current_cat) if current_cat in CATEGORIES_LIST else 0, key=f"cat_inbox_{index}")
                     
                     if new_cat != current_cat:
-                         df_reviews.loc[index, "Category"] = new_cat
-                         save_reviews_db(df_reviews)
+                         update_review(row["Hash"], Category=new_cat)
                          st.rerun()
 
                     # Asignar Limpieza
@@ -1454,8 +3854,7 @@ elif page_selection == "Comentarios":
                         selection = c3.selectbox("🧹 Limpieza:", options, index=idx, key=f"clean_inbox_{index}")
                         
                         if selection != current_cleaner:
-                            df_reviews.loc[index, "Cleaner"] = selection if selection != "Sin asignar" else None
-                            save_reviews_db(df_reviews)
+                            update_review(row["Hash"], Cleaner=selection if selection != "Sin asignar" else None)
                             st.rerun()
 
         else:
@@ -1525,13 +3924,10 @@ elif page_selection == "Comentarios":
                                     "Cleaner": new_cleaner if new_cleaner != "Sin asignar" else None,
                                     "Category": new_cat
                                 }
-                                df_db = pd.concat([df_db, pd.DataFrame([new_entry])], ignore_index=True)
+                                queue_review_rows(pd.DataFrame([new_entry]))
                             else:
                                 # Actualizar
-                                df_db.loc[df_db["Hash"] == hash_id, "Cleaner"] = new_cleaner if new_cleaner != "Sin asignar" else None
-                                df_db.loc[df_db["Hash"] == hash_id, "Category"] = new_cat
-                            
-                            save_reviews_db(df_db)
+                                update_review(hash_id, Cleaner=new_cleaner if new_cleaner != "Sin asignar" else None, Category=new_cat)
                             st.rerun()
 
                 if acc["airbnb"]:
@@ -1627,13 +4023,12 @@ elif page_selection == "Configuración":
     else:
         st.info("Modo Local (Sin conexión a nube). Añade secretos para conectar.")
     
-    if os.path.exists(csv_file):
-        if st.button("📤 Subir CSV Local a Google Sheets", help="Úsalo una vez para migrar tus datos actuales a la nube."):
+    if os.path.exists(reviews_db_file):
+        if st.button("📤 Subir BD Local a Google Sheets", help="Úsalo una vez para migrar tus datos actuales a la nube."):
             if GS_CONN and GS_CONN.connect():
-                df_local = pd.read_csv(csv_file)
-                # Ensure dates are strings for sheets
-                df_local["Date"] = pd.to_datetime(df_local["Date"]).dt.strftime('%Y-%m-%d %H:%M:%S')
-                if GS_CONN.save_data(df_local):
+                df_local = read_local_reviews()
+                # Notas en parcial: la pestaña conserva las que ya se han resumido en local
+                if GS_CONN.save_data(df_local) and GS_CONN.save_data(read_local_snapshots(), sheet_name=SNAPSHOTS_SHEET, partial=True):
                     st.success("¡Datos migrados a la nube con éxito!")
             else:
                 st.error("No se puede conectar. Revisa tu archivo secrets.toml o la configuración.")
@@ -1642,16 +4037,35 @@ elif page_selection == "Configuración":
     
     # --- DEBUG SECTION (Solo para verificar Nube) ---
     with st.expander("🛠️ Debug: Diagnóstico de Nube"):
+        snap = get_review_snapshot()
+        st.caption(f"Histórico local: versión {snap.version} · {snap.loads} lecturas del SQLite desde el arranque")
+        if snap.tables is not None and not snap.tables["reviews"].empty:
+            st.caption("Memoria del histórico en caché (tipos compactos frente a object):")
+            st.dataframe(frame_memory_report(snap.tables["reviews"]), use_container_width=True)
         if GS_CONN and GS_CONN.connect():
             df_debug = GS_CONN.get_data()
             st.write(f"Filas en Google Sheets: **{len(df_debug)}**")
+            st.caption(f"Hoja: `{GS_CONN.spreadsheet_id or '—'}` · Reconexiones: {GS_CONN.reconnects}")
+            flusher = get_edit_flusher()
+            st.caption(f"Cambios pendientes de subir: {count_pending_edits()} · Última subida: {flusher.last_flush or '—'}"
+                       + (f" · ❌ {flusher.last_error}" if flusher.last_error else ""))
+            if st.button("☁️ Subir cambios pendientes ahora"):
+                st.toast(f"{flusher.flush()} reseñas actualizadas en la Nube")
             if not df_debug.empty:
                 st.dataframe(df_debug.head())
             else:
                 st.warning("Google Sheets está vacío.")
         else:
             st.error("No se pudo conectar a GSheets para diagnóstico.")
-            
+
+    with st.expander("🧭 Navegador de Scraping (Pool)"):
+        pool = get_browser_pool()
+        st.json(pool.status())
+        if st.button("♻️ Reiniciar navegador", help="Cierra Chromium y lo vuelve a lanzar en la próxima consulta."):
+            pool.shutdown()
+            get_browser_pool.clear()
+            st.rerun()
+
 
     
     st.markdown("Aquí puedes gestionar tu lista de pisos y tu equipo.")
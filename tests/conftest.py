@@ -0,0 +1,36 @@
+import importlib.util
+import os
+import shutil
+
+import pytest
+import streamlit as st
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+@pytest.fixture
+def load_app(tmp_path, monkeypatch):
+    """Importa app.py (modo consola) con reviews.db y los JSON de configuración en tmp_path."""
+    for name in ("alojamientos.json", "cleaners.json"):
+        shutil.copy(os.path.join(ROOT, name), tmp_path)
+    monkeypatch.chdir(tmp_path)
+    loaded = []
+
+    def _load():
+        # Los singletons de st.cache_resource sobreviven entre importaciones
+        st.cache_resource.clear()
+        st.cache_data.clear()
+        spec = importlib.util.spec_from_file_location("app", os.path.join(ROOT, "app.py"))
+        app = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(app)
+        # El flusher de ediciones y su atexit siguen vivos al salir del test: ruta absoluta
+        app.reviews_db_file = str(tmp_path / app.reviews_db_file)
+        loaded.append(app)
+        return app
+
+    yield _load
+    # Un flusher que despierte durante el test siguiente llamaría a init_local_store, cuya
+    # caché comparten todas las importaciones: la dejaría marcada sin crear las tablas nuevas
+    for app in loaded:
+        app.flush_pending_edits = lambda: 0
@@ -0,0 +1,50 @@
+import asyncio
+
+
+class FakePage:
+    async def close(self): pass
+    async def route(self, *a, **k): pass
+
+
+class FakeContext:
+    async def new_page(self): return FakePage()
+    async def close(self): pass
+
+
+class FakeBrowser:
+    def __init__(self): self.crashed = False
+    def is_connected(self): return not self.crashed
+    async def close(self): pass
+    async def new_context(self, **k):
+        if self.crashed: raise RuntimeError("browser closed")
+        return FakeContext()
+
+
+class FakePlaywright:
+    def __init__(self): self.chromium = self
+    async def start(self): return self
+    async def stop(self): pass
+    async def launch(self, **k): return FakeBrowser()
+
+
+def test_waiting_borrowers_survive_a_browser_relaunch(load_app):
+    app = load_app()
+    app.async_playwright = FakePlaywright
+    pool = app.BrowserPool(size=2)
+
+    async def borrow():
+        async with pool.page("Airbnb"):
+            await asyncio.sleep(0.1)
+
+    async def main():
+        # 2 pestañas prestadas y 4 esperando contexto cuando el navegador se cae
+        tasks = [asyncio.create_task(borrow()) for _ in range(6)]
+        await asyncio.sleep(0.02)
+        pool._browser.crashed = True
+        await asyncio.wait_for(asyncio.gather(*tasks), 5)
+
+    try:
+        pool.run(main(), timeout=10)
+        assert pool.launches == 2
+    finally:
+        pool.shutdown()
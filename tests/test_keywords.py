@@ -0,0 +1,40 @@
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pandas as pd
+
+from conftest import ROOT
+
+TEXT = "Mucho ruido por la noche y el baño sucio, aunque la ubicación es céntrica"
+
+
+def test_concepts_follow_dictionary_order(load_app):
+    app = load_app()
+    assert app.KEYWORD_ENGINE.concepts(TEXT) == [
+        ("Limpieza", "neg", "sucio"), ("Ubicación", "pos", "ubicación"), ("Ruido/Descanso", "neg", "ruido")]
+    assert "con limpieza no haya sido perfecta" in app.generate_smart_reply(TEXT, "Airbnb")
+
+
+def test_concepts_do_not_depend_on_hash_seed():
+    # El orden de un set cambia con PYTHONHASHSEED: el de concepts() no debe
+    code = ("import sys; sys.argv = ['app.py']; exec(open('app.py', encoding='utf-8').read().split('# --- FUNCIONES DE CARGA/GUARDADO ---')[0]); "
+            f"print(KEYWORD_ENGINE.concepts({TEXT!r}))")
+    outputs = {subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True,
+                              env={**os.environ, "PYTHONHASHSEED": seed}).stdout for seed in ("0", "1", "2", "3")}
+    assert len(outputs) == 1 and "Limpieza" in outputs.pop()
+
+
+def test_imported_history_gets_keyword_crisis(load_app, tmp_path):
+    app = load_app()
+    # CSV antiguo: una fila por sync con las reseñas unidas y el relleno General/False
+    pd.DataFrame([{"Hash": "h1", "Date": "2023-05-01 10:00:00", "Platform": "Booking", "Name": "Piso A",
+                   "Rating": 8.0, "Text": "Había chinches en la cama || Todo perfecto",
+                   "Category": "General", "Crisis": False}]).to_csv(tmp_path / "historico_reviews.csv", index=False)
+    app.init_local_store.clear()
+    app.init_local_store()
+    conn = sqlite3.connect(app.reviews_db_file)
+    rows = dict(conn.execute("SELECT Text, Crisis FROM reviews").fetchall())
+    conn.close()
+    assert rows == {"Había chinches en la cama": 1, "Todo perfecto": 0}
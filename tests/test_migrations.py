@@ -0,0 +1,61 @@
+import sqlite3
+
+# reviews.db tal como la dejaba la versión sin schema_version (v0): una fila por ficha y
+# sync, notas sin reescalar y fechas sin deducir del texto
+V0_SCHEMA = ('CREATE TABLE reviews ("Hash" TEXT PRIMARY KEY, "Date" TEXT, "Platform" TEXT, "Name" TEXT, "URL" TEXT, '
+             '"Rating" REAL, "Text" TEXT, "Category" TEXT, "Cleaner" TEXT, "New" INTEGER, "Crisis" INTEGER)')
+V0_ROWS = [
+    ("h1", "2024-01-01 10:00:00", "Airbnb", "Piso A", None, 487, "Todo perfecto", None, None, 0, 0),
+    ("h2", "2024-01-02 10:00:00", "Airbnb", "Piso A", None, 4.2, "Había pelos en el baño, muy sucio", "Limpieza", "Ana", 1, 0),
+    ("h3", "2024-01-03 10:00:00", "Booking", "Piso B", None, 9.1, "Ruido toda la noche", None, None, 1, 1),
+    ("h4", None, "Booking", "Piso B", None, 8.5, "Hace 3 días - bien", None, None, 0, 0),
+]
+
+
+def _write_v0_db():
+    conn = sqlite3.connect("reviews.db")
+    conn.execute(V0_SCHEMA)
+    conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("CREATE TABLE pending_edits (id INTEGER PRIMARY KEY AUTOINCREMENT, Hash TEXT, changes TEXT, created TEXT)")
+    conn.execute("INSERT INTO meta VALUES ('csv_migrated', '2024-01-05 00:00:00')")
+    conn.executemany("INSERT INTO reviews VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", V0_ROWS)
+    conn.commit()
+    conn.close()
+
+
+def _daily_matches_reviews(conn):
+    expected = conn.execute("SELECT COUNT(*), IFNULL(SUM(IsNegative), 0), IFNULL(SUM(Crisis), 0) "
+                            "FROM reviews WHERE Date IS NOT NULL").fetchone()
+    got = conn.execute("SELECT IFNULL(SUM(Count), 0), IFNULL(SUM(Negatives), 0), IFNULL(SUM(Crisis), 0) FROM review_daily").fetchone()
+    return expected == got
+
+
+def test_v0_database_upgrades_to_current_schema(load_app):
+    _write_v0_db()
+    app = load_app()
+    app.load_reviews_db()
+
+    conn = sqlite3.connect("reviews.db")
+    assert conn.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()[0] == str(app.SCHEMA_VERSION)
+    triggers = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    assert triggers == set(app.AGGREGATE_TRIGGERS)
+    assert conn.execute("SELECT COUNT(*) FROM rating_snapshots").fetchone()[0] == len(V0_ROWS)
+    assert conn.execute("SELECT MAX(Rating) FROM rating_snapshots WHERE Platform = 'Airbnb'").fetchone()[0] <= 5
+    assert _daily_matches_reviews(conn)
+    conn.close()
+
+    # Los triggers siguen al día tras una edición del inbox
+    h = app.load_reviews_db().dropna(subset=["Date"])["Hash"].iloc[0]
+    app.update_review(h, Category="Limpieza", Cleaner="Ana", Crisis=True)
+    conn = sqlite3.connect("reviews.db")
+    assert _daily_matches_reviews(conn)
+    conn.close()
+
+
+def test_new_database_starts_at_current_schema(load_app):
+    app = load_app()
+    app.load_reviews_db()
+    conn = sqlite3.connect("reviews.db")
+    assert conn.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()[0] == str(app.SCHEMA_VERSION)
+    assert {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")} == set(app.AGGREGATE_TRIGGERS)
+    conn.close()
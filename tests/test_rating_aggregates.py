@@ -0,0 +1,42 @@
+import sqlite3
+
+import pandas as pd
+
+
+def _status(app):
+    conn = sqlite3.connect(app.reviews_db_file)
+    row = conn.execute("SELECT Rating, PrevRating FROM listing_status WHERE Name = 'Piso C' AND Platform = 'Booking'").fetchone()
+    conn.close()
+    return row
+
+
+def test_rebuilt_status_matches_triggers_after_compaction(load_app):
+    app = load_app()
+    now = pd.Timestamp("2024-06-30 12:00:00")
+    syncs = [("2024-04-01 10:00:00", 7.4), ("2024-05-20 09:00:00", 9.5), ("2024-05-20 18:00:00", 9.0), ("2024-05-10 08:00:00", 8.0)]
+    app.merge_scraped_results([{"Date": d, "Platform": "Booking", "Name": "Piso C", "URL": "u", "Rating": r, "Reviews": []} for d, r in syncs])
+    assert _status(app) == (9.0, 9.5)
+
+    stats = app.compact_rating_snapshots(now=now)
+    assert stats["notas resumidas"] == 2  # Las dos últimas siguen sueltas
+    assert _status(app) == (9.0, 9.5)
+
+    with app.local_db() as conn:
+        app.rebuild_rating_aggregates(conn)
+    assert _status(app) == (9.0, 9.5)
+
+
+def test_replacing_history_drops_old_rollups(load_app):
+    app = load_app()
+    history = pd.DataFrame([{"Date": d, "Platform": "Booking", "Name": "Piso C", "URL": "u", "Rating": r}
+                            for d, r in [("2024-01-05 10:00:00", 8.0), ("2024-01-20 10:00:00", 8.4),
+                                         ("2024-05-20 09:00:00", 9.5), ("2024-05-20 18:00:00", 9.0)]])
+    app.write_local_history(history)
+    assert app.compact_rating_snapshots(now=pd.Timestamp("2024-06-30 12:00:00"))["notas resumidas"] == 2
+
+    # Volver a importar el detalle (p.ej. desde la pestaña Snapshots) no suma dos veces enero
+    app.write_local_history(history)
+    conn = sqlite3.connect(app.reviews_db_file)
+    assert conn.execute("SELECT COUNT(*) FROM rating_rollups").fetchone()[0] == 0
+    assert conn.execute("SELECT SUM(Count) FROM rating_monthly").fetchone()[0] == 4
+    conn.close()
@@ -0,0 +1,79 @@
+import json
+import os
+
+import pandas as pd
+
+from conftest import FIXTURES
+
+
+def _payloads(name):
+    with open(os.path.join(FIXTURES, name), encoding="utf-8") as f:
+        return [p["body"] for p in json.load(f)["payloads"]]
+
+
+def test_parse_airbnb_reviews_payload(load_app):
+    app = load_app()
+    first, second = _payloads("airbnb.reviews.json")
+    assert app.parse_airbnb_reviews_payload(first) == [
+        {"Reviewer": "Lucía", "Rating": 5, "Date": "2024-10-20", "Text": "Todo perfecto, muy limpio y céntrico."},
+        # localizedReview (traducción) manda sobre el original
+        {"Reviewer": "John", "Rating": 2, "Date": "2024-09-02", "Text": "El baño estaba sucio."},
+    ]
+    # Sin createdAt se queda la fecha localizada; sin texto no es reseña
+    assert app.parse_airbnb_reviews_payload(second)[1:] == [
+        {"Reviewer": "Marta", "Rating": 4, "Date": "agosto de 2024", "Text": "Bien, aunque algo de ruido por la noche."},
+    ]
+
+
+def test_parse_booking_reviews_payload(load_app):
+    app = load_app()
+    (body,) = _payloads("booking.reviews.json")
+    assert app.parse_booking_reviews_payload(body) == [
+        {"Reviewer": "Carlos", "Rating": 9.6, "Date": "2024-06-18", "Text": "Excepcional | Ubicación inmejorable."},
+        {"Reviewer": "Anne", "Rating": 4, "Date": "2024-06-04", "Text": "Decepcionante | Había cucarachas en la cocina."},
+        {"Reviewer": "Anónimo", "Rating": 7.0, "Date": "2024-05-21", "Text": "Correcto."},
+    ]
+
+
+def test_recorded_fixtures_replay_through_review_capture(load_app):
+    app = load_app()
+    airbnb = app.load_review_fixture(os.path.join(FIXTURES, "airbnb.reviews.json"))
+    assert (airbnb.payloads, [r["Reviewer"] for r in airbnb.reviews]) == (2, ["Lucía", "John", "Marta"])  # sin repetir a John
+    booking = app.load_review_fixture(os.path.join(FIXTURES, "booking.reviews.json"))
+    assert booking.as_texts()[1] == "⭐ 4.0 | Decepcionante | Había cucarachas en la cocina."
+    assert app.check_review_fixtures(FIXTURES) == 0
+
+
+def test_booking_json_score_survives_text_round_trip(load_app):
+    app = load_app()
+    # reviewScore llega entero en el JSON de Booking
+    text = app.format_review_text("Booking", {"Rating": 4, "Reviewer": "Ana", "Text": "Regular"})
+    assert text == "⭐ 4.0 | Regular"
+    # Textos ya guardados con la nota entera ("⭐ 4 | ...") también se leen
+    df = pd.DataFrame({"Text": ["⭐ 4 | Regular", "⭐ 10 | Genial", text], "Platform": ["Booking"] * 3})
+    scored = app.score_negativity(df)
+    assert scored["Score"].tolist() == [4.0, 10.0, 4.0]
+    assert scored["IsNegative"].tolist() == [True, False, True]
+    assert scored["NotaUI"].tolist() == ["4.0", "10.0", "4.0"]
+
+
+def test_booking_score_needs_its_prefix(load_app):
+    app = load_app()
+    df = pd.DataFrame({"Text": ["Puntuación: 6,5", "Habitación 2 | Todo correcto"],
+                       "Platform": ["Booking"] * 2})
+    scored = app.score_negativity(df)
+    assert scored["Score"].iloc[0] == 6.5
+    assert pd.isna(scored["Score"].iloc[1])
+
+
+def test_structured_rating_takes_precedence_over_text(load_app):
+    app = load_app()
+    df = pd.DataFrame({
+        "Platform": ["Booking", "Booking", "Airbnb", "Airbnb"],
+        "Rating": [6.0, None, 2.0, None],
+        "Text": ["👤 Ana: Todo bien", "⭐ 9.0 | Todo bien", "👤 Luis: Todo bien", "Valoración: 5 estrellas"],
+    })
+    scored = app.score_negativity(df)
+    assert scored["Score"].tolist() == [6.0, 9.0, 2.0, 5.0]
+    assert scored["IsNegative"].tolist() == [True, False, True, False]
+    assert scored["NotaUI"].astype(str).tolist() == ["6.0", "9.0", "2 ⭐", "5 ⭐"]
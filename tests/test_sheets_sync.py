@@ -0,0 +1,85 @@
+import json
+import sqlite3
+
+import pandas as pd
+import pytest
+
+
+class FakeWorksheet:
+    """Lo que upsert_worksheet usa de gspread.Worksheet, sobre una lista de filas."""
+    id = 0
+    col_count = 26
+
+    def __init__(self, rows):
+        self.rows = [list(r) for r in rows]
+
+    def row_values(self, n):
+        return list(self.rows[n - 1]) if len(self.rows) >= n else []
+
+    def col_values(self, n, value_render_option=None):
+        return [r[n - 1] if len(r) >= n else "" for r in self.rows]
+
+    def get_all_values(self, value_render_option=None):
+        return [list(r) for r in self.rows]
+
+    def update(self, values, start):
+        if start == "A1" and not self.rows: self.rows = [list(r) for r in values]
+        else: self.rows[0] += values[0]  # Solo cabecera (columnas nuevas)
+
+    def append_rows(self, rows, table_range=None):
+        self.rows += [list(r) for r in rows]
+
+    def batch_update(self, updates):
+        self.updates = updates
+
+    def records(self):
+        header = self.rows[0]
+        return {r[header.index("Hash")]: dict(zip(header, r)) for r in self.rows[1:]}
+
+
+def test_partial_upsert_appends_full_rows_for_unknown_hashes(load_app):
+    app = load_app()
+    ws = FakeWorksheet([["Hash", "Name", "Text", "Category"], ["aaaaaa1", "Piso A", "Bien", "General"]])
+    full = pd.DataFrame([{"Hash": "bbbbbb2", "Name": "Piso B", "Text": "Sucio", "Category": "Limpieza", "Cleaner": "Ana"}])
+    edits = pd.DataFrame([{"Hash": "aaaaaa1", "Category": "Ruido/Descanso"},
+                          {"Hash": "bbbbbb2", "Category": "Limpieza"},
+                          {"Hash": "cccccc3", "Category": "Otros"}])  # Ya no está en local
+
+    stats = app.upsert_worksheet(ws, edits, partial=True, complete=lambda hashes: full[full["Hash"].isin(hashes)])
+
+    assert stats["nuevas"] == 1 and stats["omitidas"] == 1
+    rows = ws.records()
+    assert set(rows) == {"aaaaaa1", "bbbbbb2"}  # Sin fila a medias para cccccc3
+    assert rows["bbbbbb2"] == {"Hash": "bbbbbb2", "Name": "Piso B", "Text": "Sucio", "Category": "Limpieza", "Cleaner": "Ana"}
+    assert ws.updates == [{"range": "D2:D2", "values": [["Ruido/Descanso"]]}]
+
+
+class FailingSheets:
+    """GSheets conectado que no acepta escrituras (save_data devuelve False)."""
+    def __init__(self): self.calls = []
+    def connect(self): return True
+    def save_data(self, df, sheet_name="Reviews", partial=False, complete=None):
+        self.calls.append((sheet_name, sorted(df["Hash"]), complete(list(df["Hash"]))))
+        return False
+
+
+def test_sync_rows_stay_journaled_until_the_upload_succeeds(load_app):
+    app = load_app()
+    app.GS_CONN = FailingSheets()
+    app.merge_scraped_results([{
+        "Date": "2024-03-01 10:00:00", "Platform": "Booking", "Name": "Piso B", "URL": "https://example.com/b", "Rating": 8.4,
+        "Reviews": [{"Text": "⭐ 6.0 | Había ruido", "Date": "2024-02-28", "Rating": 6.0}],
+    }])
+
+    conn = sqlite3.connect(app.reviews_db_file)
+    journal = conn.execute("SELECT Sheet, changes FROM pending_edits ORDER BY id").fetchall()
+    conn.close()
+    assert [sheet for sheet, _ in journal] == [app.SNAPSHOTS_SHEET, "Reviews"]
+    assert json.loads(journal[1][1])["Text"] == "⭐ 6.0 | Había ruido"
+
+    with pytest.raises(RuntimeError):
+        app.flush_pending_edits()
+    assert app.count_pending_edits() == 2
+    # La fila completa sale del SQLite (con lo calculado al guardar, p.ej. Category)
+    sheet, _hashes, full = app.GS_CONN.calls[0]
+    assert sheet == app.SNAPSHOTS_SHEET and full["Rating"].tolist() == [8.4]
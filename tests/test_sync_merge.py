@@ -0,0 +1,71 @@
+import asyncio
+import sqlite3
+
+
+def _sync_record(reviews):
+    return {"Date": "2024-03-01 10:00:00", "Platform": "Booking", "Name": "Piso B", "URL": "https://example.com/b",
+            "Rating": 8.4, "Reviews": reviews}
+
+
+def _stored_reviews(app):
+    conn = sqlite3.connect(app.reviews_db_file)
+    rows = conn.execute("SELECT Reviewer, substr(Date, 1, 10), Text FROM reviews ORDER BY Reviewer").fetchall()
+    conn.close()
+    return rows
+
+
+def test_same_text_from_two_guests_is_two_reviews(load_app):
+    app = load_app()
+    reviews = [{"Text": "⭐ 9.0 | Todo bien", "Reviewer": "Ana", "Date": "2024-02-20", "Rating": 9.0},
+               {"Text": "⭐ 9.0 | Todo bien", "Reviewer": "Luis", "Date": "2024-02-25", "Rating": 9.0}]
+    app.merge_scraped_results([_sync_record(reviews)])
+    app.merge_scraped_results([_sync_record(reviews)])  # La siguiente sync no duplica
+    assert _stored_reviews(app) == [("Ana", "2024-02-20", "⭐ 9.0 | Todo bien"), ("Luis", "2024-02-25", "⭐ 9.0 | Todo bien")]
+
+    # Releer el histórico (p.ej. desde GSheets) reconoce las filas como reseñas sueltas
+    snapshots, items = app.split_history(app.read_local_reviews())
+    assert snapshots.empty and len(items) == 2
+
+
+def test_reviews_stored_before_reviewer_keys_are_not_duplicated(load_app):
+    app = load_app()
+    # Guardada sin autor (clave antigua: Nombre + Plataforma + Texto)
+    app.merge_scraped_results([_sync_record([{"Text": "⭐ 9.0 | Todo bien", "Date": "2024-02-20", "Rating": 9.0}])])
+    reviews = [{"Text": "⭐ 9.0 | Todo bien", "Reviewer": "Ana", "Date": "2024-02-20", "Rating": 9.0},
+               {"Text": "⭐ 9.0 | Todo bien", "Reviewer": "Luis", "Date": "2024-02-25", "Rating": 9.0}]
+    app.merge_scraped_results([_sync_record(reviews)])
+    app.merge_scraped_results([_sync_record(reviews)])
+    assert len(_stored_reviews(app)) == 2
+
+
+class _InlinePool:
+    def run(self, coro):
+        return asyncio.run(coro)
+
+
+def test_fingerprints_wait_for_the_merge(load_app, monkeypatch):
+    app = load_app()
+    listing = {"name": "Piso B", "booking_url": "https://example.com/b"}
+
+    async def fake_scrape(accommodations_list, fingerprints=None, skip_urls=None, on_result=None, **kwargs):
+        if "https://example.com/b" in skip_urls: return
+        fingerprints["https://example.com/b"] = "huella"
+        on_result("Piso B", "Booking", "https://example.com/b", _sync_record([]), "ok")
+
+    def failing_merge(results):
+        raise RuntimeError("disco lleno")
+
+    monkeypatch.setattr(app, "get_browser_pool", _InlinePool)
+    monkeypatch.setattr(app, "scrape_data_async", fake_scrape)
+    monkeypatch.setattr(app, "merge_scraped_results", failing_merge)
+    job = app.SyncJob()
+    job.start([listing])
+    job._thread.join()
+    assert job.record["status"] == "error"
+    assert app.load_fingerprints() == {}  # La próxima sync vuelve a visitar la ficha
+
+    monkeypatch.setattr(app, "merge_scraped_results", lambda results: None)
+    job.start([listing], resume=True)
+    job._thread.join()
+    assert job.record["status"] == "done"
+    assert app.load_fingerprints() == {"https://example.com/b": "huella"}